@@ -6,8 +6,14 @@ class ApiConfig(AppConfig):
     name = 'api'
 
     def ready(self):
+        # Create the tile cache backend when the app is loaded, so that a
+        # misconfigured backend fails at startup instead of on every tile
+        # request
+        from .tile_cache import get_tile_cache
+        get_tile_cache()
+
         # When `SERVER_SOFTWARE` is in the environment, we know that the app
         # has been loaded from gunicorn, not a management command.
         if os.environ.get('SERVER_SOFTWARE') is not None:
             from .matching import GazetteerCache
-            GazetteerCache.get_latest()
+            GazetteerCache.current()
@@ -4,8 +4,9 @@ from api.matching import GazetteerCache
 
 @check
 def _check_gazetteercache():
-    GazetteerCache.get_latest()
-    return {'ok': True}
+    GazetteerCache.current()
+    # The stats are None while the gazetteer is being loaded in the background
+    return dict(ok=True, **(GazetteerCache.index_stats() or {}))
 
 
 def gazetteercache():
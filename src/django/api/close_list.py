@@ -2,22 +2,105 @@ from datetime import datetime
 from django.utils import timezone
 
 from django.db import transaction
+from simple_history.utils import bulk_create_with_history
 
-from api.models import (Facility, FacilityActivityReport, Contributor, User)
+from api.models import (Facility, FacilityActivityReport, Contributor, User,
+                        index_facilities)
+from api.processing import bulk_update_with_history
 
+# The number of facilities closed in each transaction
+CLOSE_LIST_CHUNK_SIZE = 1000
 
-@transaction.atomic
-def close_list(list_id, user_id):
+
+def close_list(list_id, user_id, chunk_size=CLOSE_LIST_CHUNK_SIZE,
+               dry_run=False, progress=None):
+    """
+    Close the open facilities in a list and create a confirmed
+    `FacilityActivityReport` for each of them.
+
+    The facilities are closed in chunks that are each committed in their own
+    transaction, so rows are only locked while a chunk is written. Facilities
+    that are already closed are skipped, so closing a list again finishes a
+    closure that was interrupted. All of the facilities in the list are
+    reindexed once after the last chunk.
+
+    Arguments:
+    list_id -- The ID of a FacilityList.
+    user_id -- The ID of the User recorded as responsible for the closures.
+               The user must be the admin of a contributor.
+    chunk_size -- The maximum number of facilities closed in each transaction.
+    dry_run -- If True, count the facilities without closing them.
+    progress -- An optional function called with the number of facilities
+                closed so far and the number to close after each chunk.
+
+    Returns:
+    A dict with the number of `facilities` in the list, the number that were
+    `already_closed` and the number that were `closed`.
+    """
     user = User.objects.get(id=user_id)
     contributor = Contributor.objects.get(admin=user)
+    facility_ids = list(
+        Facility.objects
+        .filter(facilitylistitem__source__facility_list_id=list_id)
+        .order_by('id')
+        .values_list('id', flat=True)
+        .distinct())
+    open_ids = list(
+        Facility.objects
+        .filter(id__in=facility_ids)
+        .exclude(is_closed=True)
+        .order_by('id')
+        .values_list('id', flat=True))
+
+    counts = {
+        'facilities': len(facility_ids),
+        'already_closed': len(facility_ids) - len(open_ids),
+        'closed': 0,
+    }
+    if dry_run:
+        return counts
+
+    for start in range(0, len(open_ids), chunk_size):
+        with transaction.atomic():
+            counts['closed'] += close_facilities(
+                open_ids[start:start + chunk_size], user, contributor)
+        if progress is not None:
+            progress(counts['closed'], len(open_ids))
+
+    if len(facility_ids) > 0:
+        index_facilities(facility_ids)
+
+    return counts
+
+
+def close_facilities(facility_ids, user, contributor):
+    """
+    Close the specified facilities with a bulk update that writes history
+    records and bulk create a confirmed `FacilityActivityReport` for each of
+    them. Should be called in a transaction.
+
+    Arguments:
+    facility_ids -- A list of Facility IDs.
+    user -- The User recorded as responsible for the closures.
+    contributor -- The Contributor of `user`.
+
+    Returns:
+    The number of facilities closed.
+    """
     now = datetime.now(tz=timezone.utc)
     reason = "Closed via bulk list closure"
-    facilities = Facility.objects.filter(
-        facilitylistitem__source__facility_list_id=list_id)
+    # The rows are locked so that a facility closed by another request after
+    # the open facilities were listed is not closed again
+    facilities = list(Facility.objects
+                      .select_for_update()
+                      .filter(id__in=facility_ids)
+                      .exclude(is_closed=True))
     for facility in facilities:
         facility.is_closed = True
-        facility.save()
-        FacilityActivityReport.objects.create(
+        facility.updated_at = now
+    bulk_update_with_history(facilities, Facility, ['is_closed', 'updated_at'])
+    bulk_create_with_history([
+        FacilityActivityReport(
             facility=facility,
             reported_by_user=user,
             reported_by_contributor=contributor,
@@ -28,4 +111,5 @@ def close_list(list_id, user_id):
             status_change_reason=reason,
             status_change_by=user,
             status_change_date=now,
-        )
+        ) for facility in facilities], FacilityActivityReport)
+    return len(facilities)
@@ -0,0 +1,466 @@
+import logging
+import math
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from django.conf import settings
+from django.db import connection
+
+from api.constants import FacilitiesQueryParams
+from api.facility_type_processing_type import get_facility_and_processing_type
+from api.helpers import clean
+from api.models import Facility
+
+logger = logging.getLogger(__name__)
+
+# The radius used by the web mercator projection
+EARTH_RADIUS = 6378137.0
+
+# The web mercator projection does not extend to the poles
+MAX_MERCATOR_LATITUDE = 85.0511
+
+# The size of a vector tile in tile coordinates and the margin around the tile
+# within which points are kept, which match the defaults of ST_AsMVTGeom
+MVT_EXTENT = 4096
+MVT_BUFFER = 256
+
+# The query parameters that filter on columns that are not kept in the store.
+# Tiles filtered by these parameters are created by the database.
+UNSUPPORTED_FILTER_PARAMS = [
+    FacilitiesQueryParams.Q,
+    FacilitiesQueryParams.NAME,
+    FacilitiesQueryParams.BOUNDARY,
+    FacilitiesQueryParams.NATIVE_LANGUAGE_NAME,
+]
+
+# The FacilityIndex array columns kept in the store and the type of their
+# values. Each column is stored as a mapping of each value to the positions
+# of the facilities whose array contains the value.
+ARRAY_COLUMNS = [
+    ('contrib_types', str),
+    ('contributors', int),
+    ('lists', int),
+    ('facility_type', str),
+    ('processing_type', str),
+    ('product_type', str),
+    ('number_of_workers', str),
+    ('parent_company_id', int),
+    ('parent_company_name', str),
+]
+
+# The number of FacilityIndex rows fetched from the database at a time when
+# building the store
+FACILITY_POINT_STORE_FETCH_SIZE = 10000
+
+
+def lng_lat_to_mercator(lng, lat):
+    x = np.radians(lng) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * EARTH_RADIUS
+    return x, y
+
+
+def mercator_to_lng_lat(x, y):
+    lng = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    # Longitudes outside of the world wrap around as they do in PostGIS
+    return (lng + 180) % 360 - 180, lat
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def encode_field(number, wire_type, value):
+    key = encode_varint((number << 3) | wire_type)
+    if wire_type == 0:
+        return key + encode_varint(value)
+    if wire_type == 1:
+        return key + value
+    return key + encode_varint(len(value)) + value
+
+
+def encode_packed(values):
+    return b''.join(encode_varint(value) for value in values)
+
+
+def encode_mvt_value(value):
+    if isinstance(value, float):
+        return encode_field(3, 1, np.float64(value).tobytes())
+    elif value >= 0:
+        return encode_field(5, 0, value)
+    return encode_field(6, 0, encode_zigzag(value))
+
+
+def encode_point_mvt_layer(name, points, properties):
+    """
+    Encode a Mapbox vector tile with a single layer of point features.
+
+    Arguments:
+    name -- The name of the layer.
+    points -- A list of (x, y) tile coordinates of the points.
+    properties -- A list with a dict of property names to int or float values
+                  for each point.
+
+    Returns:
+    The bytes of the vector tile.
+    """
+    keys = {}
+    values = {}
+    features = []
+    for (x, y), props in zip(points, properties):
+        tags = []
+        for key, value in props.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(
+                encode_mvt_value(value), len(values)))
+        # A single MoveTo command followed by the coordinates of the point
+        geometry = [9, encode_zigzag(x), encode_zigzag(y)]
+        features.append(encode_field(2, 2, (
+            encode_field(2, 2, encode_packed(tags))
+            + encode_field(3, 0, 1)
+            + encode_field(4, 2, encode_packed(geometry)))))
+    if not features:
+        return b''
+    layer = (
+        encode_field(15, 0, 2)
+        + encode_field(1, 2, name.encode())
+        + b''.join(features)
+        + b''.join(encode_field(3, 2, key.encode()) for key in keys)
+        + b''.join(encode_field(4, 2, value) for value in values)
+        + encode_field(5, 0, MVT_EXTENT))
+    return encode_field(3, 2, layer)
+
+
+class FacilityPointStore(object):
+    """
+    The projected location and filterable attributes of every indexed
+    facility held in NumPy arrays, so that facility grid tiles can be
+    counted for any supported filter without querying the database.
+    """
+    def __init__(self, version, x, y, country_codes, countries, arrays):
+        self.version = version
+        self.x = x
+        self.y = y
+        self.country_codes = country_codes
+        self.countries = countries
+        self.arrays = arrays
+
+    @classmethod
+    def load(cls, version):
+        """
+        Build a store from the rows of the FacilityIndex table.
+
+        Arguments:
+        version -- The tile cache key of the facilities at the time the store
+                   is built.
+
+        Returns:
+        A FacilityPointStore.
+        """
+        lngs = []
+        lats = []
+        country_codes = []
+        countries = {}
+        arrays = {column: {} for column, _ in ARRAY_COLUMNS}
+        columns = ', '.join(column for column, _ in ARRAY_COLUMNS)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT ST_X(location), ST_Y(location), country_code, {} '
+                'FROM api_facilityindex '
+                'WHERE abs(ST_Y(location)) < %s'.format(columns),
+                [MAX_MERCATOR_LATITUDE])
+            position = 0
+            while True:
+                rows = cursor.fetchmany(FACILITY_POINT_STORE_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    lngs.append(row[0])
+                    lats.append(row[1])
+                    country_codes.append(
+                        countries.setdefault(row[2], len(countries)))
+                    for (column, _), values in zip(ARRAY_COLUMNS, row[3:]):
+                        for value in set(values or []):
+                            arrays[column].setdefault(value, []).append(
+                                position)
+                    position += 1
+
+        x, y = lng_lat_to_mercator(np.array(lngs, dtype=np.float64),
+                                   np.array(lats, dtype=np.float64))
+        return cls(
+            version, x, y, np.array(country_codes, dtype=np.int32), countries,
+            {column: {value: np.array(positions, dtype=np.int32)
+                      for value, positions in values.items()}
+             for column, values in arrays.items()})
+
+    def __len__(self):
+        return len(self.x)
+
+    def supports(self, params):
+        return not any(param in params for param in UNSUPPORTED_FILTER_PARAMS)
+
+    def match_any(self, column, values, value_type):
+        mask = np.zeros(len(self), dtype=bool)
+        for value in set(values):
+            try:
+                positions = self.arrays[column].get(value_type(value))
+            except (TypeError, ValueError):
+                # A value that cannot be converted is in no facility's array
+                continue
+            if positions is not None:
+                mask[positions] = True
+        return mask
+
+    def match_all(self, column, values, value_type):
+        try:
+            values = set(value_type(value) for value in values)
+        except (TypeError, ValueError):
+            # A value that cannot be converted is in no facility's array
+            return np.zeros(len(self), dtype=bool)
+        counts = np.zeros(len(self), dtype=np.int32)
+        for value in values:
+            positions = self.arrays[column].get(value)
+            if positions is None:
+                return np.zeros(len(self), dtype=bool)
+            counts[positions] += 1
+        return counts == len(values)
+
+    def filter(self, params):
+        """
+        Find the facilities that match request query params in the same way
+        as `FacilityIndexManager.filter_by_query_params`.
+
+        Arguments:
+        params (dict) -- Request query parameters that are `supported`.
+
+        Returns:
+        A boolean array that is True for each matching facility.
+        """
+        column_types = dict(ARRAY_COLUMNS)
+        mask = np.ones(len(self), dtype=bool)
+
+        def overlap(column, values):
+            return self.match_any(column, values, column_types[column])
+
+        countries = params.getlist(FacilitiesQueryParams.COUNTRIES)
+        if len(countries):
+            codes = [self.countries[c] for c in countries
+                     if c in self.countries]
+            mask &= np.isin(self.country_codes, codes)
+
+        contributor_types = params.getlist(
+            FacilitiesQueryParams.CONTRIBUTOR_TYPES)
+        if len(contributor_types):
+            mask &= overlap('contrib_types', contributor_types)
+
+        contributors = params.getlist(FacilitiesQueryParams.CONTRIBUTORS)
+        if len(contributors):
+            combine_contributors = params.get(
+                FacilitiesQueryParams.COMBINE_CONTRIBUTORS, '')
+            if combine_contributors.upper() == 'AND':
+                mask &= self.match_all('contributors', contributors, int)
+            else:
+                mask &= overlap('contributors', contributors)
+
+        lists = params.getlist(FacilitiesQueryParams.LISTS)
+        if len(lists):
+            mask &= overlap('lists', lists)
+
+        parent_companies = params.getlist(FacilitiesQueryParams.PARENT_COMPANY)
+        if len(parent_companies):
+            mask &= (
+                overlap('parent_company_id',
+                        [p for p in parent_companies if p.isnumeric()])
+                | overlap('parent_company_name',
+                          [p for p in parent_companies
+                           if not p.isnumeric()]))
+
+        facility_types = params.getlist(FacilitiesQueryParams.FACILITY_TYPE)
+        if len(facility_types):
+            standard_types = [
+                get_facility_and_processing_type(t) for t in facility_types]
+            mask &= overlap('facility_type', [
+                t[2] for t in standard_types if t[0] is not None])
+
+        processing_types = params.getlist(
+            FacilitiesQueryParams.PROCESSING_TYPE)
+        if len(processing_types):
+            standard_types = [
+                get_facility_and_processing_type(t) for t in processing_types]
+            mask &= overlap('processing_type', [
+                t[3] for t in standard_types if t[0] is not None])
+
+        product_types = params.getlist(FacilitiesQueryParams.PRODUCT_TYPE)
+        if len(product_types):
+            mask &= overlap('product_type', [clean(t) for t in product_types])
+
+        number_of_workers = params.getlist(
+            FacilitiesQueryParams.NUMBER_OF_WORKERS)
+        if len(number_of_workers):
+            mask &= overlap('number_of_workers', number_of_workers)
+
+        return mask
+
+    def get_grid_vector_tile(self, params, layer, xy_bounds, hex_dimensions):
+        """
+        Create a facility grid vector tile with the same cells and properties
+        as the tiles created by the database.
+
+        Arguments:
+        params (dict) -- Request query parameters that are `supported`.
+        layer (string) -- The name of the tile layer.
+        xy_bounds -- The web mercator bounds of the tile.
+        hex_dimensions -- The width of the grid hexagons, half of the length
+                          of a side of a hexagon and the height of a pair of
+                          rows of hexagons.
+
+        Returns:
+        The bytes of the vector tile.
+        """
+        width, a, height = hex_dimensions
+        b = width / 2
+        index_xmin = math.floor(xy_bounds.left / width)
+        index_xmax = math.ceil(xy_bounds.right / width)
+        index_ymin = math.floor(xy_bounds.bottom / height)
+        index_ymax = math.ceil(xy_bounds.top / height)
+
+        # Only bin the facilities near the tile
+        mask = (self.filter(params)
+                & (self.x >= (index_xmin - 1) * width)
+                & (self.x <= (index_xmax + 1) * width)
+                & (self.y >= (index_ymin - 1) * height)
+                & (self.y <= (index_ymax + 1) * height))
+        px = self.x[mask]
+        py = self.y[mask]
+
+        # Hexagon centers are on two offset rectangular lattices, so the
+        # hexagon that contains a point is the one with the nearer of the
+        # closest center on each lattice
+        x0 = np.rint(px / width)
+        y0 = np.rint((py - 2 * a) / height)
+        x1 = np.rint((px - b) / width)
+        y1 = np.rint((py - 5 * a) / height)
+        is_even = ((px - x0 * width) ** 2 + (py - y0 * height - 2 * a) ** 2
+                   <= (px - x1 * width - b) ** 2
+                   + (py - y1 * height - 5 * a) ** 2)
+        cell_x = np.where(is_even, x0, x1).astype(np.int64)
+        cell_row = np.where(is_even, y0, y1).astype(np.int64)
+        cell_offset = np.where(is_even, 0, 1)
+
+        in_tile = ((cell_x >= index_xmin) & (cell_x <= index_xmax)
+                   & (cell_row >= index_ymin) & (cell_row <= index_ymax))
+        cells, counts = np.unique(
+            np.stack([cell_x[in_tile], cell_row[in_tile],
+                      cell_offset[in_tile]], axis=1),
+            axis=0, return_counts=True)
+        if len(cells) == 0:
+            return b''
+
+        cx = cells[:, 0] * width + cells[:, 2] * b
+        cy = cells[:, 1] * height + (2 + 3 * cells[:, 2]) * a
+        lng_min, lat_min = mercator_to_lng_lat(cx - b, cy - 2 * a)
+        lng_max, lat_max = mercator_to_lng_lat(cx + b, cy + 2 * a)
+        tile_x = np.rint((cx - xy_bounds.left) * MVT_EXTENT
+                         / (xy_bounds.right - xy_bounds.left))
+        tile_y = np.rint((xy_bounds.top - cy) * MVT_EXTENT
+                         / (xy_bounds.top - xy_bounds.bottom))
+
+        # Exclude geoms on the edges that wrap around the world and those
+        # outside of the tile buffer, which ST_AsMVTGeom drops
+        keep = np.flatnonzero(
+            (np.abs(lng_max - lng_min) < 180)
+            & (tile_x >= -MVT_BUFFER) & (tile_x <= MVT_EXTENT + MVT_BUFFER)
+            & (tile_y >= -MVT_BUFFER) & (tile_y <= MVT_EXTENT + MVT_BUFFER))
+
+        return encode_point_mvt_layer(
+            layer,
+            [(int(tile_x[i]), int(tile_y[i])) for i in keep],
+            [{
+                'count': int(counts[i]),
+                'xmin': float(lng_min[i]),
+                'ymin': float(lat_min[i]),
+                'xmax': float(lng_max[i]),
+                'ymax': float(lat_max[i]),
+            } for i in keep])
+
+
+_facility_point_store = None
+_facility_point_store_lock = threading.Lock()
+_facility_point_store_checked_at = 0
+_facility_point_store_loading = False
+
+
+def _refresh_facility_point_store(store):
+    """
+    Rebuild the shared FacilityPointStore if the tile cache key of the
+    facilities is not the version of `store`. Runs on a background thread
+    started by `get_facility_point_store`.
+
+    Arguments:
+    store -- The FacilityPointStore currently shared by the threads in this
+             process, or None.
+    """
+    global _facility_point_store, _facility_point_store_loading
+    try:
+        version = Facility.current_tile_cache_key()
+        if store is None or store.version != version:
+            started = time.time()
+            store = FacilityPointStore.load(version)
+            logger.info('Loaded {} facilities into the point store in '
+                        '{:.2f}s'.format(len(store), time.time() - started))
+    except Facility.DoesNotExist:
+        store = None
+    except Exception:
+        logger.error('Failed to load the facility point store: {}'.format(
+            traceback.format_exc()))
+    finally:
+        with _facility_point_store_lock:
+            _facility_point_store = store
+            _facility_point_store_loading = False
+        # Each thread has its own connection, which would otherwise be left
+        # open when the thread finishes
+        connection.close()
+
+
+def get_facility_point_store():
+    """
+    Returns:
+    The FacilityPointStore shared by the threads in this process, or None if
+    the store is disabled or has not been built yet.
+
+    The tile cache key of the facilities is checked at most once every
+    FACILITY_POINT_STORE_REFRESH_INTERVAL_IN_SECONDS. When it has changed,
+    the store is rebuilt on a background thread while the previous store
+    continues to be used, or tiles are created with the database if there is
+    no previous store.
+    """
+    global _facility_point_store_checked_at, _facility_point_store_loading
+    if not settings.FACILITY_POINT_STORE:
+        return None
+
+    with _facility_point_store_lock:
+        store = _facility_point_store
+        now = time.time()
+        if _facility_point_store_loading or (
+                now - _facility_point_store_checked_at
+                < settings.FACILITY_POINT_STORE_REFRESH_INTERVAL_IN_SECONDS):
+            return store
+        _facility_point_store_checked_at = now
+        _facility_point_store_loading = True
+
+    threading.Thread(target=_refresh_facility_point_store, args=(store,),
+                     name='facility-point-store', daemon=True).start()
+    return store
@@ -1,11 +1,34 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from api.helpers import clean
+from api.models import GeocodingCacheEntry
 
 
+OK = "OK"
 ZERO_RESULTS = "ZERO_RESULTS"
+OVER_QUERY_LIMIT = "OVER_QUERY_LIMIT"
+UNKNOWN_ERROR = "UNKNOWN_ERROR"
 GEOCODING_URL = "https://maps.googleapis.com/maps/api/geocode/json"
 
+# The statuses of the responses that answer whether an address can be
+# geocoded. Other statuses, such as REQUEST_DENIED, are errors that are raised
+# rather than returned or cached as an address with no results.
+GEOCODING_RESULT_STATUSES = (OK, ZERO_RESULTS)
+
+# The statuses of responses to requests that may succeed if they are retried
+GEOCODING_RETRY_STATUSES = (OVER_QUERY_LIMIT, UNKNOWN_ERROR)
+
 
 def create_geocoding_params(address, country_code):
     return {
@@ -75,19 +98,315 @@ def find_valid_country_code(data, country_code):
     raise ValueError(error)
 
 
+class TokenBucket:
+    """
+    A thread-safe rate limiter that allows an average of `rate` acquisitions
+    per second, with bursts of up to `capacity` acquisitions.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token from the bucket, waiting for one to be added if the
+        bucket is empty.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class GeocodingClient:
+    """
+    Sends geocoding requests over a pool of persistent HTTP connections,
+    limiting the rate of requests and retrying requests that fail with a
+    server error or because the query limit was exceeded. A client can be
+    shared by multiple threads.
+
+    Arguments:
+    url -- The URL of the geocoding API.
+    requests_per_second -- The maximum average rate of requests.
+    max_retries -- The number of times a failed request is retried.
+    backoff -- The number of seconds to wait before the first retry. The wait
+               is doubled for each subsequent retry.
+    timeout -- The number of seconds to wait for a response.
+    concurrency -- The number of requests sent at the same time by
+                   `geocode_batch`, which is also the size of the connection
+                   pool.
+    """
+    def __init__(self, url=GEOCODING_URL, requests_per_second=50,
+                 max_retries=3, backoff=1, timeout=10, concurrency=10):
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, params):
+        """
+        Send a geocoding request, retrying it with exponential backoff if it
+        fails with a connection error, a 5xx status or an OVER_QUERY_LIMIT or
+        UNKNOWN_ERROR status.
+
+        Returns:
+        The parsed JSON response
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            can_retry = attempt < self.max_retries
+
+            self.rate_limiter.acquire()
+            try:
+                r = self.session.get(self.url, params=params,
+                                     timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if can_retry:
+                    continue
+                raise
+
+            if r.status_code >= 500 and can_retry:
+                continue
+            if r.status_code != 200:
+                raise ValueError("Geocoding request failed with status {}"
+                                 .format(r.status_code))
+
+            data = r.json()
+            if data.get("status") in GEOCODING_RETRY_STATUSES:
+                if can_retry:
+                    continue
+                raise ValueError("Geocoding request failed with status {}"
+                                 .format(data["status"]))
+            return data
+
+    def geocode(self, address, country_code):
+        params = create_geocoding_params(address, country_code)
+        data = self.request(params)
+
+        if data["status"] not in GEOCODING_RESULT_STATUSES:
+            raise ValueError("Geocoding request failed with status {}"
+                             .format(data["status"]))
+        if data["status"] == ZERO_RESULTS or len(data["results"]) == 0:
+            return format_no_geocode_results(data)
+
+        valid_result = find_valid_country_code(data, country_code)
+
+        return format_geocoded_address_data(data, valid_result)
+
+    def geocode_batch(self, addresses):
+        """
+        Geocode several addresses at the same time.
+
+        Arguments:
+        addresses -- A list of (address, country_code) tuples.
+
+        Returns:
+        A list with an item for each address, in the same order, that is
+        either the value returned by `geocode` or the exception it raised
+        """
+        def geocode_or_error(address_and_country_code):
+            try:
+                return self.geocode(*address_and_country_code)
+            except Exception as e:
+                return e
+
+        if len(addresses) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(geocode_or_error, addresses))
+
+
+_geocoding_client = None
+_geocoding_client_lock = threading.Lock()
+
+
+def get_geocoding_client():
+    """
+    Get the `GeocodingClient` shared by all threads, configured from the
+    GEOCODING_* settings.
+    """
+    global _geocoding_client
+    with _geocoding_client_lock:
+        if _geocoding_client is None:
+            _geocoding_client = GeocodingClient(
+                requests_per_second=settings.GEOCODING_REQUESTS_PER_SECOND,
+                max_retries=settings.GEOCODING_MAX_RETRIES,
+                timeout=settings.GEOCODING_TIMEOUT_IN_SECONDS,
+                concurrency=settings.GEOCODING_CONCURRENCY)
+        return _geocoding_client
+
+
+# The number of addresses looked up in the geocoding cache by this process
+# that were found (hits) and that had to be geocoded (misses)
+_geocoding_cache_stats = {'hits': 0, 'misses': 0}
+_geocoding_cache_stats_lock = threading.Lock()
+
+
+def geocoding_cache_stats():
+    with _geocoding_cache_stats_lock:
+        return dict(_geocoding_cache_stats)
+
+
+def geocoding_cache_key(address, country_code):
+    """
+    Get the key of the geocoding cache entry for an address.
+
+    Returns:
+    A (clean address, country code) tuple, or None if the result of geocoding
+    the address should not be cached
+    """
+    if not settings.GEOCODING_CACHE_TTL_IN_DAYS:
+        return None
+    if address is None or country_code is None or len(country_code) != 2:
+        return None
+    clean_address = clean(address)
+    if clean_address is None:
+        return None
+    return (clean_address, country_code.upper())
+
+
+def get_cached_geocoding_results(keys):
+    """
+    Get the unexpired geocoding cache entries for the specified keys and
+    count them as hits.
+
+    Arguments:
+    keys -- A list of keys returned by `geocoding_cache_key`.
+
+    Returns:
+    A dictionary mapping the keys that were found to results in the format
+    returned by `GeocodingClient.geocode`
+    """
+    keys = set(keys)
+    if len(keys) == 0:
+        return {}
+    now = timezone.now()
+    expires_before = now - timedelta(
+        days=settings.GEOCODING_CACHE_TTL_IN_DAYS)
+    entries = [
+        entry for entry in GeocodingCacheEntry.objects.filter(
+            address__in=set(address for address, _ in keys),
+            country_code__in=set(country_code for _, country_code in keys),
+            created_at__gte=expires_before)
+        if (entry.address, entry.country_code) in keys]
+
+    if len(entries) > 0:
+        GeocodingCacheEntry.objects \
+            .filter(id__in=[entry.id for entry in entries]) \
+            .update(hit_count=F('hit_count') + 1, last_hit_at=now)
+    with _geocoding_cache_stats_lock:
+        _geocoding_cache_stats['hits'] += len(entries)
+        _geocoding_cache_stats['misses'] += len(keys) - len(entries)
+
+    return {
+        (entry.address, entry.country_code): {
+            'result_count': entry.result_count,
+            'geocoded_point': entry.geocoded_point,
+            'geocoded_address': entry.geocoded_address,
+            'full_response': entry.full_response,
+        }
+        for entry in entries}
+
+
+def cache_geocoding_results(results):
+    """
+    Store geocoding results in the cache, replacing any expired entries.
+    Results of responses with an error status are not stored.
+
+    Arguments:
+    results -- A dictionary mapping keys returned by `geocoding_cache_key` to
+               results returned by `GeocodingClient.geocode`.
+    """
+    results = {
+        key: result for key, result in results.items()
+        if result['full_response'].get('status') in GEOCODING_RESULT_STATUSES}
+    if len(results) == 0:
+        return
+    expires_before = timezone.now() - timedelta(
+        days=settings.GEOCODING_CACHE_TTL_IN_DAYS)
+    GeocodingCacheEntry.objects.filter(
+        address__in=set(address for address, _ in results.keys()),
+        country_code__in=set(country_code for _, country_code in results),
+        created_at__lt=expires_before).delete()
+    # Another process may have cached the same address since it was looked up
+    GeocodingCacheEntry.objects.bulk_create([
+        GeocodingCacheEntry(
+            address=address,
+            country_code=country_code,
+            result_count=result['result_count'],
+            geocoded_point=result['geocoded_point'],
+            geocoded_address=result['geocoded_address'],
+            full_response=result['full_response'])
+        for (address, country_code), result in results.items()],
+        ignore_conflicts=True)
+
+
 def geocode_address(address, country_code):
-    params = create_geocoding_params(address, country_code)
-    r = requests.get(GEOCODING_URL, params=params)
+    key = geocoding_cache_key(address, country_code)
+    if key is None:
+        return get_geocoding_client().geocode(address, country_code)
+
+    cached = get_cached_geocoding_results([key])
+    if key in cached:
+        return cached[key]
+    result = get_geocoding_client().geocode(address, country_code)
+    cache_geocoding_results({key: result})
+    return result
+
 
-    if r.status_code != 200:
-        raise ValueError("Geocoding request failed with status {}"
-                         .format(r.status_code))
+def geocode_addresses(addresses):
+    """
+    Geocode several addresses, using the cached results for any addresses
+    that have been geocoded before and geocoding the rest concurrently.
 
-    data = r.json()
+    Arguments:
+    addresses -- A list of (address, country_code) tuples.
 
-    if data["status"] == ZERO_RESULTS or len(data["results"]) == 0:
-        return format_no_geocode_results(data)
+    Returns:
+    A list with an item for each address, in the same order, that is
+    either the geocoding result or the exception raised when geocoding the
+    address
+    """
+    keys = [geocoding_cache_key(address, country_code)
+            for address, country_code in addresses]
+    cached = get_cached_geocoding_results(
+        [key for key in keys if key is not None])
 
-    valid_result = find_valid_country_code(data, country_code)
+    # Group the uncached addresses by key so that an address that appears
+    # more than once is only geocoded once
+    uncached = {}
+    for i, key in enumerate(keys):
+        if key not in cached:
+            uncached.setdefault(key if key is not None else i, []).append(i)
+    uncached = list(uncached.values())
+    uncached_results = get_geocoding_client().geocode_batch(
+        [addresses[indexes[0]] for indexes in uncached])
 
-    return format_geocoded_address_data(data, valid_result)
+    results = [cached.get(key) for key in keys]
+    new_results = {}
+    for indexes, result in zip(uncached, uncached_results):
+        for i in indexes:
+            results[i] = result
+        key = keys[indexes[0]]
+        if key is not None and not isinstance(result, Exception):
+            new_results[key] = result
+    cache_geocoding_results(new_results)
+    return results
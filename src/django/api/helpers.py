@@ -1,6 +1,7 @@
 import re
 import csv
 import json
+from functools import lru_cache
 from unidecode import unidecode
 
 from api.constants import NumberOfWorkersRanges
@@ -55,7 +56,11 @@ def try_parse_int_from_float(value):
 
 
 def get_single_contributor_field_values(item, fields):
-    data = parse_raw_data(item.raw_data)
+    return get_raw_data_field_values(item.raw_data, fields)
+
+
+def get_raw_data_field_values(raw_data, fields):
+    data = parse_raw_data(raw_data)
     for f in fields:
         value = data.get(f['column_name'], None)
         if value is not None:
@@ -64,8 +69,12 @@ def get_single_contributor_field_values(item, fields):
 
 
 def get_list_contributor_field_values(item, fields):
-    data_values = get_csv_values(item.raw_data)
     list_fields = get_csv_values(item.source.facility_list.header)
+    return get_csv_field_values(item.raw_data, list_fields, fields)
+
+
+def get_csv_field_values(raw_data, list_fields, fields):
+    data_values = get_csv_values(raw_data)
     for f in fields:
         if f['column_name'] in list_fields:
             index = list_fields.index(f['column_name'])
@@ -74,26 +83,64 @@ def get_list_contributor_field_values(item, fields):
     return fields
 
 
+# The single character substitutions made by `clean`. Mapping to None
+# removes the character.
+CLEAN_TRANSLATION_TABLE = str.maketrans({
+    '\n': ' ',
+    '-': None,
+    '/': ' ',
+    "'": None,
+    ',': None,
+    ':': ' ',
+})
+
+CLEAN_SPACES = re.compile(' +')
+
+NON_ASCII_CHARACTERS = re.compile('[^\x00-\x7f]+')
+
+# The number of distinct values for which the result of `clean` is cached
+CLEAN_CACHE_SIZE = 2 ** 17
+
+
+@lru_cache(maxsize=CLEAN_CACHE_SIZE)
 def clean(column):
     """
     Remove punctuation and excess whitespace from a value before using it to
     find matches. This should be the same function used when developing the
     training data read from training.json as part of train_gazetteer.
     """
-    column = unidecode(column)
-    column = re.sub('\n', ' ', column)
-    column = re.sub('-', '', column)
-    column = re.sub('/', ' ', column)
-    column = re.sub("'", '', column)
-    column = re.sub(",", '', column)
-    column = re.sub(":", ' ', column)
-    column = re.sub(' +', ' ', column)
+    # unidecode transliterates each character independently and leaves ASCII
+    # characters unchanged, so we only pass it the non-ASCII characters
+    if not column.isascii():
+        column = NON_ASCII_CHARACTERS.sub(
+            lambda match: unidecode(match.group()), column)
+    column = CLEAN_SPACES.sub(' ', column.translate(CLEAN_TRANSLATION_TABLE))
     column = column.strip().strip('"').strip("'").lower().strip()
     if not column:
         column = None
     return column
 
 
+def clean_values(values):
+    """
+    Clean a sequence of values, such as a column of names, calling `clean`
+    once for each distinct value.
+
+    Arguments:
+    values -- An iterable of strings.
+
+    Returns:
+    A list of the clean values in the same order.
+    """
+    cleaned = {}
+    result = []
+    for value in values:
+        if value not in cleaned:
+            cleaned[value] = clean(value)
+        result.append(cleaned[value])
+    return result
+
+
 def value_is_in_range(range_value, range):
     range_min = range.get('min', 0)
     range_max = range.get('max', None)
@@ -1,15 +1,23 @@
 import os
 import sys
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connection, transaction
 
 from api.constants import ProcessingAction
-from api.models import FacilityList, FacilityListItem
-from api.matching import match_facility_list_items, identify_exact_matches
+from api.models import FacilityIndexWorker, FacilityList, FacilityListItem
+from api.geocoding import geocoding_cache_stats
+from api.matching import (match_facility_list_items,
+                          identify_exact_matches,
+                          gazetteer_match_pool,
+                          stream_match_facility_list_items)
 from api.processing import (parse_facility_list_item,
                             geocode_facility_list_item,
-                            save_match_details,
+                            geocode_list_item_addresses,
+                            bulk_save_match_details,
                             save_exact_match_details)
 from api.mail import notify_facility_list_complete
 
@@ -22,6 +30,10 @@ LIST_ACTIONS = set([ProcessingAction.MATCH, ProcessingAction.NOTIFY_COMPLETE])
 
 VALID_ACTIONS = list(LINE_ITEM_ACTIONS.keys()) + list(LIST_ACTIONS)
 
+# The number of line items processed in each transaction when items are
+# processed in chunks and no chunk size is specified
+DEFAULT_ITEM_CHUNK_SIZE = 100
+
 
 class Command(BaseCommand):
     help = 'Run an action on all items in a facility list. If ' \
@@ -40,6 +52,26 @@ class Command(BaseCommand):
         group.add_argument('-l', '--list-id',
                            required=True,
                            help='The id of the facility list to process.')
+        parser.add_argument('-c', '--chunk-size',
+                            type=int,
+                            help='Process the list in chunks of this many '
+                                 'items, saving the results of each chunk '
+                                 'in its own transaction. A list that was '
+                                 'partially matched is resumed from the last '
+                                 'saved chunk.')
+        parser.add_argument('-w', '--workers',
+                            type=int,
+                            default=1,
+                            help='The number of threads used to parse or '
+                                 'geocode chunks of the list at the same '
+                                 'time. Each thread uses its own database '
+                                 'connection.')
+        parser.add_argument('-p', '--processes',
+                            type=int,
+                            default=settings.GAZETTEER_MATCH_PROCESSES,
+                            help='The number of processes used to match '
+                                 'the countries in a list at the same time. '
+                                 'Defaults to GAZETTEER_MATCH_PROCESSES.')
 
     def handle(self, *args, **options):
         action = options['action']
@@ -64,23 +96,27 @@ class Command(BaseCommand):
             sys.exit(1)
 
         if action in LINE_ITEM_ACTIONS.keys():
-            self.process_items(facility_list, action, process)
+            self.process_items(facility_list, action, process,
+                               workers=options['workers'],
+                               chunk_size=options['chunk_size'])
         elif action == ProcessingAction.MATCH:
             facility_list = FacilityList.objects.get(id=list_id)
-            total_item_count = \
-                facility_list.source.facilitylistitem_set.count()
 
-            exact_result = identify_exact_matches(facility_list)
-            with transaction.atomic():
-                save_exact_match_details(exact_result)
+            with gazetteer_match_pool(options['processes']):
+                if options['chunk_size']:
+                    success_count, fail_count = self.stream_match(
+                        facility_list, options['chunk_size'])
+                else:
+                    exact_result = identify_exact_matches(facility_list)
+                    with transaction.atomic():
+                        save_exact_match_details(exact_result)
 
-            result = match_facility_list_items(facility_list)
-            with transaction.atomic():
-                save_match_details(result)
+                    result = match_facility_list_items(facility_list)
+                    with transaction.atomic():
+                        bulk_save_match_details(result)
 
-            success_count = len(result['processed_list_item_ids']) + \
-                len(exact_result['processed_list_item_ids'])
-            fail_count = total_item_count - success_count
+                    success_count, fail_count = self.count_match_results(
+                        exact_result, result)
             if success_count > 0:
                 self.stdout.write(
                     self.style.SUCCESS(
@@ -94,7 +130,42 @@ class Command(BaseCommand):
         elif action == ProcessingAction.NOTIFY_COMPLETE:
             notify_facility_list_complete(list_id)
 
-    def process_items(self, facility_list, action, process):
+        # Wait for deferred facility index updates so that the changes are
+        # searchable when the command finishes
+        FacilityIndexWorker.flush()
+
+    def stream_match(self, facility_list, chunk_size):
+        success_count = 0
+        fail_count = 0
+        for exact_result, result in stream_match_facility_list_items(
+                facility_list, chunk_size=chunk_size):
+            # Each chunk is saved in its own transaction so that a failure
+            # only requires the unsaved chunks to be matched again
+            with transaction.atomic():
+                save_exact_match_details(exact_result)
+                bulk_save_match_details(result)
+            chunk_success_count, chunk_fail_count = \
+                self.count_match_results(exact_result, result)
+            success_count += chunk_success_count
+            fail_count += chunk_fail_count
+            self.stdout.write('{}: matched chunk of {} items'.format(
+                ProcessingAction.MATCH,
+                chunk_success_count + chunk_fail_count))
+        return success_count, fail_count
+
+    def count_match_results(self, exact_result, result):
+        # Only the items processed by this run are counted, so items that
+        # were matched by an earlier run are not reported as failures when
+        # matching is resumed
+        item_ids = result['processed_list_item_ids'] + \
+            exact_result['processed_list_item_ids']
+        fail_count = FacilityListItem.objects.filter(
+            id__in=item_ids,
+            status__in=FacilityListItem.ERROR_STATUSES).count()
+        return len(item_ids) - fail_count, fail_count
+
+    def process_items(self, facility_list, action, process, workers=1,
+                      chunk_size=None):
         row_index = os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX')
         if row_index:
             items = FacilityListItem.objects.filter(
@@ -109,35 +180,30 @@ class Command(BaseCommand):
             'failure': 0,
         }
 
-        # Process all items, save affected items, facilities, matches,
-        # and tally successes and failures
-        for item in items:
-            try:
-                with transaction.atomic():
-                    if action == ProcessingAction.MATCH:
-                        matches = process(item)
-                        item.save()
-
-                        if len(matches) == 1:
-                            [match] = matches
-
-                            if match.facility.created_from == item:
-                                item.facility = match.facility
-                                item.save()
-                            elif match.confidence == 1.0:
-                                item.facility = match.facility
-                                item.save()
-                    else:
-                        process(item)
-                        item.save()
-
-                if item.status in FacilityListItem.ERROR_STATUSES:
-                    result['failure'] += 1
-                else:
-                    result['success'] += 1
-            except ValueError as e:
-                self.stderr.write('Value Error: {}'.format(e))
-                result['failure'] += 1
+        if not row_index and (workers > 1 or chunk_size):
+            item_ids = list(items.order_by('id').values_list('id', flat=True))
+            chunk_size = chunk_size or DEFAULT_ITEM_CHUNK_SIZE
+            chunks = [item_ids[i:i + chunk_size]
+                      for i in range(0, len(item_ids), chunk_size)]
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(self.process_chunk_in_thread,
+                                        chunk, action, process)
+                        for chunk in chunks]
+                    for future in as_completed(futures):
+                        self.add_chunk_result(result, future.result(),
+                                              action)
+            else:
+                for chunk in chunks:
+                    self.add_chunk_result(
+                        result, self.process_chunk(chunk, action, process),
+                        action)
+        else:
+            # Process all items, save affected items, facilities, matches,
+            # and tally successes and failures
+            for item in items:
+                self.process_item(item, action, process, result)
 
         # Print successes
         if result['success'] > 0:
@@ -152,3 +218,74 @@ class Command(BaseCommand):
                 self.style.ERROR(
                     '{}: {} failures'.format(
                         action, result['failure'])))
+
+        if action == ProcessingAction.GEOCODE:
+            stats = geocoding_cache_stats()
+            self.stdout.write('{}: {} cached results, {} geocoded'.format(
+                action, stats['hits'], stats['misses']))
+
+    def process_item(self, item, action, process, result):
+        try:
+            with transaction.atomic():
+                if action == ProcessingAction.MATCH:
+                    matches = process(item)
+                    item.save()
+
+                    if len(matches) == 1:
+                        [match] = matches
+
+                        if match.facility.created_from == item:
+                            item.facility = match.facility
+                            item.save()
+                        elif match.confidence == 1.0:
+                            item.facility = match.facility
+                            item.save()
+                else:
+                    process(item)
+                    item.save()
+
+            if item.status in FacilityListItem.ERROR_STATUSES:
+                result['failure'] += 1
+            else:
+                result['success'] += 1
+        except ValueError as e:
+            self.stderr.write('Value Error: {}'.format(e))
+            result['failure'] += 1
+
+    def process_chunk(self, item_ids, action, process):
+        result = {
+            'success': 0,
+            'failure': 0,
+        }
+        # Each item is processed in a savepoint so that an item that fails
+        # with a ValueError does not roll back the rest of the chunk
+        with transaction.atomic():
+            items = list(FacilityListItem.objects.filter(id__in=item_ids)
+                                                 .order_by('id'))
+            if action == ProcessingAction.GEOCODE:
+                # Geocode the addresses in the chunk concurrently before
+                # processing the items
+                geocoded_data = geocode_list_item_addresses(items)
+
+                def geocode_item(item):
+                    return geocode_facility_list_item(
+                        item, geocoded_data.get(item.id))
+                process = geocode_item
+
+            for item in items:
+                self.process_item(item, action, process, result)
+        return result
+
+    def process_chunk_in_thread(self, item_ids, action, process):
+        try:
+            return self.process_chunk(item_ids, action, process)
+        finally:
+            # Each thread has its own connection, which would otherwise be
+            # left open when the thread finishes
+            connection.close()
+
+    def add_chunk_result(self, result, chunk_result, action):
+        result['success'] += chunk_result['success']
+        result['failure'] += chunk_result['failure']
+        self.stdout.write('{}: processed chunk of {} items'.format(
+            action, chunk_result['success'] + chunk_result['failure']))
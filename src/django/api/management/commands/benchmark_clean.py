@@ -0,0 +1,129 @@
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from unidecode import unidecode
+
+from api.helpers import clean, clean_values
+
+
+def clean_with_regexes(column):
+    """
+    The implementation of `clean` that applied each substitution with a
+    separate regular expression, used as the baseline for the benchmark.
+    """
+    column = unidecode(column)
+    column = re.sub('\n', ' ', column)
+    column = re.sub('-', '', column)
+    column = re.sub('/', ' ', column)
+    column = re.sub("'", '', column)
+    column = re.sub(",", '', column)
+    column = re.sub(":", ' ', column)
+    column = re.sub(' +', ' ', column)
+    column = column.strip().strip('"').strip("'").lower().strip()
+    if not column:
+        column = None
+    return column
+
+
+NAME_WORDS = ['Garment', 'Textile', 'Apparel', 'Knit', 'Denim', 'Fashion',
+              'Industries', 'Co.,', 'Ltd.', 'Limited', 'Export', 'Mills',
+              'Dệt May', 'Thời Trang', 'Tekstil', 'Giyim', 'Sanayi',
+              '服装', '有限公司', 'Confecções', 'Ñandú', "O'Neill", 'A/S']
+ADDRESS_WORDS = ['Road', 'Street', 'Lane', 'Industrial Park', 'Zone',
+                 'Phường', 'Quận', 'Mahallesi', 'Cad.', 'No:', 'Sok.',
+                 '工业区', '路', 'Rua', 'São', '-', '/', 'Dhaka-1230',
+                 'Gazipur', 'Ho Chi Minh', 'İstanbul']
+COUNTRIES = ['BD', 'CN', 'IN', 'VN', 'TR', 'PK', 'KH', 'ID', 'BR', 'US']
+
+
+def synthetic_registry(count, distinct_count, seed):
+    """
+    Generate `count` facility rows drawn from `distinct_count` distinct rows,
+    since the same facility is contributed in many lists.
+    """
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(distinct_count):
+        name = ' '.join(rnd.choice(NAME_WORDS)
+                        for _ in range(rnd.randint(2, 5)))
+        address = '{}, {}\n{}'.format(
+            rnd.randint(1, 999),
+            ' '.join(rnd.choice(ADDRESS_WORDS)
+                     for _ in range(rnd.randint(2, 6))),
+            rnd.choice(ADDRESS_WORDS))
+        rows.append({'country': rnd.choice(COUNTRIES),
+                     'name': name,
+                     'address': address})
+    return [rnd.choice(rows) for _ in range(count)]
+
+
+class Command(BaseCommand):
+    help = ('Compare the time taken to clean the country, name, and address '
+            'fields of a synthetic facility registry, as is done when the '
+            'gazetteer is rebuilt, with the previous and current '
+            'implementations of clean.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--count',
+                            type=int,
+                            default=100000,
+                            help='The number of synthetic facilities.')
+        parser.add_argument('-d', '--distinct',
+                            type=float,
+                            default=0.5,
+                            help='The fraction of the facilities that are '
+                                 'distinct.')
+        parser.add_argument('-s', '--seed',
+                            type=int,
+                            default=1,
+                            help='The seed used to generate the facilities.')
+
+    def handle(self, *args, **options):
+        rows = synthetic_registry(
+            options['count'], int(options['count'] * options['distinct']),
+            options['seed'])
+        fields = ('country', 'name', 'address')
+
+        def time_cleaning(clean_row):
+            start = time.perf_counter()
+            result = [clean_row(row) for row in rows]
+            return result, time.perf_counter() - start
+
+        baseline, baseline_time = time_cleaning(
+            lambda row: {k: clean_with_regexes(row[k]) for k in fields})
+
+        clean.cache_clear()
+        uncached, uncached_time = time_cleaning(
+            lambda row: {k: clean.__wrapped__(row[k]) for k in fields})
+
+        clean.cache_clear()
+        cold, cold_time = time_cleaning(
+            lambda row: {k: clean(row[k]) for k in fields})
+        warm, warm_time = time_cleaning(
+            lambda row: {k: clean(row[k]) for k in fields})
+
+        clean.cache_clear()
+        start = time.perf_counter()
+        columns = [clean_values(row[k] for row in rows) for k in fields]
+        batch = [dict(zip(fields, values)) for values in zip(*columns)]
+        batch_time = time.perf_counter() - start
+
+        if not (baseline == uncached == cold == warm == batch):
+            raise CommandError('The implementations of clean returned '
+                               'different values')
+
+        self.stdout.write('Cleaned {} facilities ({} values)'.format(
+            len(rows), len(rows) * len(fields)))
+        results = [
+            ('Regular expressions (previous)', baseline_time),
+            ('Translation table, uncached', uncached_time),
+            ('Translation table, cold cache', cold_time),
+            ('Translation table, warm cache', warm_time),
+            ('clean_values, cold cache', batch_time),
+        ]
+        for label, seconds in results:
+            self.stdout.write('{:<32} {:>8.3f}s {:>6.1f}x'.format(
+                label, seconds, baseline_time / seconds))
+        self.stdout.write(self.style.SUCCESS('All implementations agree'))
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 
-from api.close_list import close_list
+from api.close_list import CLOSE_LIST_CHUNK_SIZE, close_list
+from api.models import FacilityIndexWorker
 
 
 class Command(BaseCommand):
@@ -17,8 +18,41 @@ class Command(BaseCommand):
                            required=True,
                            help='The id of the user to record as responsible' +
                            ' for the closures.')
+        parser.add_argument('-c', '--chunk-size',
+                            type=int,
+                            default=CLOSE_LIST_CHUNK_SIZE,
+                            help='The number of facilities closed in each ' +
+                            'transaction.')
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            help='Report the number of facilities that ' +
+                            'would be closed without closing them.')
 
     def handle(self, *args, **options):
         list_id = options['list_id']
         user_id = options['user_id']
-        close_list(list_id, user_id)
+        dry_run = options['dry_run']
+        chunk_size = options['chunk_size']
+
+        def write_progress(closed, total):
+            if total > chunk_size:
+                self.stdout.write(
+                    'Closed {} of {} facilities'.format(closed, total))
+
+        counts = close_list(list_id, user_id,
+                            chunk_size=chunk_size,
+                            dry_run=dry_run,
+                            progress=write_progress)
+        # Wait for deferred facility index updates so that the closed
+        # facilities are hidden when the command finishes
+        FacilityIndexWorker.flush()
+        self.stdout.write(
+            '{} facilities in list {}, {} already closed'.format(
+                counts['facilities'], list_id, counts['already_closed']))
+        if dry_run:
+            self.stdout.write(
+                'Dry run: {} facilities would be closed'.format(
+                    counts['facilities'] - counts['already_closed']))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                'Closed {} facilities'.format(counts['closed'])))
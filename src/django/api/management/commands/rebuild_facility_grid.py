@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from api.models import FacilityGridCell
+
+
+class Command(BaseCommand):
+    help = 'Recounts the facilities in each cell of the facility grid. The ' \
+           'counts are kept up to date as facilities are indexed, so this ' \
+           'is only needed if the grid has been changed outside of the ' \
+           'database triggers.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT rebuild_facility_grid_cells()')
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt {} facility grid cells'.format(
+                FacilityGridCell.objects.filter(count__gt=0).count())))
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.matching import refresh_training_sample
+
+
+class Command(BaseCommand):
+    help = ('Add the list items created since the previous refresh to the '
+            'sample of list items used to train the gazetteer.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--size-per-country',
+                            type=int,
+                            default=None,
+                            help='The maximum number of items sampled from '
+                                 'each country. Defaults to the '
+                                 'GAZETTEER_TRAINING_SAMPLE_SIZE_PER_COUNTRY '
+                                 'setting.')
+        parser.add_argument('-r', '--rebuild',
+                            action='store_true',
+                            help='Discard the existing sample and sample all '
+                                 'list items.')
+
+    def handle(self, *args, **options):
+        size_per_country = options['size_per_country'] or \
+            settings.GAZETTEER_TRAINING_SAMPLE_SIZE_PER_COUNTRY
+        added, removed = refresh_training_sample(
+            size_per_country=size_per_country, rebuild=options['rebuild'])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                'Added {} and removed {} training sample items'.format(
+                    added, removed)))
@@ -0,0 +1,246 @@
+import queue
+import sys
+import threading
+import time
+
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+
+from api.constants import ProcessingAction
+from api.management.commands.batch_process import (
+    Command as BatchProcessCommand,
+    LINE_ITEM_ACTIONS)
+from api.models import FacilityIndexWorker, FacilityList, FacilityListItem
+from api.matching import match_facility_list_item_ids
+from api.processing import bulk_save_match_details, save_exact_match_details
+from api.mail import notify_facility_list_complete
+
+# The number of line items passed from one stage to the next and saved in
+# each transaction when no chunk size is specified
+DEFAULT_PIPELINE_CHUNK_SIZE = 100
+
+PIPELINE_STAGES = [
+    ProcessingAction.PARSE,
+    ProcessingAction.GEOCODE,
+    ProcessingAction.MATCH,
+]
+
+# The statuses of the items that are waiting for each stage. The status of
+# each item is saved along with the results of every chunk, so it is the
+# checkpoint from which an interrupted pipeline is resumed.
+STAGE_PENDING_STATUSES = {
+    ProcessingAction.PARSE: [FacilityListItem.UPLOADED],
+    ProcessingAction.GEOCODE: [FacilityListItem.PARSED],
+    ProcessingAction.MATCH: [FacilityListItem.GEOCODED,
+                             FacilityListItem.GEOCODED_NO_RESULTS],
+}
+
+# Put on a stage queue after the last chunk for that stage
+END_OF_STAGE = None
+
+
+class Command(BatchProcessCommand):
+    help = 'Run all of the unprocessed items in a facility list through the ' \
+           'parse, geocode and match stages without AWS Batch. The stages ' \
+           'run at the same time and pass chunks of items to each other, ' \
+           'so early chunks are matched while later chunks are geocoded. ' \
+           'Each chunk is saved as it completes a stage, so a list that was ' \
+           'interrupted is resumed from the last saved chunk of each stage.'
+
+    def add_arguments(self, parser):
+        # Create a group of arguments explicitly labeled as required,
+        # because by default named arguments are considered optional.
+        group = parser.add_argument_group('required arguments')
+        group.add_argument('-l', '--list-id',
+                           required=True,
+                           help='The id of the facility list to process.')
+        parser.add_argument('-c', '--chunk-size',
+                            type=int,
+                            default=DEFAULT_PIPELINE_CHUNK_SIZE,
+                            help='The number of items passed from one stage '
+                                 'to the next and saved together.')
+        parser.add_argument('--skip-notify',
+                            action='store_true',
+                            help='Do not email the contributor when the list '
+                                 'has been processed.')
+
+    def handle(self, *args, **options):
+        list_id = options['list_id']
+        chunk_size = options['chunk_size']
+
+        # Crash if invalid list_id specified
+        try:
+            facility_list = FacilityList.objects.get(pk=list_id)
+        except FacilityList.DoesNotExist:
+            self.stderr.write('Validation Error: '
+                              'No facility list with id {}.'.format(list_id))
+            sys.exit(1)
+
+        self.results = {
+            action: {'success': 0, 'failure': 0, 'elapsed': 0}
+            for action in PIPELINE_STAGES
+        }
+        self.errors = []
+        self.stopped = threading.Event()
+
+        # The items waiting for each stage are listed before any stage
+        # starts so that each item resumed from a checkpoint is queued once
+        # and items are only passed on by the stage that processed them
+        pending = {
+            action: self.pending_chunks(facility_list, action, chunk_size)
+            for action in PIPELINE_STAGES
+        }
+        geocode_queue = queue.Queue()
+        match_queue = queue.Queue()
+        for chunk in pending[ProcessingAction.GEOCODE]:
+            geocode_queue.put(chunk)
+        for chunk in pending[ProcessingAction.MATCH]:
+            match_queue.put(chunk)
+
+        started = time.time()
+        threads = [
+            threading.Thread(
+                target=self.run_stage,
+                args=(ProcessingAction.PARSE,
+                      iter(pending[ProcessingAction.PARSE]),
+                      self.parse_chunk, geocode_queue)),
+            threading.Thread(
+                target=self.run_stage,
+                args=(ProcessingAction.GEOCODE,
+                      iter(geocode_queue.get, END_OF_STAGE),
+                      self.geocode_chunk, match_queue)),
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Matching a chunk can match items to facilities created by earlier
+        # chunks, so the chunks are matched one at a time on this thread
+        try:
+            for _ in self.run_stage_chunks(
+                    ProcessingAction.MATCH,
+                    iter(match_queue.get, END_OF_STAGE),
+                    lambda item_ids: self.match_chunk(facility_list,
+                                                      item_ids)):
+                pass
+        except Exception:
+            self.stopped.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if self.errors:
+            raise CommandError(
+                'The pipeline stopped after an error and can be resumed by '
+                'running it again: {}'.format('; '.join(self.errors)))
+
+        # Wait for deferred facility index updates so that the list's
+        # facilities are searchable when the pipeline finishes
+        FacilityIndexWorker.flush()
+
+        for action in PIPELINE_STAGES:
+            self.write_stage_result(action, self.results[action])
+        self.stdout.write('pipeline: finished in {:.2f}s'.format(
+            time.time() - started))
+
+        processed_count = sum(
+            r['success'] + r['failure'] for r in self.results.values())
+        if processed_count > 0 and not options['skip_notify']:
+            notify_facility_list_complete(list_id)
+
+    def pending_chunks(self, facility_list, action, chunk_size):
+        item_ids = list(
+            facility_list.source.facilitylistitem_set
+            .filter(status__in=STAGE_PENDING_STATUSES[action])
+            .order_by('id')
+            .values_list('id', flat=True))
+        return [item_ids[i:i + chunk_size]
+                for i in range(0, len(item_ids), chunk_size)]
+
+    def run_stage(self, action, chunks, process_chunk, next_queue):
+        try:
+            for item_ids in self.run_stage_chunks(action, chunks,
+                                                  process_chunk):
+                next_queue.put(item_ids)
+        except Exception as e:
+            self.stopped.set()
+            self.errors.append('{}: {}'.format(action, e))
+        finally:
+            next_queue.put(END_OF_STAGE)
+            # Each thread has its own connection, which would otherwise be
+            # left open when the thread finishes
+            connection.close()
+
+    def run_stage_chunks(self, action, chunks, process_chunk):
+        """
+        Process each chunk of items with `process_chunk` and add its result to
+        the totals for the stage.
+
+        Arguments:
+        action -- The ProcessingAction of the stage.
+        chunks -- An iterable of lists of FacilityListItem IDs.
+        process_chunk -- A function that processes a list of item IDs and
+                         returns a tuple of a result dict, with "success" and
+                         "failure" counts, and the IDs of the items that are
+                         ready for the next stage.
+
+        Returns:
+        A generator of the lists of item IDs that are ready for the next
+        stage.
+        """
+        for item_ids in chunks:
+            if self.stopped.is_set():
+                return
+            started = time.time()
+            chunk_result, next_item_ids = process_chunk(item_ids)
+            self.results[action]['elapsed'] += time.time() - started
+            self.add_chunk_result(self.results[action], chunk_result, action)
+            if next_item_ids:
+                yield next_item_ids
+
+    def parse_chunk(self, item_ids):
+        return self.process_pipeline_chunk(item_ids, ProcessingAction.PARSE,
+                                           ProcessingAction.GEOCODE)
+
+    def geocode_chunk(self, item_ids):
+        return self.process_pipeline_chunk(item_ids, ProcessingAction.GEOCODE,
+                                           ProcessingAction.MATCH)
+
+    def process_pipeline_chunk(self, item_ids, action, next_action):
+        chunk_result = self.process_chunk(
+            item_ids, action, LINE_ITEM_ACTIONS[action])
+        next_item_ids = list(
+            FacilityListItem.objects
+            .filter(id__in=item_ids,
+                    status__in=STAGE_PENDING_STATUSES[next_action])
+            .order_by('id')
+            .values_list('id', flat=True))
+        return chunk_result, next_item_ids
+
+    def match_chunk(self, facility_list, item_ids):
+        exact_result, result = match_facility_list_item_ids(facility_list,
+                                                            item_ids)
+        with transaction.atomic():
+            save_exact_match_details(exact_result)
+            bulk_save_match_details(result)
+        success_count = len(result['processed_list_item_ids']) + \
+            len(exact_result['processed_list_item_ids'])
+        chunk_result = {
+            'success': success_count,
+            'failure': len(item_ids) - success_count,
+        }
+        return chunk_result, None
+
+    def write_stage_result(self, action, result):
+        if result['success'] > 0:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    '{}: {} successes'.format(
+                        action, result['success'])))
+        if result['failure'] > 0:
+            self.stdout.write(
+                self.style.ERROR(
+                    '{}: {} failures'.format(
+                        action, result['failure'])))
+        self.stdout.write('{}: {:.2f}s processing chunks'.format(
+            action, result['elapsed']))
@@ -0,0 +1,152 @@
+import time
+
+import mercantile
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.contrib.gis.db.models import Extent
+from django.core import exceptions as core_exceptions
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.http import QueryDict
+
+from api.models import Facility
+from api.tiler import get_vector_tile, TILE_LAYERS
+from api.tile_cache import (get_tile_cache, make_tile_cache_key,
+                            TILE_CACHE_HIT)
+
+# The web mercator projection does not extend to the poles
+WORLD_BOUNDS = (-180.0, -85.0511, 180.0, 85.0511)
+
+
+class Command(BaseCommand):
+    help = 'Render vector tiles into the tile cache so that they do not ' \
+           'have to be rendered when they are first requested. Renders ' \
+           'every tile in a range of zoom levels for the whole world and ' \
+           'deeper zoom levels for the extent of the facilities in the ' \
+           'specified countries, without filters and with each of the ' \
+           'specified filters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-zoom', type=int, default=0,
+                            help='The lowest zoom level rendered for the '
+                                 'whole world.')
+        parser.add_argument('--max-zoom', type=int, default=8,
+                            help='The highest zoom level rendered for the '
+                                 'whole world.')
+        parser.add_argument('--country', action='append', default=[],
+                            dest='countries',
+                            help='A country code whose facilities are '
+                                 'rendered at deeper zoom levels. May be '
+                                 'repeated.')
+        parser.add_argument('--country-max-zoom', type=int, default=11,
+                            help='The highest zoom level rendered for the '
+                                 'countries.')
+        parser.add_argument('--layer', action='append', default=[],
+                            dest='layers', choices=TILE_LAYERS,
+                            help='A tile layer to render. May be repeated. '
+                                 'Renders all layers by default.')
+        parser.add_argument('--filter', action='append', default=[],
+                            dest='filters',
+                            help='A query string of tile filters, such as '
+                                 '"countries=US&contributors=1", that is '
+                                 'rendered in addition to the unfiltered '
+                                 'tiles. May be repeated.')
+        parser.add_argument('-w', '--workers', type=int, default=4,
+                            help='The number of tiles rendered at the same '
+                                 'time. Each worker uses its own database '
+                                 'connection.')
+
+    def handle(self, *args, **options):
+        tile_cache = get_tile_cache()
+        if tile_cache is None:
+            raise CommandError(
+                'TILE_CACHE_BACKEND must be set to seed the tile cache')
+
+        layers = options['layers'] or TILE_LAYERS
+        filters = [QueryDict(f) for f in [''] + options['filters']]
+        cachekey = Facility.current_tile_cache_key()
+        tiles = self.get_tiles(options)
+
+        self.stdout.write('Seeding tile cache key {} with {} tiles'.format(
+            cachekey, sum(len(t) for t in tiles.values())
+            * len(layers) * len(filters)))
+
+        rendered_count = 0
+        cached_count = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for z in sorted(tiles.keys()):
+                started = time.time()
+                futures = [
+                    executor.submit(self.seed_tile, tile_cache, cachekey,
+                                    params, layer, tile)
+                    for tile in tiles[z]
+                    for layer in layers
+                    for params in filters]
+                results = [future.result() for future in as_completed(futures)]
+                self.write_zoom_result(z, results, time.time() - started)
+                hits = [cache_status for _, cache_status in results
+                        if cache_status == TILE_CACHE_HIT]
+                cached_count += len(hits)
+                rendered_count += len(results) - len(hits)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Rendered {} tiles, {} were already cached'.format(
+                rendered_count, cached_count)))
+
+    def get_tiles(self, options):
+        """
+        Returns:
+        A dict of zoom levels to the set of `mercantile.Tile`s rendered at
+        that zoom level.
+        """
+        tiles = {}
+
+        def add_tiles(bounds, min_zoom, max_zoom):
+            for zoom in range(min_zoom, max_zoom + 1):
+                tiles.setdefault(zoom, set()).update(
+                    mercantile.tiles(*bounds, zooms=[zoom]))
+
+        add_tiles(WORLD_BOUNDS, options['min_zoom'], options['max_zoom'])
+        for country_code in options['countries']:
+            extent = Facility.objects \
+                .filter(country_code=country_code.upper()) \
+                .aggregate(extent=Extent('location'))['extent']
+            if extent is None:
+                self.stderr.write(
+                    'No facilities in {}'.format(country_code))
+                continue
+            add_tiles(extent, options['min_zoom'],
+                      options['country_max_zoom'])
+        return tiles
+
+    def seed_tile(self, tile_cache, cachekey, params, layer, tile):
+        key = make_tile_cache_key(layer, cachekey, tile.z, tile.x, tile.y,
+                                  params)
+
+        def render_tile():
+            try:
+                return get_vector_tile(params, layer, tile.z, tile.x, tile.y)
+            finally:
+                # The grid layer creates a temporary table that only exists
+                # until the connection is closed, so each tile is rendered
+                # on a new connection as it would be by a request
+                connection.close()
+
+        try:
+            tile_bytes, cache_status = tile_cache.get_or_render(
+                key, render_tile)
+        except core_exceptions.EmptyResultSet:
+            tile_bytes, cache_status = b'', None
+        return len(tile_bytes), cache_status
+
+    def write_zoom_result(self, z, results, elapsed):
+        sizes = [size for size, cache_status in results
+                 if cache_status != TILE_CACHE_HIT]
+        self.stdout.write(
+            'z{}: {} tiles, {} rendered in {:.2f}s, {} cached, '
+            'mean size {:.0f} bytes, max size {} bytes'.format(
+                z, len(results), len(sizes), elapsed,
+                len(results) - len(sizes),
+                sum(sizes) / len(sizes) if sizes else 0,
+                max(sizes) if sizes else 0))
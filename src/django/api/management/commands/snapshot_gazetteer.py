@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.matching import GazetteerCache
+
+
+class Command(BaseCommand):
+    help = ('Write the trained and indexed gazetteer, along with the facility '
+            'and match history versions it includes, to a snapshot file that '
+            'is loaded by new processes in place of retraining.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--path',
+                            help='The snapshot file to write. Defaults to '
+                                 'the GAZETTEER_SNAPSHOT_PATH setting.')
+        parser.add_argument('-r', '--rebuild',
+                            action='store_true',
+                            help='Rebuild the gazetteer rather than '
+                                 'updating the existing snapshot. The model '
+                                 'is retrained unless the file in the '
+                                 'GAZETTEER_MODEL_SETTINGS_PATH setting was '
+                                 'trained with the current training data.')
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.GAZETTEER_SNAPSHOT_PATH
+        if not path:
+            raise CommandError('A --path argument or GAZETTEER_SNAPSHOT_PATH '
+                               'setting is required.')
+
+        header = GazetteerCache.write_snapshot(
+            path, rebuild=options['rebuild'])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                'Wrote gazetteer snapshot to {} (facility version {}, match '
+                'version {})'.format(path, header['facility_version'],
+                                     header['match_version'])))
@@ -1,14 +1,25 @@
 import dedupe
+import hashlib
+import heapq
+import io
 import logging
+import multiprocessing
 import os
+import pickle
+import random
 import sys
+import tempfile
+import threading
+import time
 import traceback
 
 from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from django.conf import settings
 from django.contrib.postgres.search import TrigramSimilarity
-from django.db import transaction
+from django.db import connection, connections, transaction
 from django.db.models import Q, Max
 
 from api.models import (Facility,
@@ -16,8 +27,11 @@ from api.models import (Facility,
                         FacilityListItem,
                         FacilityMatch,
                         HistoricalFacility,
-                        HistoricalFacilityMatch)
-from api.helpers import clean
+                        HistoricalFacilityMatch,
+                        Source,
+                        TrainingSampleItem,
+                        Version)
+from api.helpers import clean, clean_values
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +75,26 @@ def normalize_extended_facility_id(facility_id):
         return facility_id.split('_')[0]
 
 
+def values_to_dedupe_records(values):
+    """
+    Convert dictionaries with id, country, name, and address keys into a
+    dictionary suitable for training and indexing a Dedupe model. Each field
+    is cleaned as a column so that repeated values are only cleaned once.
+
+    Arguments:
+    values -- An iterable of dictionaries created from a `values` query.
+
+    Returns:
+    A dictionary. The key is the string ID. The value is a dictionary of clean
+    field values keyed by field name (country, name, address).
+    """
+    values = list(values)
+    fields = ('country', 'name', 'address')
+    columns = [clean_values(v[field] for v in values) for field in fields]
+    return {str(v['id']): dict(zip(fields, clean_row))
+            for v, clean_row in zip(values, zip(*columns))}
+
+
 def get_canonical_items():
     """
     Fetch all `Facility` items and create a dictionary suitable for use by a
@@ -75,15 +109,19 @@ def get_canonical_items():
         select={'country': 'country_code'}).values(
             'id', 'country', 'name', 'address')
 
-    items = {str(i['id']):
-             {k: clean(i[k]) for k in i if k != 'id'}
-             for i in facility_set}
+    items = values_to_dedupe_records(facility_set)
 
-    confirmed_items = {match_to_extended_facility_id(m): {
-        'country': clean(m.facility_list_item.country_code),
-        'name': clean(m.facility_list_item.name),
-        'address': clean(m.facility_list_item.address),
-    } for m in FacilityMatch.objects.filter(status=FacilityMatch.CONFIRMED)}
+    confirmed_items = values_to_dedupe_records(
+        {
+            'id': match_detail_to_extended_facility_id(
+                m['facility_id'], m['id']),
+            'country': m['facility_list_item__country_code'],
+            'name': m['facility_list_item__name'],
+            'address': m['facility_list_item__address'],
+        } for m in FacilityMatch.objects.filter(
+            status=FacilityMatch.CONFIRMED).values(
+                'id', 'facility_id', 'facility_list_item__country_code',
+                'facility_list_item__name', 'facility_list_item__address'))
 
     items.update(confirmed_items)
 
@@ -102,45 +140,119 @@ def sort_exact_matches(exact_matches, active_item_ids, contributor):
     return sorted(exact_matches, key=sort_order, reverse=True)
 
 
-def exact_match_items(messy, contributor):
+# The maximum number of distinct (name, address, country) keys that are
+# joined against list items in a single exact match query
+EXACT_MATCH_CHUNK_SIZE = 1000
+
+
+def get_exact_match_candidates(match_keys):
+    """
+    Find the matched list items that have exactly the same clean name, clean
+    address, and country code as any of the specified keys.
+
+    Arguments:
+    match_keys -- A list of (clean_name, clean_address, country_code) tuples.
+                  The clean name and address values must not be empty.
+
+    Returns:
+    A dictionary where the keys are (clean_name, clean_address, country_code)
+    tuples and the values are lists of dictionaries with `id`, `facility_id`,
+    `source__contributor_id`, and `updated_at` keys describing the list items
+    that match the key.
+    """
+    candidates = defaultdict(list)
+    if len(match_keys) == 0:
+        return candidates
+
+    item_table = FacilityListItem._meta.db_table
+    source_table = Source._meta.db_table
+    values_sql = ', '.join(['(%s, %s, %s)'] * len(match_keys))
+    query = (
+        'SELECT i.id, i.facility_id, s.contributor_id, i.updated_at, '
+        '  k.clean_name, k.clean_address, k.country_code '
+        'FROM {item_table} i '
+        'JOIN {source_table} s ON s.id = i.source_id '
+        'JOIN (VALUES {values_sql}) '
+        '  AS k (clean_name, clean_address, country_code) '
+        '  ON i.clean_name = k.clean_name '
+        '  AND i.clean_address = k.clean_address '
+        '  AND i.country_code = k.country_code '
+        'WHERE i.status IN (%s, %s) '
+        '  AND i.facility_id IS NOT NULL '
+        "  AND i.clean_name <> '' "
+        "  AND i.clean_address <> ''"
+    ).format(item_table=item_table, source_table=source_table,
+             values_sql=values_sql)
+    params = [value for key in match_keys for value in key]
+    params += [FacilityListItem.MATCHED, FacilityListItem.CONFIRMED_MATCH]
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        for (item_id, facility_id, contributor_id, updated_at,
+             clean_name, clean_address, country_code) in cursor.fetchall():
+            candidates[(clean_name, clean_address, country_code)].append({
+                'id': item_id,
+                'facility_id': facility_id,
+                'source__contributor_id': contributor_id,
+                'updated_at': updated_at,
+            })
+
+    return candidates
+
+
+def get_active_item_ids(item_ids):
+    """
+    Return the subset of the specified `FacilityListItem` IDs that have an
+    active match from an active source.
+    """
+    return set(FacilityMatch.objects
+               .filter(status__in=[FacilityMatch.AUTOMATIC,
+                                   FacilityMatch.CONFIRMED,
+                                   FacilityMatch.MERGED],
+                       is_active=True,
+                       facility_list_item__source__is_active=True,
+                       facility_list_item_id__in=item_ids)
+               .values_list('facility_list_item', flat=True))
+
+
+def exact_match_items(messy, contributor,
+                      chunk_size=EXACT_MATCH_CHUNK_SIZE):
     started = str(datetime.utcnow())
 
-    matched_items = FacilityListItem.objects \
-        .filter(status__in=[FacilityListItem.MATCHED,
-                            FacilityListItem.CONFIRMED_MATCH]) \
-        .exclude(facility_id=None)
-    active_item_ids = FacilityMatch.objects \
-        .filter(status__in=[FacilityMatch.AUTOMATIC,
-                            FacilityMatch.CONFIRMED,
-                            FacilityMatch.MERGED],
-                is_active=True,
-                facility_list_item__source__is_active=True) \
-        .values_list('facility_list_item', flat=True)
+    # Clean every messy item once and group the items by their match key so
+    # that each distinct key is only looked up once
+    messy_ids_by_key = defaultdict(list)
+    for messy_id, item in messy.items():
+        clean_name = clean(item.get('name') or '')
+        clean_address = clean(item.get('address') or '')
+        country_code = (item.get('country') or '').upper()
+        if clean_name and clean_address:
+            key = (clean_name, clean_address, country_code)
+            messy_ids_by_key[key].append(messy_id)
 
     results = dict()
 
-    for messy_id, item in messy.items():
-        clean_name = clean(item.get('name', ''))
-        clean_address = clean(item.get('address', ''))
-        country_code = item.get('country', '').upper()
-        empty_text_fields = Q(Q(clean_name__isnull=True) |
-                              Q(clean_name__exact='') |
-                              Q(clean_address__isnull=True) |
-                              Q(clean_address__exact=''))
-        exact_matches = matched_items.filter(clean_name=clean_name,
-                                             clean_address=clean_address,
-                                             country_code=country_code) \
-            .exclude(empty_text_fields) \
-            .values('id', 'facility_id', 'source__contributor_id',
-                    'updated_at')
-
-        if len(exact_matches) > 0:
+    match_keys = list(messy_ids_by_key.keys())
+    for i in range(0, len(match_keys), chunk_size):
+        candidates = get_exact_match_candidates(match_keys[i:i + chunk_size])
+
+        multiple_match_item_ids = [
+            m['id'] for exact_matches in candidates.values()
+            if len(exact_matches) > 1 for m in exact_matches]
+        active_item_ids = get_active_item_ids(multiple_match_item_ids) \
+            if len(multiple_match_item_ids) > 0 else set()
+
+        for key, exact_matches in candidates.items():
             if len(exact_matches) > 1:
                 exact_matches = sort_exact_matches(exact_matches,
                                                    active_item_ids,
                                                    contributor)
+            for messy_id in messy_ids_by_key[key]:
+                results[messy_id] = exact_matches
 
-            results[messy_id] = exact_matches
+    # Preserve the order of the messy items in the results
+    results = {messy_id: results[messy_id] for messy_id in messy.keys()
+               if messy_id in results}
 
     finished = str(datetime.utcnow())
 
@@ -171,6 +283,14 @@ def exact_match_item(country, name, address, contributor, id='id'):
         contributor)
 
 
+def get_messy_item_values(facility_list):
+    return facility_list.source.facilitylistitem_set.filter(
+        Q(status=FacilityListItem.GEOCODED)
+        | Q(status=FacilityListItem.GEOCODED_NO_RESULTS)).extra(
+            select={'country': 'country_code'}).values(
+                'id', 'country', 'name', 'address')
+
+
 def get_messy_items_from_facility_list(facility_list):
     """
     Fetch all `FacilityListItem` objects that belong to the specified
@@ -185,24 +305,162 @@ def get_messy_items_from_facility_list(facility_list):
     address). A "clean" value is one which has been passed through the `clean`
     function.
     """
-    facility_list_item_set = facility_list.source.facilitylistitem_set.filter(
-        Q(status=FacilityListItem.GEOCODED)
-        | Q(status=FacilityListItem.GEOCODED_NO_RESULTS)).extra(
-            select={'country': 'country_code'}).values(
-                'id', 'country', 'name', 'address')
-    return {str(i['id']): {k: clean(i[k]) for k in i if k != 'id'}
-            for i in facility_list_item_set}
+    return values_to_dedupe_records(get_messy_item_values(facility_list))
 
 
-def get_messy_items_for_training(mod_factor=5):
+def get_messy_item_chunks_from_facility_list(facility_list, chunk_size):
     """
-    Fetch a subset of `FacilityListItem` objects that have been parsed and are
-    not in an error state.
+    Fetch the `FacilityListItem` objects that belong to the specified
+    `FacilityList` and are ready to be matched in chunks ordered by ID.
+
+    Each chunk is fetched with a separate query starting after the last ID of
+    the previous chunk, so items that are matched and saved between chunks
+    are not fetched again and the list is never held in memory at once.
 
     Arguments:
-    mod_factor -- Used to partition a subset of `FacilityListItem` records. The
-                  larger the value, the fewer records will be contained in the
-                  subset.
+    facility_list -- A `FacilityList`.
+    chunk_size -- The maximum number of items in each chunk.
+
+    Returns:
+    A generator of dictionaries in the format returned by
+    `get_messy_items_from_facility_list`.
+    """
+    last_id = 0
+    while True:
+        chunk = list(get_messy_item_values(facility_list)
+                     .filter(id__gt=last_id)
+                     .order_by('id')[:chunk_size])
+        if len(chunk) == 0:
+            return
+        last_id = chunk[-1]['id']
+        yield values_to_dedupe_records(chunk)
+
+
+# The statuses of list items that are not included in the training sample
+TRAINING_SAMPLE_EXCLUDED_STATUSES = (
+    FacilityListItem.UPLOADED,
+    FacilityListItem.ERROR,
+    FacilityListItem.ERROR_PARSING,
+    FacilityListItem.ERROR_GEOCODING,
+    FacilityListItem.ERROR_MATCHING,
+)
+
+# The name of the `Version` row that stores the ID of the last list item that
+# was considered for the training sample
+TRAINING_SAMPLE_VERSION_NAME = 'training_sample_item_id'
+
+
+def training_sample_sort_key(item_id):
+    """
+    Return a pseudo-random, but stable, value between 0 and 2^28 for a list
+    item ID. Keeping the items with the lowest values in each country gives a
+    uniform random sample of each country that can be updated incrementally.
+    """
+    digest = hashlib.md5(str(item_id).encode('utf-8')).hexdigest()
+    return int(digest[:7], 16)
+
+
+def refresh_training_sample(size_per_country=None, rebuild=False,
+                            chunk_size=10000):
+    """
+    Update the `TrainingSampleItem` table with the list items that have been
+    created since the previous refresh.
+
+    The sample contains up to `size_per_country` items from each country. Only
+    the sample and the new list items are read, so the cost of a refresh
+    depends on the number of items added since the previous one.
+
+    Arguments:
+    size_per_country -- The maximum number of items sampled from each country.
+                        Defaults to the
+                        GAZETTEER_TRAINING_SAMPLE_SIZE_PER_COUNTRY setting.
+    rebuild -- If True, discard the existing sample and consider every list
+               item. Required to grow the sample after increasing
+               `size_per_country`.
+    chunk_size -- The number of new list items read with each query.
+
+    Returns:
+    A tuple of the number of items added to and removed from the sample.
+    """
+    if size_per_country is None:
+        size_per_country = settings.GAZETTEER_TRAINING_SAMPLE_SIZE_PER_COUNTRY
+
+    with transaction.atomic():
+        # Locking the version row prevents concurrent refreshes from
+        # considering the same items
+        watermark, _ = Version.objects.select_for_update().get_or_create(
+            name=TRAINING_SAMPLE_VERSION_NAME, defaults={'version': 0})
+        if rebuild:
+            TrainingSampleItem.objects.all().delete()
+            watermark.version = 0
+
+        # Each heap holds (-sort_key, item_id) tuples so that the item with
+        # the highest sort key, which is the first to be evicted, is at the
+        # top
+        heaps = defaultdict(list)
+        for item in TrainingSampleItem.objects.values_list(
+                'facility_list_item_id', 'country', 'sort_key'):
+            item_id, country, sort_key = item
+            heaps[country].append((-sort_key, item_id))
+        for heap in heaps.values():
+            heapq.heapify(heap)
+        sampled_ids = {item_id for heap in heaps.values()
+                       for _, item_id in heap}
+
+        new_items = {}
+        last_id = watermark.version
+        while True:
+            items = list(
+                FacilityListItem.objects
+                .filter(id__gt=last_id)
+                .exclude(status__in=TRAINING_SAMPLE_EXCLUDED_STATUSES)
+                .order_by('id')
+                .values('id', 'country_code', 'name', 'address')
+                [:chunk_size])
+            if len(items) == 0:
+                break
+            last_id = items[-1]['id']
+            for item in items:
+                country = clean(item['country_code'])
+                sort_key = training_sample_sort_key(item['id'])
+                heap = heaps[country]
+                if len(heap) < size_per_country:
+                    heapq.heappush(heap, (-sort_key, item['id']))
+                elif -heap[0][0] > sort_key:
+                    heapq.heapreplace(heap, (-sort_key, item['id']))
+                else:
+                    continue
+                new_items[item['id']] = TrainingSampleItem(
+                    facility_list_item_id=item['id'],
+                    country=country,
+                    name=clean(item['name']),
+                    address=clean(item['address']),
+                    sort_key=sort_key)
+
+        # Shrink the sample if the size has been reduced
+        for country, heap in heaps.items():
+            while len(heap) > size_per_country:
+                heapq.heappop(heap)
+
+        kept_ids = {item_id for heap in heaps.values() for _, item_id in heap}
+        removed_ids = sampled_ids - kept_ids
+        if len(removed_ids) > 0:
+            TrainingSampleItem.objects.filter(
+                facility_list_item_id__in=removed_ids).delete()
+        added = [item for item_id, item in new_items.items()
+                 if item_id in kept_ids]
+        TrainingSampleItem.objects.bulk_create(added, batch_size=1000)
+
+        watermark.version = max(last_id, watermark.version)
+        watermark.save()
+
+    return len(added), len(removed_ids)
+
+
+def get_messy_items_for_training():
+    """
+    Fetch the sample of `FacilityListItem` objects that have been parsed and
+    are not in an error state, refreshing it first with any new items.
 
     Returns:
     A dictionary. The key is the `FacilityListItem` ID. The value is a
@@ -210,19 +468,343 @@ def get_messy_items_for_training(mod_factor=5):
     address). A "clean" value is one which has been passed through the `clean`
     function.
     """
-    facility_list_item_set = FacilityListItem.objects.exclude(
-        Q(status=FacilityListItem.UPLOADED)
-        | Q(status=FacilityListItem.ERROR)
-        | Q(status=FacilityListItem.ERROR_PARSING)
-        | Q(status=FacilityListItem.ERROR_GEOCODING)
-        | Q(status=FacilityListItem.ERROR_MATCHING)
-    ).extra(
-            select={'country': 'country_code'}).values(
-                'id', 'country', 'name', 'address')
-    records = [record for (i, record) in enumerate(facility_list_item_set)
-               if i % mod_factor == 0]
-    return {str(i['id']): {k: clean(i[k]) for k in i if k != 'id'}
-            for i in records}
+    refresh_training_sample()
+    # Items that have moved into an error state since they were sampled are
+    # excluded here rather than removed from the sample
+    sample = TrainingSampleItem.objects.exclude(
+        facility_list_item__status__in=TRAINING_SAMPLE_EXCLUDED_STATUSES
+    ).values_list('facility_list_item_id', 'country', 'name', 'address')
+    return {str(item_id): {'country': country, 'name': name,
+                           'address': address}
+            for item_id, country, name, address in sample}
+
+
+# The number of processes used by `ShardedGazetteer.match` in the current
+# thread, which is only set above 1 by `gazetteer_match_pool`
+_match_pool = threading.local()
+
+
+@contextmanager
+def gazetteer_match_pool(processes):
+    """
+    Allow `ShardedGazetteer.match` to match shards in a pool of up to
+    `processes` forked processes within the block.
+
+    Only use this in a management command. Forking a process that runs other
+    threads, such as a web server or the background gazetteer refresh, can
+    deadlock the forked processes on locks held by those threads, and each
+    forked process holds a copy of the gazetteer.
+    """
+    _match_pool.processes = processes
+    try:
+        yield
+    finally:
+        _match_pool.processes = 1
+
+
+# Set on the parent process immediately before forking a pool of processes to
+# match the shards of a `ShardedGazetteer` so that the forked processes can
+# use the indexed shards without having to pickle them
+_shards_for_pool = None
+
+
+def _match_shard_in_pool(shard_key, messy_data, threshold, n_matches,
+                         num_cores):
+    shard = _shards_for_pool[shard_key]
+    shard.num_cores = num_cores
+    return ShardedGazetteer.match_shard(shard, messy_data, threshold,
+                                        n_matches)
+
+
+class ShardedGazetteer:
+    """
+    A set of gazetteers sharing a single trained model, each of which indexes
+    only the canonical records for one country.
+
+    Every record is routed to a shard using its clean `country` value. Because
+    the first gazetteer field is an `Exact` comparison on the country, records
+    in different countries are not expected to match and partitioning the
+    index only removes candidates that would be discarded. It also means that
+    an update to a facility only touches the index of its country and that the
+    countries in a large list can be matched in parallel. If `by_country` is
+    False all records are held in a single shard.
+
+    The block keys under which each canonical record is stored are tracked so
+    that records can be reliably removed from the index with `remove`. The
+    `index`, `threshold`, `match`, and `writeSettings` methods can be used in
+    place of the same methods on a dedupe.Gazetteer.
+    """
+    # Lists with fewer messy records than this are matched in the current
+    # process because the cost of starting a pool outweighs the benefit
+    MIN_RECORDS_FOR_POOL = 500
+
+    def __init__(self, model_settings, shards=None, by_country=True):
+        self.model_settings = model_settings
+        self.shards = shards if shards is not None else {}
+        self.by_country = by_country
+        # Maps each indexed record ID to a tuple of its shard key, the set of
+        # block keys under which it is stored, and the record itself
+        self._records = {}
+        # The number of records removed or replaced since the shards were
+        # built. The predicate indices still contain the values of these
+        # records until the gazetteer is compacted.
+        self.stale_count = 0
+        # The keys of shards that are shared with the gazetteer from which
+        # this one was copied and must be copied before they are changed
+        self._shared_shard_keys = set()
+        for shard_key, shard in self.shards.items():
+            self._track_blocked_records(shard_key, shard)
+
+    @classmethod
+    def from_gazetteer(cls, gazetteer, by_country=True):
+        """
+        Create an empty ShardedGazetteer that uses the model trained by the
+        specified dedupe.Gazetteer.
+        """
+        f = io.BytesIO()
+        gazetteer.writeSettings(f)
+        return cls(f.getvalue(), by_country=by_country)
+
+    @classmethod
+    def readSettings(cls, file_obj):
+        """
+        Create a ShardedGazetteer from a file object written by
+        `writeSettings`.
+        """
+        model_settings = pickle.load(file_obj)
+        by_country = pickle.load(file_obj)
+        shard_keys = pickle.load(file_obj)
+        shards = {shard_key: dedupe.StaticGazetteer(file_obj)
+                  for shard_key in shard_keys}
+        return cls(model_settings, shards=shards, by_country=by_country)
+
+    def writeSettings(self, file_obj, index=False):
+        """
+        Write the trained model and, if `index` is True, the index of every
+        shard to a file object.
+        """
+        shard_keys = list(self.shards.keys())
+        pickle.dump(self.model_settings, file_obj)
+        pickle.dump(self.by_country, file_obj)
+        pickle.dump(shard_keys if index else [], file_obj)
+        if index:
+            for shard_key in shard_keys:
+                self.shards[shard_key].writeSettings(file_obj, index=True)
+
+    def _new_shard(self):
+        return dedupe.StaticGazetteer(io.BytesIO(self.model_settings))
+
+    def _writable_shard(self, shard_key):
+        if shard_key in self._shared_shard_keys:
+            f = io.BytesIO()
+            self.shards[shard_key].writeSettings(f, index=True)
+            f.seek(0)
+            self.shards[shard_key] = dedupe.StaticGazetteer(f)
+            self._shared_shard_keys.discard(shard_key)
+        elif shard_key not in self.shards:
+            self.shards[shard_key] = self._new_shard()
+        return self.shards[shard_key]
+
+    def copy(self):
+        """
+        Return a copy of this gazetteer that can be updated while this one is
+        being used for matching. The shards are shared until they are changed,
+        so only the shards that are updated are copied.
+        """
+        other = ShardedGazetteer(self.model_settings,
+                                 by_country=self.by_country)
+        other.shards = dict(self.shards)
+        other._shared_shard_keys = set(self.shards.keys())
+        # The tuples are not shared by updates because `index` and `remove`
+        # replace records rather than changing them
+        other._records = dict(self._records)
+        other.stale_count = self.stale_count
+        return other
+
+    def _shard_key(self, record):
+        return record.get('country') if self.by_country else None
+
+    def _group_by_shard(self, data):
+        groups = defaultdict(dict)
+        for record_id, record in data.items():
+            groups[self._shard_key(record)][record_id] = record
+        return groups
+
+    def _track_blocked_records(self, shard_key, shard):
+        for block_key, block in shard.blocked_records.items():
+            for record_id, record in block.items():
+                _, block_keys, _ = self._records.setdefault(
+                    record_id, (shard_key, set(), record))
+                block_keys.add(block_key)
+
+    def index(self, data):
+        """
+        Add records to the index of their shard, replacing any previously
+        indexed record with the same ID.
+        """
+        self.remove([record_id for record_id in data
+                     if record_id in self._records])
+        for shard_key, records in self._group_by_shard(data).items():
+            shard = self._writable_shard(shard_key)
+            for record_id, record in records.items():
+                self._records[record_id] = (shard_key, set(), record)
+            # This is equivalent to dedupe.Gazetteer.index, but also records
+            # the block keys so that the records can be removed later
+            shard.blocker.indexAll(records)
+            for block_key, record_id in shard.blocker(records.items(),
+                                                      target=True):
+                shard.blocked_records.setdefault(block_key, {})[record_id] = \
+                    records[record_id]
+                self._records[record_id][1].add(block_key)
+
+    def remove(self, record_ids):
+        """
+        Remove records from the index so that they are no longer returned as
+        candidates. Unknown IDs are ignored.
+
+        dedupe.Gazetteer.unindex computes the block keys of the removed records
+        differently than `index` did, which left records in place and raised
+        exceptions, so we remove each record from the blocks under which it
+        was stored instead.
+        """
+        for record_id in record_ids:
+            if record_id not in self._records:
+                continue
+            shard_key, block_keys, _ = self._records.pop(record_id)
+            blocked_records = self._writable_shard(shard_key).blocked_records
+            for block_key in block_keys:
+                block = blocked_records.get(block_key)
+                if block is not None:
+                    block.pop(record_id, None)
+                    if len(block) == 0:
+                        del blocked_records[block_key]
+            self.stale_count += 1
+
+    def record_ids(self):
+        return self._records.keys()
+
+    def index_size(self):
+        return len(self._records)
+
+    def live_records(self):
+        """
+        Return a dictionary of the records currently in the index keyed by
+        record ID.
+        """
+        return {record_id: record
+                for record_id, (_, _, record) in self._records.items()}
+
+    def compacted(self, records=None):
+        """
+        Return a new ShardedGazetteer with freshly built shards containing
+        only the specified records, which default to the records currently in
+        the index. Records that have been removed no longer contribute to the
+        predicate indices of the new shards and empty shards are dropped.
+        """
+        if records is None:
+            records = self.live_records()
+        compacted = ShardedGazetteer(self.model_settings,
+                                     by_country=self.by_country)
+        compacted.index(records)
+        return compacted
+
+    def threshold(self, messy_data, recall_weight=1.5):
+        thresholds = []
+        for shard_key, records in self._group_by_shard(messy_data).items():
+            if shard_key in self.shards:
+                try:
+                    thresholds.append(self.shards[shard_key].threshold(
+                        records, recall_weight=recall_weight))
+                except dedupe.core.BlockingError:
+                    pass
+        if len(thresholds) == 0:
+            raise dedupe.core.BlockingError(
+                'No records have been blocked together in any shard')
+        return min(thresholds)
+
+    @staticmethod
+    def match_shard(shard, messy_data, threshold, n_matches):
+        try:
+            return list(shard.match(messy_data, threshold=threshold,
+                                    n_matches=n_matches, generator=True))
+        except ValueError:
+            # dedupe raises a ValueError when none of the messy records were
+            # blocked with a canonical record in this shard
+            return []
+
+    def _use_pool(self, work, processes):
+        return (processes > 1
+                and len(work) > 1
+                and sum(len(r) for _, r in work) >= self.MIN_RECORDS_FOR_POOL
+                and not connection.in_atomic_block)
+
+    def _match_in_pool(self, work, threshold, n_matches, processes):
+        global _shards_for_pool
+        processes = min(processes, len(work))
+        # dedupe scores each shard with its own pool of `num_cores`
+        # processes and does not support scoring with fewer than 2, so we
+        # split the available cores between the shard processes
+        num_cores = max(2, (multiprocessing.cpu_count() or 1) // processes)
+        # Forked processes must not share the database connections of the
+        # parent process. Django reconnects when the connection is next used.
+        connections.close_all()
+        _shards_for_pool = self.shards
+        try:
+            executor = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('fork'))
+            with executor:
+                futures = [
+                    executor.submit(_match_shard_in_pool, shard_key, records,
+                                    threshold, n_matches, num_cores)
+                    for shard_key, records in work]
+                return [future.result() for future in futures]
+        finally:
+            _shards_for_pool = None
+
+    def match(self, messy_data, threshold=0.5, n_matches=1, generator=False):
+        # Match the largest groups first so that they do not end up running
+        # alone at the end of the pool
+        work = sorted(
+            [(shard_key, records) for shard_key, records
+             in self._group_by_shard(messy_data).items()
+             if shard_key in self.shards],
+            key=lambda w: len(w[1]), reverse=True)
+
+        processes = getattr(_match_pool, 'processes', 1)
+
+        if self._use_pool(work, processes):
+            results = self._match_in_pool(
+                work, threshold, n_matches, processes)
+            clusters = (cluster for shard_clusters in results
+                        for cluster in shard_clusters)
+        else:
+            clusters = (cluster for shard_key, records in work
+                        for cluster in self.match_shard(
+                            self.shards[shard_key], records, threshold,
+                            n_matches))
+
+        if generator:
+            return clusters
+        else:
+            return list(clusters)
+
+
+TRAINING_FILE = os.path.join(settings.BASE_DIR, 'api', 'data',
+                             'training.json')
+
+# The maximum number of canonical items from which training pairs are drawn.
+# dedupe uses at most this many records to learn blocking predicates.
+CANONICAL_TRAINING_SAMPLE_SIZE = 50000
+
+
+def training_data_hash():
+    """
+    Return a hash of the labeled training pairs, which identifies the model
+    trained from them.
+    """
+    with open(TRAINING_FILE, 'rb') as tf:
+        return hashlib.sha256(tf.read()).hexdigest()
 
 
 def train_gazetteer(messy, canonical, model_settings=None, should_index=False):
@@ -246,10 +828,14 @@ def train_gazetteer(messy, canonical, model_settings=None, should_index=False):
         ]
 
         gazetteer = dedupe.Gazetteer(fields)
-        gazetteer.sample(messy, canonical, 15000)
-        training_file = os.path.join(settings.BASE_DIR, 'api', 'data',
-                                     'training.json')
-        with open(training_file) as tf:
+        sample_canonical = canonical
+        if len(canonical) > CANONICAL_TRAINING_SAMPLE_SIZE:
+            sample_canonical = {
+                k: canonical[k] for k in random.sample(
+                    list(canonical.keys()), CANONICAL_TRAINING_SAMPLE_SIZE)}
+        gazetteer.sample(messy, sample_canonical, 15000,
+                         original_length_2=len(canonical))
+        with open(TRAINING_FILE) as tf:
             gazetteer.readTraining(tf)
         gazetteer.train()
         gazetteer.cleanupTraining()
@@ -265,6 +851,53 @@ def train_gazetteer(messy, canonical, model_settings=None, should_index=False):
     return gazetteer
 
 
+# The maximum number of (messy, canonical) candidate pairs that are checked for
+# facility existence with a single query
+MATCH_EXISTS_CHUNK_SIZE = 2000
+
+
+def chunk_match_results(results, chunk_size=MATCH_EXISTS_CHUNK_SIZE):
+    """
+    Flatten the clusters returned by `Gazetteer.match` into lists of
+    (messy_id, canonical_id, score) tuples containing at most `chunk_size`
+    items.
+    """
+    chunk = []
+    for matches in results:
+        for (messy_id, canon_id), score in matches:
+            chunk.append((messy_id, canon_id, score))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def filter_existing_facility_matches(matches):
+    """
+    Remove matches to facilities that no longer exist.
+
+    Arguments:
+    matches -- A list of (messy_id, canonical_id, score) tuples. The canonical
+               IDs may be extended facility IDs.
+
+    Returns:
+    A list of the (messy_id, canonical_id, score) tuples for which the
+    facility exists, in their original order.
+    """
+    facility_ids = {normalize_extended_facility_id(canon_id)
+                    for _, canon_id, _ in matches}
+    existing_facility_ids = set(
+        Facility.objects
+        .filter(id__in=facility_ids)
+        .values_list('id', flat=True)) if len(facility_ids) > 0 else set()
+
+    return [(messy_id, canon_id, score)
+            for messy_id, canon_id, score in matches
+            if normalize_extended_facility_id(canon_id)
+            in existing_facility_ids]
+
+
 class MatchDefaults:
     AUTOMATIC_THRESHOLD = 0.8
     GAZETTEER_THRESHOLD = 0.5
@@ -333,7 +966,7 @@ def match_items(messy,
     if len(messy.keys()) > 0:
         no_geocoded_items = False
         try:
-            gazetteer = GazetteerCache.get_latest()
+            gazetteer = GazetteerCache.current()
             gazetteer.threshold(messy, recall_weight=recall_weight)
             results = gazetteer.match(messy, threshold=gazetteer_threshold,
                                       n_matches=None, generator=True)
@@ -352,18 +985,13 @@ def match_items(messy,
     finished = str(datetime.utcnow())
 
     item_matches = defaultdict(list)
-    for matches in results:
-        for (messy_id, canon_id), score in matches:
-            # The gazetteer matcher obtained from the GazetteerCache may have
-            # encountered an exception raised by Dedupe while unindexing
-            # records and could therefore return matches for facility IDs that
-            # no longer exist due to merging or deleting.
-            facility_exists = Facility \
-                .objects \
-                .filter(pk=normalize_extended_facility_id(canon_id)) \
-                .exists()
-            if facility_exists:
-                item_matches[messy_id].append((canon_id, score))
+    # Facilities that were merged or deleted after the gazetteer obtained from
+    # the GazetteerCache was last updated are still in its index, so we filter
+    # out matches for facility IDs that no longer exist.
+    for chunk in chunk_match_results(results):
+        for messy_id, canon_id, score in filter_existing_facility_matches(
+                chunk):
+            item_matches[messy_id].append((canon_id, score))
 
     return {
         'processed_list_item_ids': list(messy.keys()),
@@ -417,6 +1045,102 @@ def match_facility_list_items(
                        recall_weight=recall_weight)
 
 
+# The default number of list items that are matched and saved together when
+# streaming the matching of a list
+MATCH_STREAM_CHUNK_SIZE = 1000
+
+
+def stream_match_facility_list_items(
+        facility_list,
+        chunk_size=MATCH_STREAM_CHUNK_SIZE,
+        automatic_threshold=MatchDefaults.AUTOMATIC_THRESHOLD,
+        gazetteer_threshold=MatchDefaults.GAZETTEER_THRESHOLD,
+        recall_weight=MatchDefaults.RECALL_WEIGHT):
+    """
+    Match the items in the specified `FacilityList` that have not yet been
+    matched in chunks, first to exact matches and then to the current list of
+    facilities.
+
+    The next chunk is fetched after the results for the previous chunk have
+    been consumed, so saving the results of each chunk before continuing
+    keeps memory use proportional to `chunk_size` and allows matching to
+    resume from the last saved chunk if it is interrupted. Facilities created
+    when the results of a chunk are saved are candidates for matching the
+    items in later chunks.
+
+    Arguments:
+    facility_list -- A FacilityList instance
+    chunk_size -- The maximum number of items matched together
+    automatic_threshold -- See `match_facility_list_items`.
+    gazetteer_threshold -- See `match_facility_list_items`.
+    recall_weight -- See `match_facility_list_items`.
+
+    Returns:
+    A generator of (exact_result, result) tuples, where `exact_result` is the
+    return value of `exact_match_items` and `result` is the return value of
+    `match_items` for the items in the chunk without an exact match.
+    """
+    if type(facility_list) != FacilityList:
+        raise ValueError('Argument must be a FacilityList')
+
+    contributor = facility_list.source.contributor
+    for messy in get_messy_item_chunks_from_facility_list(facility_list,
+                                                          chunk_size):
+        yield match_item_chunk(messy, contributor,
+                               automatic_threshold=automatic_threshold,
+                               gazetteer_threshold=gazetteer_threshold,
+                               recall_weight=recall_weight)
+
+
+def match_facility_list_item_ids(
+        facility_list,
+        item_ids,
+        automatic_threshold=MatchDefaults.AUTOMATIC_THRESHOLD,
+        gazetteer_threshold=MatchDefaults.GAZETTEER_THRESHOLD,
+        recall_weight=MatchDefaults.RECALL_WEIGHT):
+    """
+    Match the items in the specified `FacilityList` with the specified IDs,
+    first to exact matches and then to the current list of facilities. Items
+    that are not ready to be matched are ignored, so matching a chunk of items
+    that has already been matched and saved does nothing.
+
+    Arguments:
+    facility_list -- A FacilityList instance
+    item_ids -- A list of FacilityListItem IDs
+    automatic_threshold -- See `match_facility_list_items`.
+    gazetteer_threshold -- See `match_facility_list_items`.
+    recall_weight -- See `match_facility_list_items`.
+
+    Returns:
+    An (exact_result, result) tuple in the format yielded by
+    `stream_match_facility_list_items`.
+    """
+    if type(facility_list) != FacilityList:
+        raise ValueError('Argument must be a FacilityList')
+
+    messy = values_to_dedupe_records(
+        get_messy_item_values(facility_list).filter(id__in=item_ids))
+    return match_item_chunk(messy, facility_list.source.contributor,
+                            automatic_threshold=automatic_threshold,
+                            gazetteer_threshold=gazetteer_threshold,
+                            recall_weight=recall_weight)
+
+
+def match_item_chunk(messy,
+                     contributor,
+                     automatic_threshold=MatchDefaults.AUTOMATIC_THRESHOLD,
+                     gazetteer_threshold=MatchDefaults.GAZETTEER_THRESHOLD,
+                     recall_weight=MatchDefaults.RECALL_WEIGHT):
+    exact_result = exact_match_items(messy, contributor)
+    exact_ids = set(exact_result['processed_list_item_ids'])
+    result = match_items(
+        {k: v for k, v in messy.items() if k not in exact_ids},
+        automatic_threshold=automatic_threshold,
+        gazetteer_threshold=gazetteer_threshold,
+        recall_weight=recall_weight)
+    return exact_result, result
+
+
 def match_item(country,
                name,
                address,
@@ -508,6 +1232,152 @@ class GazetteerCacheTimeoutError(Exception):
     pass
 
 
+class GazetteerSnapshotError(Exception):
+    pass
+
+
+# Increment this value whenever the structure of the snapshot file changes so
+# that processes running new code do not attempt to load an old snapshot.
+GAZETTEER_SNAPSHOT_VERSION = 2
+
+
+def write_gazetteer_snapshot(gazetteer, facility_version, match_version,
+                             path):
+    """
+    Write a trained and indexed gazetteer to a file so that it can be loaded by
+    other processes without retraining or reindexing.
+
+    The snapshot is written to a temporary file that is moved into place once
+    it is complete so that readers never see a partially written snapshot.
+
+    Arguments:
+    gazetteer -- A trained and indexed `ShardedGazetteer`.
+    facility_version -- The last `HistoricalFacility` history_id that has been
+                        applied to the gazetteer index.
+    match_version -- The last `HistoricalFacilityMatch` history_id that has
+                     been applied to the gazetteer index.
+    path -- The file path to which the snapshot will be written.
+    """
+    header = {
+        'snapshot_version': GAZETTEER_SNAPSHOT_VERSION,
+        'facility_version': facility_version,
+        'match_version': match_version,
+        'code_version': settings.GIT_COMMIT,
+        'training_hash': training_data_hash(),
+        'created_at': str(datetime.utcnow()),
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(header, f)
+            # Passing `index=True` includes the predicate indices and the
+            # blocked canonical records in the settings
+            gazetteer.writeSettings(f, index=True)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return header
+
+
+def read_gazetteer_snapshot_header(path):
+    """
+    Read the header of a file written by `write_gazetteer_snapshot` without
+    loading the gazetteer.
+
+    Returns:
+    The snapshot header dictionary.
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def is_current_gazetteer_snapshot(header):
+    """
+    Check that a snapshot was written by the running code from the current
+    training data, which determine the trained model.
+
+    Arguments:
+    header -- A snapshot header dictionary.
+    """
+    return isinstance(header, dict) \
+        and header.get('code_version') == settings.GIT_COMMIT \
+        and header.get('training_hash') == training_data_hash()
+
+
+def read_gazetteer_snapshot(path):
+    """
+    Load a gazetteer from a file written by `write_gazetteer_snapshot`.
+
+    Arguments:
+    path -- The file path from which the snapshot will be read.
+
+    Returns:
+    A tuple of the snapshot header dictionary, which includes the
+    `facility_version` and `match_version` watermarks, and a
+    `ShardedGazetteer`.
+    """
+    with open(path, 'rb') as f:
+        header = pickle.load(f)
+        if not isinstance(header, dict) or \
+           header.get('snapshot_version') != GAZETTEER_SNAPSHOT_VERSION:
+            raise GazetteerSnapshotError(
+                'Unsupported gazetteer snapshot version in {}'.format(path))
+        gazetteer = ShardedGazetteer.readSettings(f)
+    return header, gazetteer
+
+
+def write_gazetteer_model_settings(model_settings, path):
+    """
+    Write the settings of a trained gazetteer model, which include the learned
+    blocking predicates and classifier, to a file so that the model can be
+    reused until the training data changes.
+
+    Arguments:
+    model_settings -- The bytes written by dedupe.Gazetteer.writeSettings.
+    path -- The file path to which the settings will be written.
+    """
+    header = {
+        'snapshot_version': GAZETTEER_SNAPSHOT_VERSION,
+        'training_hash': training_data_hash(),
+        'created_at': str(datetime.utcnow()),
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(header, f)
+            pickle.dump(model_settings, f)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return header
+
+
+def read_gazetteer_model_settings(path):
+    """
+    Load model settings from a file written by
+    `write_gazetteer_model_settings`.
+
+    Returns:
+    A tuple of the header dictionary, which includes the `training_hash` of
+    the training data used to train the model, and the settings bytes.
+    """
+    with open(path, 'rb') as f:
+        header = pickle.load(f)
+        if not isinstance(header, dict) or \
+           header.get('snapshot_version') != GAZETTEER_SNAPSHOT_VERSION:
+            raise GazetteerSnapshotError(
+                'Unsupported gazetteer model version in {}'.format(path))
+        return header, pickle.load(f)
+
+
 class GazetteerCache:
     """
     A container for holding a single, trained and indexed Gazetteer in memory,
@@ -515,11 +1385,143 @@ class GazetteerCache:
     removed since the previous call to the `get_latest` class method.
 
     Note that the first time `get_latest` is called it will be slow, as it
-    needs to train a model and index it with all the `Facility` items.
+    needs to train a model and index it with all the `Facility` items. If the
+    GAZETTEER_SNAPSHOT_PATH setting points to a snapshot file the trained and
+    indexed gazetteer is loaded from it instead and only the history rows
+    newer than the snapshot are applied.
+
+    If the GAZETTEER_REFRESH_INTERVAL_IN_SECONDS setting is set the changes are
+    applied by a background thread and `current` does not wait for them. They
+    are applied to a copy of the cached gazetteer which then replaces it, so
+    a gazetteer returned by `get_latest` or `current` is not changed while it
+    is being used for matching. Otherwise the changes are applied in place by
+    the thread that is about to match.
+
+    Deleted facilities and matches are removed from the index. Removed records
+    leave values in the predicate indices that are used for blocking, so once
+    the number of removed records reaches GAZETTEER_COMPACTION_RATIO of the
+    index size the gazetteer is rebuilt from the live records in a background
+    thread.
     """
     _gazetter = None
     _facility_version = None
     _match_version = None
+    # Maps each FacilityMatch ID to the extended facility ID under which the
+    # match is indexed
+    _match_record_ids = {}
+    # The time at which the cached gazetteer was last brought up to date
+    _refreshed_at = None
+    # Held while the cached gazetteer is replaced. Matching does not acquire
+    # the lock because the gazetteer used for matching is never changed.
+    _lock = threading.RLock()
+    _compaction_thread = None
+    _refresh_thread = None
+
+    @classmethod
+    def _set_gazetteer(cls, gazetteer):
+        cls._gazetter = gazetteer
+        cls._match_record_ids = {}
+        for record_id in gazetteer.record_ids():
+            if '_MATCH-' in record_id:
+                match_id = int(record_id.split('_MATCH-')[1])
+                cls._match_record_ids[match_id] = record_id
+
+    @classmethod
+    def _load_snapshot(cls):
+        path = getattr(settings, 'GAZETTEER_SNAPSHOT_PATH', None)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            load_start = datetime.now()
+            # A snapshot written by other code or from other training data
+            # is rebuilt rather than loaded
+            if not is_current_gazetteer_snapshot(
+                    read_gazetteer_snapshot_header(path)):
+                logger.info(
+                    'Gazetteer snapshot {} is out of date'.format(path))
+                return None
+            header, gazetteer = read_gazetteer_snapshot(path)
+        except Exception:
+            # A missing or incompatible snapshot should never prevent
+            # matching so we report the problem and fall back to rebuilding
+            logger.error('Failed to load gazetteer snapshot {}: {}'.format(
+                path, traceback.format_exc()))
+            _try_reporting_error_to_rollbar({'snapshot_path': path})
+            return None
+        logger.info('Loaded gazetteer snapshot created at {} ({})'.format(
+            header['created_at'], datetime.now() - load_start))
+        cls._set_gazetteer(gazetteer)
+        cls._facility_version = header['facility_version']
+        cls._match_version = header['match_version']
+        return cls._gazetter
+
+    @classmethod
+    def _load_model_settings(cls):
+        path = getattr(settings, 'GAZETTEER_MODEL_SETTINGS_PATH', None)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            header, model_settings = read_gazetteer_model_settings(path)
+        except Exception:
+            logger.error('Failed to load gazetteer model {}: {}'.format(
+                path, traceback.format_exc()))
+            return None
+        if header['training_hash'] != training_data_hash():
+            logger.info('Gazetteer model {} is out of date'.format(path))
+            return None
+        logger.info('Loaded gazetteer model trained at {}'.format(
+            header['created_at']))
+        return model_settings
+
+    @classmethod
+    def _write_model_settings(cls, model_settings):
+        path = getattr(settings, 'GAZETTEER_MODEL_SETTINGS_PATH', None)
+        if not path:
+            return
+        try:
+            write_gazetteer_model_settings(model_settings, path)
+        except Exception:
+            logger.error('Failed to write gazetteer model {}: {}'.format(
+                path, traceback.format_exc()))
+
+    @classmethod
+    def _write_snapshot_if_stale(cls):
+        path = getattr(settings, 'GAZETTEER_SNAPSHOT_PATH', None)
+        if not path:
+            return
+        try:
+            if is_current_gazetteer_snapshot(
+                    read_gazetteer_snapshot_header(path)):
+                return
+        except Exception:
+            # A missing or unreadable snapshot is replaced
+            pass
+        try:
+            write_gazetteer_snapshot(cls._gazetter, cls._facility_version,
+                                     cls._match_version, path)
+        except Exception:
+            logger.error('Failed to write gazetteer snapshot {}: {}'.format(
+                path, traceback.format_exc()))
+
+    @classmethod
+    def write_snapshot(cls, path, rebuild=False):
+        """
+        Bring the cached gazetteer up to date and write it to a snapshot file.
+
+        Arguments:
+        path -- The file path to which the snapshot will be written.
+        rebuild -- If True, retrain and reindex the gazetteer rather than
+                   starting from the currently cached or snapshotted version.
+
+        Returns:
+        The snapshot header dictionary.
+        """
+        if rebuild:
+            cls._rebuild_gazetteer()
+        with cls._lock:
+            gazetteer = cls.get_latest()
+            return write_gazetteer_snapshot(gazetteer, cls._facility_version,
+                                            cls._match_version, path)
 
     @classmethod
     def _rebuild_gazetteer(cls):
@@ -535,208 +1537,213 @@ class GazetteerCache:
             canonical = get_canonical_items()
             if len(canonical.keys()) == 0:
                 raise NoCanonicalRecordsError()
-            # We expect `get_messy_items_for_training` to return a list rather
-            # than a QuerySet so that we can close the transaction as quickly
-            # as possible
-            messy = get_messy_items_for_training()
-
-        cls._gazetter = train_gazetteer(messy, canonical, should_index=True)
+            model_settings = cls._load_model_settings()
+            if model_settings is None:
+                # We expect `get_messy_items_for_training` to return a list
+                # rather than a QuerySet so that we can close the transaction
+                # as quickly as possible
+                messy = get_messy_items_for_training()
+
+        by_country = getattr(settings, 'GAZETTEER_SHARD_BY_COUNTRY', False)
+        if model_settings is None:
+            gazetteer = ShardedGazetteer.from_gazetteer(
+                train_gazetteer(messy, canonical), by_country=by_country)
+            cls._write_model_settings(gazetteer.model_settings)
+        else:
+            gazetteer = ShardedGazetteer(model_settings, by_country=by_country)
+        index_start = datetime.now()
+        logger.info('Indexing started')
+        gazetteer.index(canonical)
+        logger.info('Indexing finished ({})'.format(
+            datetime.now() - index_start))
+        cls._set_gazetteer(gazetteer)
         cls._facility_version = db_facility_version
         cls._match_version = db_match_version
+        cls._write_snapshot_if_stale()
         return cls._gazetter
 
     @classmethod
-    @transaction.atomic
-    def _get_new_facility_history(cls):
-        facility_changes = []
-        latest_facility_dedupe_records = {}
-
-        db_facility_version = HistoricalFacility.objects.aggregate(
-            max_id=Max('history_id')).get('max_id')
-
-        if db_facility_version != cls._facility_version:
-            if cls._facility_version is None:
-                last_facility_version_id = 0
-            else:
-                last_facility_version_id = cls._facility_version
-            # We call `list` so that we can get all the data and exit
-            # the transaction as soon as possible
-            facility_changes = list(
-                HistoricalFacility
-                .objects
-                .filter(history_id__gt=last_facility_version_id)
-                .order_by('history_id')
-                .extra(select={'country': 'country_code'})
-                .values('id', 'country', 'name', 'address',
-                        'history_type', 'history_id'))
-
-            changed_facility_ids_qs = HistoricalFacility \
-                .objects \
-                .filter(history_id__gt=last_facility_version_id) \
-                .values_list('id', flat=True)
-
-            # We use an dictionary comprehension so that we can load
-            # all the data and exit the transaction as soon as possible
-            latest_facility_dedupe_records = {
-                f['id']: facility_values_to_dedupe_record(f) for f in
-                Facility
-                .objects
-                .filter(id__in=changed_facility_ids_qs)
-                .extra(select={'country': 'country_code'})
-                .values('id', 'country', 'name', 'address')
-            }
-
-        return facility_changes, latest_facility_dedupe_records
+    def _get_new_history(cls, facility_version, match_version):
+        """
+        Fetch the `Facility` and `FacilityMatch` changes made after the
+        specified versions with a single query.
+
+        Each history row is returned with the current values of the facility
+        or match it describes, so rows for deleted facilities and matches
+        have None in place of those values. Both history tables are read with
+        a range scan of their primary key.
+
+        Arguments:
+        facility_version -- The `HistoricalFacility` history_id after which
+                            changes are returned. None returns all changes.
+        match_version -- The `HistoricalFacilityMatch` history_id after which
+                         changes are returned. None returns all changes.
+
+        Returns:
+        A list of dictionaries with `kind`, `history_id`, `history_type`,
+        `id`, `facility_id`, `status`, `is_active`, and `record` keys, ordered
+        by kind and then history_id. `kind` is either 'facility' or 'match'.
+        `record` is the dedupe record of the current facility fields keyed by
+        facility ID or None.
+        """
+        query = """
+            SELECT 'facility', h.history_id, h.history_type, NULL, h.id,
+                   NULL, NULL, f.country_code, f.name, f.address
+            FROM api_historicalfacility h
+            LEFT JOIN api_facility f ON f.id = h.id
+            WHERE h.history_id > %s
+            UNION ALL
+            SELECT 'match', h.history_id, h.history_type, h.id, m.facility_id,
+                   m.status, m.is_active, f.country_code, f.name, f.address
+            FROM api_historicalfacilitymatch h
+            LEFT JOIN api_facilitymatch m ON m.id = h.id
+            LEFT JOIN api_facility f ON f.id = m.facility_id
+            WHERE h.history_id > %s
+            ORDER BY 1, 2
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query, [facility_version or 0, match_version or 0])
+            rows = cursor.fetchall()
+
+        changes = []
+        for (kind, history_id, history_type, match_id, facility_id, status,
+             is_active, country_code, name, address) in rows:
+            record = None
+            if country_code is not None:
+                record = facility_values_to_dedupe_record({
+                    'id': facility_id,
+                    'country': country_code,
+                    'name': name,
+                    'address': address,
+                })
+            changes.append({
+                'kind': kind,
+                'history_id': history_id,
+                'history_type': history_type,
+                'id': facility_id if kind == 'facility' else match_id,
+                'facility_id': facility_id,
+                'status': status,
+                'is_active': is_active,
+                'record': record,
+            })
+        return changes
 
     @classmethod
-    @transaction.atomic
-    def _get_new_match_history(cls):
-        match_changes = []
-        latest_match_records = {}
-        latest_matched_facility_dedupe_records = {}
-
-        db_match_version = HistoricalFacility.objects.aggregate(
-            max_id=Max('history_id')).get('max_id')
-
-        if db_match_version != cls._match_version:
-            if cls._match_version is None:
-                last_match_version_id = 0
+    def _apply_history(cls, gazetteer, match_record_ids, facility_version,
+                       match_version, changes):
+        """
+        Apply facility and match changes to a gazetteer that is not being
+        used for matching.
+
+        Arguments:
+        gazetteer -- A `ShardedGazetteer` that is updated in place.
+        match_record_ids -- A dictionary mapping each FacilityMatch ID to the
+                            extended facility ID under which it is indexed in
+                            `gazetteer`, which is updated in place.
+        facility_version -- The `HistoricalFacility` history_id that was last
+                            applied to `gazetteer`.
+        match_version -- The `HistoricalFacilityMatch` history_id that was last
+                         applied to `gazetteer`.
+        changes -- The list returned by `_get_new_history`.
+
+        Returns:
+        A tuple of the facility and match versions that have been applied.
+        """
+        def remove_match(match_id):
+            record_id = match_record_ids.pop(match_id, None)
+            if record_id is not None:
+                logger.debug('Removing match {}'.format(record_id))
+                gazetteer.remove([record_id])
+
+        # Every history row carries the current values of its facility or
+        # match, so only the latest row for each needs to be applied.
+        # Reindexing a record once per row would inflate the stale count.
+        latest_changes = {}
+        for item in changes:
+            latest_changes[(item['kind'], item['id'])] = item
+            if item['kind'] == 'facility':
+                facility_version = max(facility_version or 0,
+                                       item['history_id'])
             else:
-                last_match_version_id = cls._match_version
-
-            # We call `list` so that we can get all the data and exit
-            # the transaction as soon as possible
-            match_changes = list(
-                HistoricalFacilityMatch
-                .objects
-                .filter(history_id__gt=last_match_version_id)
-                .order_by('history_id')
-                .values('id', 'facility', 'history_type', 'history_id'))
-
-            # We use an dictionary comprehension so that we can load
-            # all the data and exit the transaction as soon as possible
-            latest_match_records = {
-                m['id']: {
-                    'facility': m['facility'],
-                    'status': m['status'],
-                    'is_active': m['is_active'],
-                } for m in
-                FacilityMatch
-                .objects
-                .filter(id__in=(
-                    HistoricalFacilityMatch
-                    .objects
-                    .filter(history_id__gt=last_match_version_id)
-                    .values_list('id', flat=True)
-                ))
-                .values('id', 'facility', 'status', 'is_active')}
-
-            # We use an dictionary comprehension so that we can load
-            # all the data and exit the transaction as soon as possible
-            latest_matched_facility_dedupe_records = {
-                f['id']: facility_values_to_dedupe_record(f) for f in
-                Facility
-                .objects
-                .filter(id__in=(
-                    HistoricalFacilityMatch
-                    .objects
-                    .filter(history_id__gt=last_match_version_id)
-                    .values_list('facility', flat=True)
-                ))
-                .extra(select={'country': 'country_code'})
-                .values('id', 'country', 'name', 'address')
-            }
+                match_version = max(match_version or 0, item['history_id'])
+
+        for item in sorted(latest_changes.values(),
+                           key=lambda i: (i['kind'], i['history_id'])):
+            # The history row has old field values, so we use the current
+            # values that were fetched with it. If there are no current values
+            # the facility or match has been deleted.
+            if item['kind'] == 'facility':
+                if item['record'] is None:
+                    logger.debug('Removing facility {}'.format(item['id']))
+                    gazetteer.remove([str(item['id'])])
+                elif item['history_type'] != '-':
+                    logger.debug(
+                        'Indexing facility {}'.format(str(item['record'])))
+                    gazetteer.index(item['record'])
+            else:
+                is_active_confirmed_match_with_facility = (
+                    item['history_type'] != '-'
+                    and item['status'] == FacilityMatch.CONFIRMED
+                    and item['is_active']
+                    and item['record'] is not None)
+                if is_active_confirmed_match_with_facility:
+                    # We index confirmed matches with a "synthetic" facility
+                    # ID so that they influence matching without replacing
+                    # the facility record
+                    key = match_detail_to_extended_facility_id(
+                        item['facility_id'], item['id'])
+                    record = {key: item['record'][str(item['facility_id'])]}
+                    if match_record_ids.get(item['id']) != key:
+                        # The match has been moved to another facility
+                        remove_match(item['id'])
+                    logger.debug('Indexing match {}'.format(str(record)))
+                    gazetteer.index(record)
+                    match_record_ids[item['id']] = key
+                else:
+                    remove_match(item['id'])
+
+        return facility_version, match_version
 
-        return (match_changes, latest_match_records,
-                latest_matched_facility_dedupe_records)
+    @classmethod
+    def _swap(cls, gazetteer, facility_version, match_version,
+              match_record_ids):
+        cls._gazetter = gazetteer
+        cls._facility_version = facility_version
+        cls._match_version = match_version
+        cls._match_record_ids = match_record_ids
 
     @classmethod
-    def get_latest(cls):
+    def _catch_up(cls):
         try:
             if cls._gazetter is None:
-                return cls._rebuild_gazetteer()
-
-            facility_changes, latest_facility_dedupe_records = \
-                cls._get_new_facility_history()
-
-            for item in facility_changes:
-                # We were previously calling `cls._gazetter.unindex` to
-                # remove records with a `history_type` of `-` but it was
-                # raising exceptions for which we could not determine the
-                # root cause. We have opted to ignore them and filter out
-                # no longer existing records from the match results.
-                if item['history_type'] != '-':
-                    # The history record has old field values, so we use the
-                    # updated version that we fetched. If we don't have a
-                    # record for the ID, it means that the facility has been
-                    # deleted. We don't need to index a deleted facility.
-                    if item['id'] in latest_facility_dedupe_records:
-                        record = latest_facility_dedupe_records[item['id']]
-                        logger.debug(
-                            'Indexing facility {}'.format(str(record)))
-                        cls._gazetter.index(record)
-                cls._facility_version = item['history_id']
-
-            (match_changes, latest_match_records,
-             latest_matched_facility_dedupe_records) = \
-                cls._get_new_match_history()
-
-            def dedupe_record_for_match_item(item):
-                facility_id = item['facility']
-                key = match_detail_to_extended_facility_id(
-                    facility_id, item['id'])
-                """
-                The latest_matched_facility_dedupe_records dictionary looks
-                like this:
-
-                {
-                    facility_id: {
-                        facility_id: {
-                            field1: value1,
-                            field2, value2
-                        }
-                    }
-                }
-
-                We want to get the inner object and change the key from a real
-                facility ID to a "synthetic" facility ID which we use to index
-                confirmed matches.
-                """
-                value = (
-                    latest_matched_facility_dedupe_records
-                    [facility_id][facility_id]
-                )
-                return {key: value}
-
-            for item in match_changes:
-                match = (latest_match_records[item['id']]
-                         if item['id'] in latest_match_records
-                         else None)
-                has_facility = (
-                    item['facility'] in latest_matched_facility_dedupe_records)
-                is_confirmed_match_with_facility = (
-                    match
-                    and match['status'] == FacilityMatch.CONFIRMED
-                    and has_facility)
-                if is_confirmed_match_with_facility:
-                    # We were previously calling `cls._gazetter.unindex` to
-                    # remove records with a `history_type` of `-` but it was
-                    # raising exceptions for which we could not determine the
-                    # root cause. We have opted to ignore them and filter out
-                    # no longer existing records from the match results.
-                    if item['history_type'] != '-':
-                        # The history record has old field values, so we us the
-                        # updated version that we fetched. If we don't have a
-                        # record for the ID, it means that the facility has
-                        # been deleted. We don't need to index a deleted
-                        # facility.
-                        if match and match['is_active']:
-                            record = dedupe_record_for_match_item(item)
-                            logger.debug(
-                                'Indexing match {}'.format(str(record)))
-                            cls._gazetter.index(record)
-                    cls._match_version = item['history_id']
-
+                if cls._load_snapshot() is None:
+                    cls._rebuild_gazetteer()
+                    cls._refreshed_at = time.time()
+                    return cls._gazetter
+
+            changes = cls._get_new_history(
+                cls._facility_version, cls._match_version)
+
+            if changes:
+                if getattr(settings, 'GAZETTEER_REFRESH_INTERVAL_IN_SECONDS',
+                           None):
+                    # The background refresh applies changes while other
+                    # threads match, so the changes are applied to a copy
+                    # that is swapped in once it is complete
+                    gazetteer = cls._gazetter.copy()
+                    match_record_ids = dict(cls._match_record_ids)
+                else:
+                    # Changes are applied by the thread that is about to
+                    # match, so the cached gazetteer is updated in place
+                    # rather than copying its records and changed shards
+                    gazetteer = cls._gazetter
+                    match_record_ids = cls._match_record_ids
+                facility_version, match_version = cls._apply_history(
+                    gazetteer, match_record_ids, cls._facility_version,
+                    cls._match_version, changes)
+                cls._swap(gazetteer, facility_version, match_version,
+                          match_record_ids)
+            cls._refreshed_at = time.time()
         except Exception:
             extra_info = {
                 'last_successful_facility_version': cls._facility_version,
@@ -745,3 +1752,179 @@ class GazetteerCache:
             raise
 
         return cls._gazetter
+
+    @classmethod
+    def get_latest(cls):
+        """
+        Bring the cached gazetteer up to date with the `Facility` and
+        `FacilityMatch` history and return it.
+        """
+        with cls._lock:
+            gazetteer = cls._catch_up()
+        cls.maybe_compact()
+        return gazetteer
+
+    @classmethod
+    def current(cls):
+        """
+        Return the cached gazetteer for matching.
+
+        If the GAZETTEER_REFRESH_INTERVAL_IN_SECONDS setting is not set this
+        is the same as `get_latest`. Otherwise the history is applied by a
+        background thread on that interval and the cached gazetteer is
+        returned without waiting for it, unless nothing has been loaded yet or
+        the cache has not been brought up to date for more than
+        GAZETTEER_MAX_STALENESS_IN_SECONDS.
+        """
+        interval = getattr(
+            settings, 'GAZETTEER_REFRESH_INTERVAL_IN_SECONDS', None)
+        if not interval:
+            return cls.get_latest()
+
+        cls.start_refresh_thread(interval)
+        gazetteer = cls._gazetter
+        max_staleness = getattr(
+            settings, 'GAZETTEER_MAX_STALENESS_IN_SECONDS', None)
+        if gazetteer is None or (max_staleness is not None
+                                 and cls.staleness() > max_staleness):
+            return cls.get_latest()
+        return gazetteer
+
+    @classmethod
+    def staleness(cls):
+        """
+        Return the number of seconds since the cached gazetteer was last
+        brought up to date, or None if it has not been loaded.
+        """
+        if cls._gazetter is None or cls._refreshed_at is None:
+            return None
+        return time.time() - cls._refreshed_at
+
+    @classmethod
+    def start_refresh_thread(cls, interval):
+        with cls._lock:
+            if cls._refresh_thread is not None \
+               and cls._refresh_thread.is_alive():
+                return
+            cls._refresh_thread = threading.Thread(
+                target=cls._refresh_periodically, args=(interval,),
+                name='gazetteer-refresh', daemon=True)
+            cls._refresh_thread.start()
+
+    @classmethod
+    def _refresh_periodically(cls, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                cls.get_latest()
+            except Exception:
+                logger.error('Failed to refresh gazetteer: {}'.format(
+                    traceback.format_exc()))
+            finally:
+                # Each thread has its own connection, which would otherwise
+                # be held open between refreshes
+                connection.close()
+            staleness = cls.staleness()
+            max_staleness = getattr(
+                settings, 'GAZETTEER_MAX_STALENESS_IN_SECONDS', None)
+            if staleness is not None and max_staleness is not None \
+               and staleness > max_staleness:
+                logger.warning(
+                    'Gazetteer has not been refreshed for {:.0f}s'.format(
+                        staleness))
+
+    @classmethod
+    def index_stats(cls):
+        """
+        Describe the size and freshness of the cached gazetteer index.
+
+        Returns:
+        A dictionary with the number of indexed facility and confirmed match
+        records, the number of shards, the number of records that have been
+        removed or replaced since the index was last built, and the number of
+        seconds since the index was last brought up to date. None if the
+        gazetteer has not been loaded.
+        """
+        with cls._lock:
+            gazetteer = cls._gazetter
+            if gazetteer is None:
+                return None
+            match_count = len(cls._match_record_ids)
+            return {
+                'indexed_records': gazetteer.index_size(),
+                'indexed_facilities': gazetteer.index_size() - match_count,
+                'indexed_matches': match_count,
+                'shards': len(gazetteer.shards),
+                'stale_records': gazetteer.stale_count,
+                'facility_version': cls._facility_version,
+                'match_version': cls._match_version,
+                'staleness_seconds': cls.staleness(),
+            }
+
+    @classmethod
+    def needs_compaction(cls):
+        gazetteer = cls._gazetter
+        if gazetteer is None or gazetteer.stale_count == 0:
+            return False
+        ratio = getattr(settings, 'GAZETTEER_COMPACTION_RATIO', None)
+        if ratio is None:
+            return False
+        return gazetteer.stale_count >= ratio * max(gazetteer.index_size(), 1)
+
+    @classmethod
+    def maybe_compact(cls):
+        """
+        Start compacting the gazetteer in a background thread if enough
+        records have been removed from the index and a compaction is not
+        already running.
+        """
+        with cls._lock:
+            if not cls.needs_compaction():
+                return
+            if cls._compaction_thread is not None \
+               and cls._compaction_thread.is_alive():
+                return
+            cls._compaction_thread = threading.Thread(
+                target=cls.compact, name='gazetteer-compaction', daemon=True)
+            cls._compaction_thread.start()
+
+    @classmethod
+    def compact(cls):
+        """
+        Replace the cached gazetteer with one that is indexed with only the
+        live records. The index is rebuilt without holding the lock so that
+        matching and refreshing can continue while it runs. The history
+        applied to the cached gazetteer in the meantime is then applied to
+        the new one before it is swapped in.
+        """
+        try:
+            with cls._lock:
+                gazetteer = cls._gazetter
+                if gazetteer is None:
+                    return
+                facility_version = cls._facility_version
+                match_version = cls._match_version
+                match_record_ids = dict(cls._match_record_ids)
+                records = gazetteer.live_records()
+                stale_count = gazetteer.stale_count
+            compact_start = datetime.now()
+            compacted = gazetteer.compacted(records)
+            with cls._lock:
+                if cls._gazetter is None:
+                    return
+                facility_version, match_version = cls._apply_history(
+                    compacted, match_record_ids, facility_version,
+                    match_version,
+                    cls._get_new_history(facility_version, match_version))
+                cls._swap(compacted, facility_version, match_version,
+                          match_record_ids)
+            logger.info(
+                'Compacted gazetteer with {} records and {} stale records '
+                '({})'.format(len(records), stale_count,
+                              datetime.now() - compact_start))
+        except Exception:
+            logger.error('Failed to compact gazetteer: {}'.format(
+                traceback.format_exc()))
+            _try_reporting_error_to_rollbar({})
+        finally:
+            connection.close()
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0090_remove_duplicate_field_name_choices'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrainingSampleItem',
+            fields=[
+                ('facility_list_item', models.OneToOneField(help_text='The list item included in the training sample.', on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='api.FacilityListItem')),
+                ('country', models.CharField(help_text='The clean country code of the list item.', max_length=2)),
+                ('name', models.TextField(blank=True, help_text='The clean name of the list item.', null=True)),
+                ('address', models.TextField(blank=True, help_text='The clean address of the list item.', null=True)),
+                ('sort_key', models.IntegerField(help_text='A pseudo-random value derived from the list item ID that is used to select the sample.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='trainingsampleitem',
+            index=models.Index(fields=['country', 'sort_key'], name='api_tsi_country_sort_key'),
+        ),
+    ]
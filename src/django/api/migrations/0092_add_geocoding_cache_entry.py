@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0091_add_training_sample_item'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodingCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.TextField(help_text='The clean address that was geocoded.')),
+                ('country_code', models.CharField(help_text='The country code the address was geocoded within.', max_length=2)),
+                ('result_count', models.IntegerField(help_text='The number of results returned by the geocoder.')),
+                ('geocoded_point', django.contrib.postgres.fields.jsonb.JSONField(help_text='The lat/lng of the geocoded location.', null=True)),
+                ('geocoded_address', models.TextField(help_text='The formatted address returned by the geocoder.', null=True)),
+                ('full_response', django.contrib.postgres.fields.jsonb.JSONField(help_text='The full response returned by the geocoder.')),
+                ('hit_count', models.IntegerField(default=0, help_text='The number of times the entry was used instead of geocoding the address.')),
+                ('last_hit_at', models.DateTimeField(help_text='When the entry was last used.', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name_plural': 'geocoding cache entries',
+                'unique_together': {('address', 'country_code')},
+            },
+        ),
+    ]
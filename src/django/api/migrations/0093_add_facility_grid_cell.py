@@ -0,0 +1,142 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+# The cells of the grid at each zoom level are the hexagons created by
+# `generate_hexgrid` with a width of one eighth of a tile at that zoom level.
+# Hexagon centers are on two offset rectangular lattices, so the cell that
+# contains a point is the one with the nearer of the closest center on each
+# lattice. The zoom levels match GRID_CELL_ZOOMS in api/tiler.py.
+create_facility_grid_functions = """
+CREATE OR REPLACE FUNCTION facility_grid_cell(
+  location geometry, zoom int, OUT x int, OUT y int
+) AS $$
+DECLARE
+  width float := 40075016.68557849 / (2 ^ zoom) / 8;
+  b float := width / 2;
+  a float := tan(radians(30)) * b;
+  height float := 6 * a;
+  mercator geometry := ST_Transform(location, 3857);
+  px float := ST_X(mercator);
+  py float := ST_Y(mercator);
+  x0 int := round(px / width);
+  y0 int := round((py - 2 * a) / height);
+  x1 int := round((px - b) / width);
+  y1 int := round((py - 5 * a) / height);
+BEGIN
+  IF (px - x0 * width) ^ 2 + (py - y0 * height - 2 * a) ^ 2
+     <= (px - x1 * width - b) ^ 2 + (py - y1 * height - 5 * a) ^ 2 THEN
+    x := x0;
+    y := 2 * y0;
+  ELSE
+    x := x1;
+    y := 2 * y1 + 1;
+  END IF;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION add_facility_grid_cell_counts(
+  locations geometry[], deltas int[]
+) RETURNS void AS $$
+  INSERT INTO api_facilitygridcell AS cell (zoom, x, y, count)
+  SELECT zoom, (c).x, (c).y, sum(delta)::int
+  FROM (
+    SELECT zoom, facility_grid_cell(location, zoom) AS c, delta
+    FROM unnest(locations, deltas) AS change(location, delta),
+         generate_series(0, 11) AS zoom
+    -- Web mercator does not extend to the poles
+    WHERE location IS NOT NULL AND abs(ST_Y(location)) < 85.0511
+  ) AS cells
+  GROUP BY zoom, (c).x, (c).y
+  ORDER BY zoom, (c).x, (c).y
+  ON CONFLICT (zoom, x, y) DO UPDATE SET count = cell.count + EXCLUDED.count;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION update_facility_grid_cells() RETURNS trigger AS $$
+DECLARE
+  locations geometry[];
+  deltas int[];
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    SELECT array_agg(location), array_agg(1)
+    INTO locations, deltas FROM new_rows;
+  ELSIF TG_OP = 'DELETE' THEN
+    SELECT array_agg(location), array_agg(-1)
+    INTO locations, deltas FROM old_rows;
+  ELSE
+    SELECT array_agg(location), array_agg(delta)
+    INTO locations, deltas FROM (
+      SELECT o.location, -1 AS delta
+      FROM old_rows o JOIN new_rows n ON o.id = n.id
+      WHERE o.location IS DISTINCT FROM n.location
+      UNION ALL
+      SELECT n.location, 1 AS delta
+      FROM old_rows o JOIN new_rows n ON o.id = n.id
+      WHERE o.location IS DISTINCT FROM n.location
+    ) AS changes;
+  END IF;
+  IF locations IS NOT NULL THEN
+    PERFORM add_facility_grid_cell_counts(locations, deltas);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rebuild_facility_grid_cells() RETURNS void AS $$
+  DELETE FROM api_facilitygridcell;
+  SELECT add_facility_grid_cell_counts(array_agg(location), array_agg(1))
+  FROM api_facilityindex;
+$$ LANGUAGE sql;
+
+CREATE TRIGGER facility_grid_cells_insert
+  AFTER INSERT ON api_facilityindex
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE update_facility_grid_cells();
+
+CREATE TRIGGER facility_grid_cells_update
+  AFTER UPDATE ON api_facilityindex
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE update_facility_grid_cells();
+
+CREATE TRIGGER facility_grid_cells_delete
+  AFTER DELETE ON api_facilityindex
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE update_facility_grid_cells();
+
+SELECT rebuild_facility_grid_cells();
+"""
+
+drop_facility_grid_functions = """
+DROP TRIGGER facility_grid_cells_insert ON api_facilityindex;
+DROP TRIGGER facility_grid_cells_update ON api_facilityindex;
+DROP TRIGGER facility_grid_cells_delete ON api_facilityindex;
+DROP FUNCTION rebuild_facility_grid_cells;
+DROP FUNCTION update_facility_grid_cells;
+DROP FUNCTION add_facility_grid_cell_counts;
+DROP FUNCTION facility_grid_cell;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0092_add_geocoding_cache_entry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacilityGridCell',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.SmallIntegerField(help_text='The tile zoom level of the grid.')),
+                ('x', models.IntegerField(help_text='The column of the cell in the grid.')),
+                ('y', models.IntegerField(help_text='The row of the cell in the grid. Odd rows are offset by half of a cell.')),
+                ('count', models.IntegerField(help_text='The number of facilities in the cell.')),
+            ],
+            options={
+                'unique_together': {('zoom', 'x', 'y')},
+            },
+        ),
+        migrations.RunSQL(create_facility_grid_functions,
+                          drop_facility_grid_functions),
+    ]
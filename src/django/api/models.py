@@ -1,7 +1,15 @@
-from collections import defaultdict
-from itertools import groupby
+import atexit
+import logging
+import queue
+import threading
+import traceback
+
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from itertools import groupby, islice
 from unidecode import unidecode
 
+from django.conf import settings
 from django.contrib.auth.models import (AbstractBaseUser,
                                         BaseUserManager,
                                         PermissionsMixin)
@@ -9,7 +17,7 @@ from django.contrib.gis.db import models as gis_models
 from django.contrib.postgres import fields as postgres
 from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.aggregates.general import ArrayAgg
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.db.models import (F, Q, ExpressionWrapper)
 from django.db.models.signals import post_save
 from django.db.models.functions import Concat
@@ -24,14 +32,17 @@ from api.countries import COUNTRY_CHOICES
 from api.oar_id import make_oar_id
 from api.constants import (Affiliations, Certifications, FacilitiesQueryParams)
 from api.helpers import (prefix_a_an,
-                         get_single_contributor_field_values,
-                         get_list_contributor_field_values,
+                         get_csv_values,
+                         get_raw_data_field_values,
+                         get_csv_field_values,
                          clean, convert_to_standard_ranges,
                          format_custom_text)
 from api.facility_type_processing_type import (
     ALL_FACILITY_TYPE_CHOICES,
     get_facility_and_processing_type)
 
+logger = logging.getLogger(__name__)
+
 
 class ArrayLength(models.Func):
     """
@@ -225,7 +236,7 @@ class Contributor(models.Model):
             .filter(facilitylistitem__source__contributor=instance)\
             .values_list('id', flat=True)
         if len(f_ids) > 0:
-            index_facilities(f_ids)
+            queue_index_update(index_facilities, f_ids)
 
     def __str__(self):
         return '{name} ({id})'.format(**self.__dict__)
@@ -404,7 +415,7 @@ class Source(models.Model):
                         .filter(facilitylistitem__source=instance) \
                         .values_list('id', flat=True)
         if len(f_ids) > 0:
-            index_facilities(f_ids)
+            queue_index_update(index_facilities, f_ids)
 
     def __str__(self):
         return '{0} ({1})'.format(
@@ -671,7 +682,7 @@ class FacilityListItem(PPEMixin):
     def post_save(sender, **kwargs):
         instance = kwargs.get('instance')
         if instance.facility is not None:
-            index_custom_text([instance.facility.id])
+            queue_index_update(index_custom_text, [instance.facility.id])
 
     def __str__(self):
         return 'FacilityListItem {id} - {status}'.format(**self.__dict__)
@@ -1201,6 +1212,8 @@ class FacilityManager(models.Manager):
     def filter_by_query_params(self, params):
         """
         Create a Facility queryset filtered by a list of request query params.
+        Only use this queryset when the Facility columns that are not in
+        FacilityIndex are needed, such as when serializing facilities.
 
         Arguments:
         self (queryset) -- A queryset on the Facility model
@@ -1210,7 +1223,80 @@ class FacilityManager(models.Manager):
         Returns:
         A queryset on the Facility model
         """
+        index_qs = FacilityIndex.objects.filter_by_query_params(params)
+        if not index_qs.query.has_filters():
+            return self.all()
+        return self.filter(id__in=index_qs.values('id'))
+
+
+# The query parameters used by `FacilityIndexManager.filter_by_query_params`
+FACILITY_FILTER_PARAMS = [
+    FacilitiesQueryParams.Q,
+    FacilitiesQueryParams.NAME,
+    FacilitiesQueryParams.CONTRIBUTORS,
+    FacilitiesQueryParams.LISTS,
+    FacilitiesQueryParams.CONTRIBUTOR_TYPES,
+    FacilitiesQueryParams.COUNTRIES,
+    FacilitiesQueryParams.COMBINE_CONTRIBUTORS,
+    FacilitiesQueryParams.BOUNDARY,
+    FacilitiesQueryParams.EMBED,
+    FacilitiesQueryParams.PARENT_COMPANY,
+    FacilitiesQueryParams.FACILITY_TYPE,
+    FacilitiesQueryParams.PROCESSING_TYPE,
+    FacilitiesQueryParams.PRODUCT_TYPE,
+    FacilitiesQueryParams.NUMBER_OF_WORKERS,
+    FacilitiesQueryParams.NATIVE_LANGUAGE_NAME,
+]
+
+# The number of filtered FacilityIndex queries kept by each process
+FILTER_QUERY_CACHE_SIZE = 256
+
+
+class FacilityIndexManager(models.Manager):
+    _filter_queries = OrderedDict()
+    _filter_queries_lock = threading.Lock()
+
+    def filter_by_query_params(self, params):
+        """
+        Create a FacilityIndex queryset filtered by a list of request query
+        params.
+
+        The filtered query is built once for each set of filter params and
+        reused by later calls, because matching facility and processing types
+        is slow. The order of the params does not change the query, but the
+        order of the values of a param is kept since the first contributor
+        is used to search custom text.
+
+        Arguments:
+        self (queryset) -- A queryset on the FacilityIndex model
+        params (dict) -- Request query parameters whose potential choices are
+                        enumerated in `api.constants.FacilitiesQueryParams`.
 
+        Returns:
+        A queryset on the FacilityIndex model
+        """
+        key = tuple((param, tuple(params.getlist(param)))
+                    for param in FACILITY_FILTER_PARAMS if param in params)
+        with self._filter_queries_lock:
+            query = self._filter_queries.get(key)
+            if query is not None:
+                self._filter_queries.move_to_end(key)
+
+        if query is None:
+            query = self.build_filter_query(params)
+            with self._filter_queries_lock:
+                self._filter_queries[key] = query
+                while len(self._filter_queries) > FILTER_QUERY_CACHE_SIZE:
+                    self._filter_queries.popitem(last=False)
+
+        return self._queryset_class(model=self.model, query=query.chain(),
+                                    using=self._db, hints=self._hints)
+
+    def build_filter_query(self, params):
+        """
+        Returns:
+        The Query of a FacilityIndex queryset filtered by the params.
+        """
         free_text_query = params.get(FacilitiesQueryParams.Q, None)
 
         name = params.get(FacilitiesQueryParams.NAME, None)
@@ -1253,7 +1339,7 @@ class FacilityManager(models.Manager):
             FacilitiesQueryParams.NATIVE_LANGUAGE_NAME, None
         )
 
-        facilities_qs = FacilityIndex.objects.all()
+        facilities_qs = self.all()
 
         if free_text_query is not None:
             custom_text = (
@@ -1356,11 +1442,7 @@ class FacilityManager(models.Manager):
                 native_language_name__icontains=unidecode_name
             )
 
-        facility_ids = facilities_qs.values_list('id', flat=True)
-        facilities_qs = Facility.objects.filter(id__in=facility_ids)
-
-        print(facilities_qs.query)
-        return facilities_qs
+        return facilities_qs.query
 
 
 class Facility(PPEMixin):
@@ -1601,7 +1683,7 @@ class Facility(PPEMixin):
             self.ppe_website = item.ppe_website
 
         return (
-            should_update_ppe_website
+            should_update_ppe_product_types
             or should_update_ppe_contact_phone
             or should_update_ppe_contact_email
             or should_update_ppe_website)
@@ -1660,7 +1742,7 @@ class Facility(PPEMixin):
     @staticmethod
     def post_save(sender, **kwargs):
         instance = kwargs.get('instance')
-        index_facilities([instance.id])
+        queue_index_update(index_facilities, [instance.id])
 
 
 class FacilityIndex(models.Model):
@@ -1757,6 +1839,8 @@ class FacilityIndex(models.Model):
         help_text='ExtendedField for parent_company_id.'),
         default=list)
 
+    objects = FacilityIndexManager()
+
     class Meta:
         indexes = [GinIndex(fields=['contrib_types', 'contributors', 'lists'])]
 
@@ -1854,7 +1938,7 @@ class FacilityMatch(models.Model):
     @staticmethod
     def post_save(sender, **kwargs):
         instance = kwargs.get('instance')
-        index_facilities([instance.facility.id])
+        queue_index_update(index_facilities, [instance.facility.id])
 
     def __str__(self):
         return '{0} - {1} - {2}'.format(self.facility_list_item, self.facility,
@@ -2453,180 +2537,368 @@ class ExtendedField(models.Model):
     def post_save(sender, **kwargs):
         instance = kwargs.get('instance')
         if instance.facility is not None:
-            index_extendedfields([instance.facility.id])
+            queue_index_update(index_extendedfields,
+                               [instance.facility.id])
+
+
+class TrainingSampleItem(models.Model):
+    """
+    A `FacilityListItem` in the sample of list items used to train the
+    gazetteer, with the clean field values used for training. The sample
+    contains the items with the lowest `sort_key` values in each country.
+    """
+    facility_list_item = models.OneToOneField(
+        'FacilityListItem',
+        primary_key=True,
+        on_delete=models.CASCADE,
+        help_text='The list item included in the training sample.')
+    country = models.CharField(
+        max_length=2,
+        null=False,
+        blank=False,
+        help_text='The clean country code of the list item.')
+    name = models.TextField(
+        null=True,
+        blank=True,
+        help_text='The clean name of the list item.')
+    address = models.TextField(
+        null=True,
+        blank=True,
+        help_text='The clean address of the list item.')
+    sort_key = models.IntegerField(
+        null=False,
+        help_text=('A pseudo-random value derived from the list item ID '
+                   'that is used to select the sample.'))
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['country', 'sort_key'],
+                         name='api_tsi_country_sort_key'),
+        ]
+
+
+class GeocodingCacheEntry(models.Model):
+    """
+    The result of geocoding an address, stored so that the address is not
+    sent to the geocoder again until the entry expires.
+    """
+    class Meta:
+        verbose_name_plural = 'geocoding cache entries'
+        unique_together = ('address', 'country_code')
+
+    address = models.TextField(
+        null=False,
+        blank=False,
+        help_text='The clean address that was geocoded.')
+    country_code = models.CharField(
+        max_length=2,
+        null=False,
+        blank=False,
+        help_text='The country code the address was geocoded within.')
+    result_count = models.IntegerField(
+        null=False,
+        help_text='The number of results returned by the geocoder.')
+    geocoded_point = postgres.JSONField(
+        null=True,
+        help_text='The lat/lng of the geocoded location.')
+    geocoded_address = models.TextField(
+        null=True,
+        help_text='The formatted address returned by the geocoder.')
+    full_response = postgres.JSONField(
+        null=False,
+        help_text='The full response returned by the geocoder.')
+    hit_count = models.IntegerField(
+        null=False,
+        default=0,
+        help_text='The number of times the entry was used instead of '
+                  'geocoding the address.')
+    last_hit_at = models.DateTimeField(
+        null=True,
+        help_text='When the entry was last used.')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class FacilityGridCell(models.Model):
+    """
+    The number of indexed facilities located in a cell of the hexagonal grid
+    drawn by the facility grid vector tiles at a zoom level. The rows are kept
+    up to date by triggers on the FacilityIndex table.
+    """
+    class Meta:
+        unique_together = ('zoom', 'x', 'y')
+
+    zoom = models.SmallIntegerField(
+        null=False,
+        help_text='The tile zoom level of the grid.')
+    x = models.IntegerField(
+        null=False,
+        help_text='The column of the cell in the grid.')
+    y = models.IntegerField(
+        null=False,
+        help_text=('The row of the cell in the grid. Odd rows are offset by '
+                   'half of a cell.'))
+    count = models.IntegerField(
+        null=False,
+        help_text='The number of facilities in the cell.')
+
+
+# The number of FacilityIndex rows updated by each query when indexing custom
+# text and extended fields
+INDEX_CHUNK_SIZE = 1000
+
+
+def get_searchable_contributor_fields():
+    """
+    Get the column names of the searchable embed fields of each contributor.
+
+    Returns:
+    A dictionary mapping contributor IDs to lists of column names
+    """
+    fields = EmbedField.objects \
+        .filter(searchable=True, visible=True, embed_config__isnull=False) \
+        .values_list('embed_config__contributor', 'column_name')
+    contributor_fields = defaultdict(list)
+    for contributor_id, column_name in fields:
+        contributor_fields[contributor_id].append(column_name)
+    return contributor_fields
+
+
+def get_list_header_fields(contributor_ids):
+    """
+    Parse the header of each list submitted by the specified contributors.
+
+    Returns:
+    A dictionary mapping facility list IDs to lists of column names
+    """
+    headers = FacilityList.objects \
+        .filter(source__contributor_id__in=contributor_ids) \
+        .values_list('id', 'header')
+    return {list_id: get_csv_values(header) for list_id, header in headers}
 
 
 @transaction.atomic
-def get_custom_text(facility_ids=list):
+def get_custom_text(facility_ids=list, contributor_fields=None,
+                    list_header_fields=None):
     # If passed an empty array, update all facilities (where applicable)
     if len(facility_ids) == 0:
         print('Indexing custom text for all facilities...')
         facility_ids = Facility.objects.all().values_list('id', flat=True)
 
-    # Get a list of searchable embed fields
-    fields_filter = (Q(searchable=True) & Q(visible=True)
-                     & Q(embed_config__isnull=False))
-    fields = EmbedField.objects.filter(fields_filter)
+    # Get the searchable embed fields of each contributor and the parsed
+    # headers of their lists, unless they were passed in by a caller getting
+    # the custom text of several batches of facilities
+    if contributor_fields is None:
+        contributor_fields = get_searchable_contributor_fields()
+    if list_header_fields is None:
+        list_header_fields = get_list_header_fields(list(contributor_fields))
 
-    # Get a list of contributors with searchable fields
-    contributor_ids = fields.values_list('embed_config__contributor',
-                                         flat=True).distinct()
+    custom_fields = defaultdict(list)
+    if len(contributor_fields) == 0:
+        return custom_fields
 
     # Get a list of active FacilityListItems for the given facilities.
     # Only include list items where the contributors have searchable fields.
     # Select the most recent item for each facility for each contributor.
     items_filter = (Q(facility_id__in=facility_ids)
-                    & Q(source__contributor_id__in=contributor_ids)
+                    & Q(source__contributor_id__in=list(contributor_fields))
                     & Q(source__is_active=True)
                     & Q(facilitymatch__is_active=True))
     items = FacilityListItem.objects.filter(items_filter) \
         .distinct('facility__id', 'source__contributor__id') \
         .order_by('facility__id', 'source__contributor__id', '-created_at') \
+        .values_list('facility_id', 'source__contributor_id',
+                     'source__source_type', 'source__facility_list_id',
+                     'raw_data') \
         .iterator()
 
-    custom_fields = defaultdict(list)
-    contributor_fields = defaultdict(list)
-
-    for item in items:
-        contributor_id = item.source.contributor.id
-
-        # Calculate a list of searchable fields for the item's contributor
-        if len(contributor_fields[contributor_id]) == 0:
-            contributor_fields[contributor_id] = fields.filter(
-                    Q(embed_config__contributor__id=contributor_id)) \
-                    .values_list('column_name', flat=True)
-
+    for facility_id, contributor_id, source_type, list_id, raw_data in items:
         formatted_fields = [{'value': '', 'column_name': f} for f
                             in contributor_fields[contributor_id]]
 
         # Get the field values from the item for all of the submitting
         # contributor's searchable fields
-        if item.source.source_type == 'SINGLE':
-            item_fields = get_single_contributor_field_values(
-                                    item,
-                                    formatted_fields
-                                )
+        if source_type == Source.SINGLE:
+            item_fields = get_raw_data_field_values(raw_data,
+                                                    formatted_fields)
         else:
-            item_fields = get_list_contributor_field_values(
-                                    item,
-                                    formatted_fields
-                                 )
+            item_fields = get_csv_field_values(
+                raw_data, list_header_fields.get(list_id, []),
+                formatted_fields)
 
         item_fields_array = [format_custom_text(contributor_id, f['value'])
                              for f in item_fields if f['value']]
 
         # Add the values to the dictionary entry for the item's facility
-        custom_fields[item.facility.id] += item_fields_array
+        custom_fields[facility_id] += item_fields_array
 
     return custom_fields
 
 
 @transaction.atomic
 def index_custom_text(facility_ids=list):
-    custom_fields = get_custom_text(facility_ids)
-
-    facilities = FacilityIndex.objects.filter(id__in=facility_ids) \
-                                      .iterator()
-    for facility in facilities:
-        facility.custom_text = custom_fields.get(facility.id, list())
-        facility.save()
-
-
-@transaction.atomic
-def index_extendedfields(facility_ids=list):
     # If passed an empty array, update all facilities (where applicable)
     if len(facility_ids) == 0:
-        print('Indexing extended fields for all facilities...')
-        facility_ids = Facility.objects.all().values_list('id', flat=True)
+        index_ids = FacilityIndex.objects.all()
+    else:
+        index_ids = FacilityIndex.objects.filter(id__in=facility_ids)
+    index_ids = index_ids.order_by('id').values_list('id', flat=True)
+    show_progress = (len(facility_ids) == 0
+                     or len(facility_ids) > INDEX_CHUNK_SIZE)
+    total = index_ids.count() if show_progress else None
+
+    contributor_fields = get_searchable_contributor_fields()
+    list_header_fields = get_list_header_fields(list(contributor_fields))
+
+    indexed = 0
+    index_ids = index_ids.iterator()
+    while True:
+        chunk = list(islice(index_ids, INDEX_CHUNK_SIZE))
+        if len(chunk) == 0:
+            break
+        custom_fields = get_custom_text(chunk, contributor_fields,
+                                        list_header_fields)
+        FacilityIndex.objects.bulk_update(
+            [FacilityIndex(id=facility_id,
+                           custom_text=custom_fields.get(facility_id, list()))
+             for facility_id in chunk],
+            ['custom_text'])
+
+        indexed += len(chunk)
+        if show_progress:
+            print('Indexed custom text for {} of {} facilities'.format(
+                indexed, total))
+
+
+EXTENDED_FIELD_INDEX_FIELDS = [
+    'parent_company_name', 'parent_company_id', 'number_of_workers',
+    'facility_type', 'processing_type', 'product_type',
+    'native_language_name']
+
+
+def get_extendedfield_index_values(fields):
+    """
+    Calculate the values of the extended field columns of a `FacilityIndex`
+    row from the extended fields of the facility.
+
+    Arguments:
+    fields -- An iterable of (field_name, value) tuples for the non-null
+              `ExtendedField`s of a facility.
 
-    fields = ExtendedField.objects.filter(facility__id__in=facility_ids,
-                                          value__isnull=False)
-
-    facilities = FacilityIndex.objects.filter(id__in=facility_ids) \
-                                      .iterator()
-    for facility in facilities:
-        facility_fields = fields.filter(facility__id=facility.id)
-
-        # Set parent_company_name and parent_company_id:
-        parent_company_values = facility_fields.filter(
-            field_name='parent_company',
-            value__has_any_keys=['name', 'contributor_name',
-                                 'contributor_id']) \
-            .values('value__contributor_name', 'value__name',
-                    'value__contributor_id')
-        parent_company_name = set()
-        parent_company_id = set()
-        for parent_company in parent_company_values:
-            contributor_name = parent_company.get('value__contributor_name',
-                                                  None)
-            name = parent_company.get('value__name', None)
-            contributor_id = parent_company.get('value__contributor_id',
-                                                None)
+    Returns:
+    A dictionary mapping each of the `EXTENDED_FIELD_INDEX_FIELDS` to a list
+    """
+    parent_company_name = set()
+    parent_company_id = set()
+    number_of_workers_ranges = set()
+    facility_types = set()
+    processing_types = set()
+    product_types = set()
+    native_language_names = set()
+
+    for field_name, value in fields:
+        if field_name == ExtendedField.PARENT_COMPANY:
+            # Set parent_company_name and parent_company_id:
+            if not isinstance(value, dict):
+                continue
+            contributor_name = value.get('contributor_name', None)
+            name = value.get('name', None)
+            contributor_id = value.get('contributor_id', None)
             if contributor_name is not None:
                 parent_company_name.add(contributor_name)
             elif name is not None:
                 parent_company_name.add(name)
             if contributor_id is not None:
                 parent_company_id.add(contributor_id)
-        facility.parent_company_name = list(parent_company_name)
-        facility.parent_company_id = list(parent_company_id)
-
-        # Add all of the standardized ranges that
-        # overlap with any of the submitted ranges
-        # to set number_of_workers:
-        number_of_workers_values = facility_fields.filter(
-            field_name='number_of_workers') \
-            .values_list('value', flat=True)
-        number_of_workers_ranges = set()
-        for value in number_of_workers_values:
-                convert_to_standard_ranges(value, number_of_workers_ranges)
-        facility.number_of_workers = list(number_of_workers_ranges)
-
-        # Use clean taxonomy values in the index for facility_type:
-        facility_type_values = facility_fields.filter(
-            field_name='facility_type',
-            value__has_key='matched_values') \
-            .values_list('value__matched_values', flat=True)
-        facility_types = set()
-        for values_list in facility_type_values:
-            for facility_type_value in values_list:
+        elif field_name == ExtendedField.NUMBER_OF_WORKERS:
+            # Add all of the standardized ranges that
+            # overlap with any of the submitted ranges
+            # to set number_of_workers:
+            convert_to_standard_ranges(value, number_of_workers_ranges)
+        elif field_name == ExtendedField.FACILITY_TYPE:
+            # Use clean taxonomy values in the index for facility_type:
+            if not isinstance(value, dict) or 'matched_values' not in value:
+                continue
+            for facility_type_value in value['matched_values']:
                 if facility_type_value[2] is not None:
                     facility_types.add(facility_type_value[2])
-        facility.facility_type = list(facility_types)
-
-        # Use clean taxonomy values in the index for processing_type:
-        processing_type_values = facility_fields.filter(
-            field_name='processing_type',
-            value__has_key='matched_values') \
-            .values_list('value__matched_values', flat=True)
-        processing_types = set()
-        for values_list in processing_type_values:
-            for processing_type_value in values_list:
+        elif field_name == ExtendedField.PROCESSING_TYPE:
+            # Use clean taxonomy values in the index for processing_type:
+            if not isinstance(value, dict) or 'matched_values' not in value:
+                continue
+            for processing_type_value in value['matched_values']:
                 if processing_type_value[0] == 'PROCESSING_TYPE':
                     processing_types.add(processing_type_value[3])
-        facility.processing_type = list(processing_types)
-
-        # Use clean on product_type values:
-        product_type_raw_values = facility_fields.filter(
-            field_name='product_type',
-            value__has_key='raw_values') \
-            .values_list('value__raw_values', flat=True)
-        product_types = set()
-        for values_list in product_type_raw_values:
-            for product_type_raw_value in values_list:
+        elif field_name == ExtendedField.PRODUCT_TYPE:
+            # Use clean on product_type values:
+            if not isinstance(value, dict) or 'raw_values' not in value:
+                continue
+            for product_type_raw_value in value['raw_values']:
                 product_types.add(clean(product_type_raw_value))
-        facility.product_type = list(product_types)
+        elif field_name == ExtendedField.NATIVE_LANGUAGE_NAME:
+            # Use unidecode when indexing native_language_name:
+            native_language_names.add(unidecode(value))
+
+    return {
+        'parent_company_name': list(parent_company_name),
+        'parent_company_id': list(parent_company_id),
+        'number_of_workers': list(number_of_workers_ranges),
+        'facility_type': list(facility_types),
+        'processing_type': list(processing_types),
+        'product_type': list(product_types),
+        'native_language_name': list(native_language_names),
+    }
 
-        # Use unidecode when indexing native_language_name:
-        native_language_name = facility_fields.filter(
-            field_name='native_language_name') \
-            .values_list('value', flat=True)
-        native_language_names = set()
-        for name in native_language_name:
-            native_language_names.add(unidecode(name))
-        facility.native_language_name = list(native_language_names)
 
-        facility.save()
+@transaction.atomic
+def index_extendedfields(facility_ids=list):
+    # If passed an empty array, update all facilities (where applicable)
+    if len(facility_ids) == 0:
+        print('Indexing extended fields for all facilities...')
+        index_ids = FacilityIndex.objects.all()
+    else:
+        index_ids = FacilityIndex.objects.filter(id__in=facility_ids)
+    index_ids = index_ids.order_by('id').values_list('id', flat=True)
+    show_progress = (len(facility_ids) == 0
+                     or len(facility_ids) > INDEX_CHUNK_SIZE)
+    total = index_ids.count() if show_progress else None
+
+    # Read the extended fields of a chunk of facilities with one query,
+    # ordered by facility so that each facility's fields are grouped together,
+    # and write the chunk of index rows with one bulk update
+    indexed = 0
+    index_ids = index_ids.iterator()
+    while True:
+        chunk = list(islice(index_ids, INDEX_CHUNK_SIZE))
+        if len(chunk) == 0:
+            break
+        fields = ExtendedField.objects \
+            .filter(facility_id__in=chunk,
+                    value__isnull=False,
+                    field_name__in=[ExtendedField.PARENT_COMPANY,
+                                    ExtendedField.NUMBER_OF_WORKERS,
+                                    ExtendedField.FACILITY_TYPE,
+                                    ExtendedField.PROCESSING_TYPE,
+                                    ExtendedField.PRODUCT_TYPE,
+                                    ExtendedField.NATIVE_LANGUAGE_NAME]) \
+            .order_by('facility_id') \
+            .values_list('facility_id', 'field_name', 'value')
+        facility_fields = {
+            facility_id: [(field_name, value)
+                          for _, field_name, value in group]
+            for facility_id, group in groupby(fields, key=lambda f: f[0])}
+
+        FacilityIndex.objects.bulk_update(
+            [FacilityIndex(id=facility_id,
+                           **get_extendedfield_index_values(
+                               facility_fields.get(facility_id, [])))
+             for facility_id in chunk],
+            EXTENDED_FIELD_INDEX_FIELDS)
+
+        indexed += len(chunk)
+        if show_progress:
+            print('Indexed extended fields for {} of {} facilities'.format(
+                indexed, total))
 
 
 @transaction.atomic
@@ -2675,6 +2947,138 @@ def index_facilities(facility_ids=list):
     index_extendedfields(facility_ids)
 
 
+# The indexing functions that have been requested in the `batch_index_updates`
+# block running on the current thread, mapped to the facility IDs to index.
+_index_batch = threading.local()
+
+
+def queue_index_update(indexer, facility_ids):
+    """
+    Rebuild the index rows for the specified facilities with `indexer`, or,
+    if a `batch_index_updates` block is running, add the facilities to the
+    batch of updates made when the block exits.
+
+    Arguments:
+    indexer -- One of `index_facilities`, `index_custom_text` or
+               `index_extendedfields`.
+    facility_ids -- The IDs of the facilities to index.
+    """
+    updates = getattr(_index_batch, 'updates', None)
+    if updates is None:
+        indexer(facility_ids)
+    else:
+        updates[indexer].update(facility_ids)
+
+
+def run_index_updates(updates):
+    """
+    Run a batch of index updates collected by `batch_index_updates`. Facilities
+    that are fully reindexed by `index_facilities` are not passed to the
+    custom text and extended field indexers.
+
+    Arguments:
+    updates -- A dictionary mapping indexing functions to sets of facility IDs.
+    """
+    facility_ids = updates.get(index_facilities, set())
+    if len(facility_ids) > 0:
+        index_facilities(list(facility_ids))
+    for indexer in (index_custom_text, index_extendedfields):
+        indexer_facility_ids = updates.get(indexer, set()) - facility_ids
+        if len(indexer_facility_ids) > 0:
+            indexer(list(indexer_facility_ids))
+
+
+@contextmanager
+def batch_index_updates():
+    """
+    Collect the index updates requested by `post_save` handlers while the
+    block runs and make them when the outermost block exits, so that a
+    facility saved many times in the block is only reindexed once. Can be
+    used as a decorator. Should be used inside a transaction.
+
+    If the FACILITY_INDEX_MODE setting is 'deferred' the updates are handed to
+    a background thread when the transaction commits instead of being made
+    before the block exits.
+    """
+    if getattr(_index_batch, 'updates', None) is not None:
+        yield
+        return
+
+    _index_batch.updates = defaultdict(set)
+    try:
+        yield
+        updates = _index_batch.updates
+    finally:
+        _index_batch.updates = None
+
+    if settings.FACILITY_INDEX_MODE == 'deferred':
+        transaction.on_commit(lambda: FacilityIndexWorker.enqueue(updates))
+    else:
+        run_index_updates(updates)
+
+
+class FacilityIndexWorker:
+    """
+    Runs the batches of index updates deferred by `batch_index_updates` on a
+    background thread, merging batches that arrive while an update is running.
+    Updates still queued when the process exits are made before it exits.
+    """
+    _queue = queue.Queue()
+    _thread = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def enqueue(cls, updates):
+        cls._queue.put(updates)
+        with cls._lock:
+            if cls._thread is None or not cls._thread.is_alive():
+                cls._thread = threading.Thread(
+                    target=cls._run, name='facility-index', daemon=True)
+                cls._thread.start()
+
+    @classmethod
+    def flush(cls):
+        """
+        Wait until the updates that have been queued have been made.
+        """
+        with cls._lock:
+            running = cls._thread is not None and cls._thread.is_alive()
+        if running:
+            cls._queue.join()
+
+    @classmethod
+    def _run(cls):
+        while True:
+            updates = cls._queue.get()
+            batch_count = 1
+            try:
+                while True:
+                    for indexer, facility_ids in \
+                            cls._queue.get_nowait().items():
+                        updates[indexer].update(facility_ids)
+                    batch_count += 1
+            except queue.Empty:
+                pass
+
+            try:
+                with transaction.atomic():
+                    run_index_updates(updates)
+            except Exception:
+                logger.error('Failed to update facility index: {}'.format(
+                    traceback.format_exc()))
+            finally:
+                # Each thread has its own connection, which would otherwise
+                # be held open between updates
+                connection.close()
+                for _ in range(batch_count):
+                    cls._queue.task_done()
+
+
+# The worker thread is a daemon thread, which would otherwise be stopped with
+# its queued updates unmade when the process exits
+atexit.register(FacilityIndexWorker.flush)
+
+
 post_save.connect(Facility.post_save, sender=Facility)
 post_save.connect(Source.post_save, sender=Source)
 post_save.connect(FacilityMatch.post_save, sender=FacilityMatch)
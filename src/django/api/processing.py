@@ -3,21 +3,27 @@ import csv
 import traceback
 import sys
 
+from itertools import islice
 from openpyxl import load_workbook
-from openpyxl.utils import get_column_letter
 
 from datetime import datetime
 
 from django.conf import settings
 from django.contrib.gis.geos import Point
 from django.core.exceptions import ValidationError
+from django.utils import timezone
+from simple_history.utils import (bulk_create_with_history,
+                                  get_history_model_for_model)
 
 from api.constants import CsvHeaderField, ProcessingAction
-from api.models import Facility, FacilityMatch, FacilityListItem
+from api.models import (ExtendedField, Facility, FacilityMatch,
+                        FacilityListItem, batch_index_updates,
+                        index_facilities)
 from api.countries import COUNTRY_CODES, COUNTRY_NAMES
-from api.geocoding import geocode_address
+from api.geocoding import geocode_address, geocode_addresses
 from api.matching import normalize_extended_facility_id
 from api.helpers import clean
+from api.oar_id import make_oar_id
 from api.extended_fields import (create_extendedfields_for_listitem,
                                  update_extendedfields_for_list_item)
 
@@ -34,14 +40,14 @@ def _report_error_to_rollbar(file, request):
                 'file_name': file.name})
 
 
-def get_xlsx_sheet(file, request):
+def get_xlsx_sheet(file, request, read_only=False):
     import defusedxml
     from defusedxml.common import EntitiesForbidden
 
     defusedxml.defuse_stdlib()
 
     try:
-        wb = load_workbook(filename=file)
+        wb = load_workbook(filename=file, read_only=read_only)
         ws = wb[wb.sheetnames[0]]
 
         return ws
@@ -71,35 +77,72 @@ def format_cell_value(value):
 
 
 def parse_xlsx(file, request):
-    try:
-        ws = get_xlsx_sheet(file, request)
+    """
+    Read the header and rows of the first sheet of an Excel file.
 
-        # openpyxl package is 1-indexed
-        percent_col = [get_column_letter(cell.column)
-                       for cell in ws[2] if '%' in cell.number_format]
+    The sheet is opened in read-only mode and the rows are read as they are
+    consumed, so only the row being formatted is held in memory.
 
-        if percent_col:
-            for col in percent_col:
-                for cell in ws[col]:
-                    if cell.row != 1:
-                        cell.value = format_percent(cell.value)
+    Arguments:
+    file -- An uploaded .xlsx file.
+    request -- The request that uploaded the file.
 
-        header = ','.join([format_cell_value(cell.value) for cell in ws[1]])
+    Returns:
+    A tuple of the header, as a comma separated string, and a generator of
+    the non-empty rows, as comma separated strings of quoted values.
+    """
+    try:
+        ws = get_xlsx_sheet(file, request, read_only=True)
+        rows = ws.iter_rows()
+        header = ','.join([format_cell_value(cell.value)
+                           for cell in next(rows, [])])
+    except ValidationError:
+        raise
+    except Exception:
+        _report_error_to_rollbar(file, request)
+        raise ValidationError('Error parsing Excel (.xlsx) file')
 
-        rows = ['"{}"'.format(
-            '","'.join([format_cell_value(cell.value) for cell in ws[idx]]))
-                for idx in range(2, ws.max_row + 1)
-                if any(cell.value is not None for cell in ws[idx])]
+    return header, format_xlsx_rows(ws, rows, file, request)
 
-        return header, rows
+
+def format_xlsx_rows(ws, rows, file, request):
+    percent_cols = None
+    try:
+        for row in rows:
+            # The number format of the first row after the header determines
+            # which columns are formatted as percentages
+            if percent_cols is None:
+                # Empty cells in a read-only sheet have no number format
+                percent_cols = set(idx for idx, cell in enumerate(row)
+                                   if cell.number_format
+                                   and '%' in cell.number_format)
+            if all(cell.value is None for cell in row):
+                continue
+            yield '"{}"'.format('","'.join([
+                format_cell_value(format_percent(cell.value)
+                                  if idx in percent_cols else cell.value)
+                for idx, cell in enumerate(row)]))
     except Exception:
         _report_error_to_rollbar(file, request)
         raise ValidationError('Error parsing Excel (.xlsx) file')
+    finally:
+        # A workbook opened in read-only mode keeps the file open until it is
+        # closed
+        ws.parent.close()
 
 
 def parse_csv(file, request):
-    rows = []
+    """
+    Read the header and rows of a UTF-8 CSV file.
+
+    Arguments:
+    file -- An uploaded .csv file.
+    request -- The request that uploaded the file.
 
+    Returns:
+    A tuple of the header and a generator of the rows. Iterating an uploaded
+    file reads it in chunks, so the rows are decoded as they are consumed.
+    """
     try:
         header = file.readline().decode(encoding='utf-8-sig').rstrip()
     except UnicodeDecodeError:
@@ -107,16 +150,53 @@ def parse_csv(file, request):
         raise ValidationError('Unsupported file encoding. Please '
                               'submit a UTF-8 CSV.')
 
+    return header, decode_csv_rows(file, request)
+
+
+def decode_csv_rows(file, request):
+    # Iterating the file starts again from the beginning, so the first line
+    # is the header that has already been read
     for idx, line in enumerate(file):
         if idx > 0:
             try:
-                rows.append(line.decode(encoding='utf-8-sig').rstrip())
+                yield line.decode(encoding='utf-8-sig').rstrip()
             except UnicodeDecodeError:
                 _report_error_to_rollbar(file, request)
                 raise ValidationError('Unsupported file encoding. Please '
                                       'submit a UTF-8 CSV.')
 
-    return header, rows
+
+# The number of uploaded rows saved by each bulk insert
+FACILITY_LIST_ITEM_BATCH_SIZE = 1000
+
+
+def create_facility_list_items(source, rows,
+                               batch_size=FACILITY_LIST_ITEM_BATCH_SIZE):
+    """
+    Save a `FacilityListItem` for each row of an uploaded list, inserting
+    the items in batches as the rows are read so that only one batch of rows
+    and items is held in memory.
+
+    Arguments:
+    source -- The `Source` of the uploaded list.
+    rows -- An iterable of row strings, like the generators returned by
+            `parse_csv` and `parse_xlsx`.
+    batch_size -- The maximum number of items saved by each insert.
+
+    Returns:
+    The number of items saved.
+    """
+    rows = iter(rows)
+    row_index = 0
+    while True:
+        items = [FacilityListItem(row_index=row_index + idx,
+                                  raw_data=row,
+                                  source=source)
+                 for idx, row in enumerate(islice(rows, batch_size))]
+        if len(items) == 0:
+            return row_index
+        FacilityListItem.objects.bulk_create(items)
+        row_index += len(items)
 
 
 def parse_csv_line(line):
@@ -251,7 +331,17 @@ def parse_facility_list_item(item):
         })
 
 
-def geocode_facility_list_item(item):
+def geocode_facility_list_item(item, geocoded_data=None):
+    """
+    Geocode a parsed list item and record the result in its processing
+    results.
+
+    Arguments:
+    item -- A `FacilityListItem` in the PARSED status.
+    geocoded_data -- An optional result of geocoding the item's address,
+                     returned or raised by `GeocodingClient.geocode_batch`.
+                     The address is geocoded if it is not specified.
+    """
     started = str(datetime.utcnow())
     if type(item) != FacilityListItem:
         raise ValueError('Argument must be a FacilityListItem')
@@ -259,7 +349,12 @@ def geocode_facility_list_item(item):
         raise ValueError('Items to be geocoded must be in the PARSED status')
     try:
         if item.geocoded_point is None:
-            data = geocode_address(item.address, item.country_code)
+            if geocoded_data is None:
+                data = geocode_address(item.address, item.country_code)
+            elif isinstance(geocoded_data, Exception):
+                raise geocoded_data
+            else:
+                data = geocoded_data
             if data['result_count'] > 0:
                 item.status = FacilityListItem.GEOCODED
                 item.geocoded_point = Point(
@@ -300,6 +395,26 @@ def geocode_facility_list_item(item):
         })
 
 
+def geocode_list_item_addresses(items):
+    """
+    Geocode the addresses of the parsed list items that have not already been
+    geocoded, sending the requests for all of the items concurrently.
+
+    Arguments:
+    items -- A list of `FacilityListItem`s.
+
+    Returns:
+    A dictionary mapping item IDs to the `geocoded_data` argument to pass to
+    `geocode_facility_list_item` for each item
+    """
+    to_geocode = [item for item in items
+                  if item.status == FacilityListItem.PARSED
+                  and item.geocoded_point is None]
+    results = geocode_addresses([(item.address, item.country_code)
+                                 for item in to_geocode])
+    return {item.id: result for item, result in zip(to_geocode, results)}
+
+
 def reduce_matches(matches):
     """
     Process a list of facility match scores to remove duplicate facilities,
@@ -351,6 +466,50 @@ def is_string_match(item, facility):
             and clean(item.address) == clean(facility.address))
 
 
+def select_automatic_match(item, matches, automatic_threshold):
+    """
+    Mark at most one of the gazetteer matches for a list item as an automatic
+    match and update the status and facility of the item accordingly.
+
+    Arguments:
+    item -- The `FacilityListItem` that was matched.
+    matches -- A list of unsaved, pending `FacilityMatch` instances for the
+               item, as built from the reduced gazetteer matches.
+    automatic_threshold -- The minimum confidence score of an automatic match.
+    """
+    item.status = FacilityListItem.POTENTIAL_MATCH
+    if len(matches) == 1:
+        if matches[0].confidence >= automatic_threshold:
+            matches[0].status = FacilityMatch.AUTOMATIC
+            matches[0].results['match_type'] = 'single_gazetteer_match'
+            item.status = FacilityListItem.MATCHED
+            item.facility = matches[0].facility
+    else:
+        quality_matches = [m for m in matches
+                           if m.confidence > automatic_threshold]
+        if len(quality_matches) == 1:
+            matches[0].status = FacilityMatch.AUTOMATIC
+            matches[0].results['match_type'] = \
+                'one_gazetteer_match_greater_than_threshold'
+            item.status = FacilityListItem.MATCHED
+            item.facility = matches[0].facility
+        elif len(quality_matches) > 1:
+            exact_matches = [m for m in quality_matches
+                             if is_string_match(item, m.facility)]
+            # We check == 1 because multiple exact matches should not
+            # happen. They are an indication of duplicate facility data
+            # that should be merged through moderation tools. Showing the
+            # multiple potential matches to the contributor increases the
+            # visibility of the issue.
+            if len(exact_matches) == 1:
+                exact_matches[0].status = FacilityMatch.AUTOMATIC
+                exact_matches[0].results['match_type'] = \
+                    'multiple_gazetteer_matches_with_one_exact_string_match'
+                item.status = FacilityListItem.MATCHED
+                item.facility = exact_matches[0].facility
+
+
+@batch_index_updates()
 def save_match_details(match_results, text_only_matches=None):
     """
     Save the results of a call to match_facility_list_items by creating
@@ -392,39 +551,9 @@ def save_match_details(match_results, text_only_matches=None):
     all_matches = []
     for item_id, matches in item_matches.items():
         item = FacilityListItem.objects.get(id=item_id)
-        item.status = FacilityListItem.POTENTIAL_MATCH
         matches = [make_pending_match(item_id, facility_id, score.item())
                    for facility_id, score in reduce_matches(matches)]
-
-        if len(matches) == 1:
-            if matches[0].confidence >= automatic_threshold:
-                matches[0].status = FacilityMatch.AUTOMATIC
-                matches[0].results['match_type'] = 'single_gazetteer_match'
-                item.status = FacilityListItem.MATCHED
-                item.facility = matches[0].facility
-        else:
-            quality_matches = [m for m in matches
-                               if m.confidence > automatic_threshold]
-            if len(quality_matches) == 1:
-                matches[0].status = FacilityMatch.AUTOMATIC
-                matches[0].results['match_type'] = \
-                    'one_gazetteer_match_greater_than_threshold'
-                item.status = FacilityListItem.MATCHED
-                item.facility = matches[0].facility
-            elif len(quality_matches) > 1:
-                exact_matches = [m for m in quality_matches
-                                 if is_string_match(item, m.facility)]
-                # We check == 1 because multiple exact matches should not
-                # happen. They are an indication of duplicate facility data
-                # that should be merged through moderation tools. Showing the
-                # multiple potential matches to the contributor increases the
-                # visibility of the issue.
-                if len(exact_matches) == 1:
-                    exact_matches[0].status = FacilityMatch.AUTOMATIC
-                    exact_matches[0].results['match_type'] = \
-                        'multiple_gazetteer_matches_with_one_exact_string_match' # NOQA
-                    item.status = FacilityListItem.MATCHED
-                    item.facility = exact_matches[0].facility
+        select_automatic_match(item, matches, automatic_threshold)
 
         item.processing_results.append({
             'action': ProcessingAction.MATCH,
@@ -549,6 +678,263 @@ def save_match_details(match_results, text_only_matches=None):
     return all_matches
 
 
+def assign_new_facility_ids(facilities):
+    """
+    Set a new OAR ID on each of the unsaved facilities. The candidate IDs for
+    all of the facilities are checked for collisions with a single query, and
+    new candidates are only generated for the facilities that collided.
+
+    Arguments:
+    facilities -- A list of unsaved `Facility` instances.
+    """
+    assigned_ids = set()
+    unassigned = list(facilities)
+    while len(unassigned) > 0:
+        for facility in unassigned:
+            facility.id = make_oar_id(facility.country_code)
+        existing_ids = set(
+            Facility.objects
+            .filter(id__in=[facility.id for facility in unassigned])
+            .values_list('id', flat=True))
+        collisions = []
+        for facility in unassigned:
+            if facility.id in existing_ids or facility.id in assigned_ids:
+                collisions.append(facility)
+            else:
+                assigned_ids.add(facility.id)
+        unassigned = collisions
+
+
+def bulk_update_with_history(objs, model, fields, batch_size=None):
+    """
+    Update the specified fields of the objects with `bulk_update` and create a
+    history record for each of them. `bulk_update` does not send the
+    `post_save` signal that `HistoricalRecords` uses to create history records
+    when a model is saved.
+
+    Arguments:
+    objs -- A list of saved instances of `model`.
+    model -- A model class that has `HistoricalRecords`.
+    fields -- The names of the fields to update.
+    batch_size -- The maximum number of rows written by each query.
+    """
+    if len(objs) == 0:
+        return
+    model.objects.bulk_update(objs, fields, batch_size=batch_size)
+
+    history_model = get_history_model_for_model(model)
+    history_date = timezone.now()
+    history_model.objects.bulk_create([
+        history_model(
+            history_date=history_date,
+            history_user=None,
+            history_change_reason='',
+            history_type='~',
+            **{field.attname: getattr(obj, field.attname)
+               for field in obj._meta.fields
+               if field.name not in history_model._history_excluded_fields})
+        for obj in objs], batch_size=batch_size)
+
+
+def bulk_save_match_details(match_results, text_only_matches=None,
+                            batch_size=1000):
+    """
+    Save the results of a call to match_facility_list_items in the same way
+    as `save_match_details`, but build all of the new Facility and
+    FacilityMatch instances and the updates to the affected FacilityListItems
+    in memory and write them with bulk queries. History records are created
+    for the facilities, matches and extended fields that are written.
+
+    Bulk queries do not send the `post_save` signals that reindex a facility
+    each time it or one of its matches is saved, so all of the affected
+    facilities are reindexed with a single call to `index_facilities` after
+    the writes.
+
+    Should be called in a transaction to ensure that all the updates are
+    applied atomically.
+
+    Arguments:
+    match_results -- The dict return value from a call to
+                     match_facility_list_items.
+    text_only_matches -- An optional object where keys are FacilityListItem
+                         IDs and values are a list of facilities that were
+                         matched to the item without dedupe which should be
+                         saved as pending matches.
+    batch_size -- The maximum number of rows written by each bulk query.
+
+    Returns:
+    The list of `FacilityMatch` objects created
+    """
+    if text_only_matches is None:
+        text_only_matches = {}
+    processed_list_item_ids = match_results['processed_list_item_ids']
+    item_matches = match_results['item_matches']
+    results = match_results['results']
+    started = match_results['started']
+    finished = match_results['finished']
+
+    automatic_threshold = results['automatic_threshold']
+
+    # Each match gets its own copy of the results because the match type is
+    # set per match and the matches are not serialized until they are written
+    def make_pending_match(item, facility, score):
+        return FacilityMatch(
+            facility_list_item=item,
+            facility=facility,
+            confidence=score,
+            status=FacilityMatch.PENDING,
+            results=copy.copy(results))
+
+    items = FacilityListItem.objects \
+                            .select_related('source') \
+                            .in_bulk(processed_list_item_ids)
+    # Candidates found through confirmed matches have extended IDs, which
+    # `reduce_matches` converts back to plain facility IDs
+    facilities = Facility.objects.in_bulk(list(set(
+        normalize_extended_facility_id(facility_id)
+        for matches in item_matches.values()
+        for facility_id, score in matches)))
+
+    all_matches = []
+    new_matches = []
+    updated_facilities = {}
+    for item_id, matches in item_matches.items():
+        item = items[int(item_id)]
+        matches = [make_pending_match(item, facilities[facility_id],
+                                      score.item())
+                   for facility_id, score in reduce_matches(matches)
+                   if facility_id in facilities]
+        select_automatic_match(item, matches, automatic_threshold)
+
+        item.processing_results.append({
+            'action': ProcessingAction.MATCH,
+            'started_at': started,
+            'error': False,
+            'finished_at': finished
+        })
+
+        if item.source.create:
+            new_matches.extend(matches)
+            for m in matches:
+                if m.status == FacilityMatch.AUTOMATIC:
+                    if m.facility.conditionally_set_ppe(item):
+                        updated_facilities[m.facility.id] = m.facility
+
+        all_matches.extend(matches)
+
+    matched_item_ids = set(int(item_id) for item_id in item_matches.keys())
+    new_facility_items = []
+    for item in items.values():
+        if item.id in matched_item_ids:
+            continue
+        has_text_only_matches = (
+            item.id in text_only_matches
+            and len(text_only_matches[item.id]) > 0)
+        if has_text_only_matches:
+            text_only_results = copy.deepcopy(results)
+            text_only_results['text_only_match'] = True
+            text_only_match_objects = [
+                FacilityMatch(
+                    facility_list_item=item,
+                    facility_id=facility.id,
+                    confidence=0,
+                    status=FacilityMatch.PENDING,
+                    results=text_only_results)
+                for facility in text_only_matches[item.id]]
+            if item.source.create:
+                new_matches.extend(text_only_match_objects)
+            all_matches.extend(text_only_match_objects)
+
+            item.status = FacilityListItem.POTENTIAL_MATCH
+            item.processing_results.append({
+                'action': ProcessingAction.MATCH,
+                'started_at': started,
+                'error': False,
+                'text_only_match': True,
+                'finished_at': finished
+            })
+        elif item.status == FacilityListItem.GEOCODED_NO_RESULTS:
+            item.status = FacilityListItem.ERROR_MATCHING
+            item.processing_results.append({
+                'action': ProcessingAction.MATCH,
+                'started_at': started,
+                'error': True,
+                'message': ('No match to an existing facility and cannot '
+                            'create a new facility without a geocode result'),
+                'finished_at': finished
+            })
+        else:
+            if item.source.create:
+                new_facility_items.append(item)
+            item.status = FacilityListItem.MATCHED
+            item.processing_results.append({
+                'action': ProcessingAction.MATCH,
+                'started_at': started,
+                'error': False,
+                'finished_at': finished
+            })
+
+    new_facilities = [
+        Facility(name=item.name,
+                 address=item.address,
+                 country_code=item.country_code,
+                 location=item.geocoded_point,
+                 created_from=item,
+                 ppe_product_types=item.ppe_product_types,
+                 ppe_contact_phone=item.ppe_contact_phone,
+                 ppe_contact_email=item.ppe_contact_email,
+                 ppe_website=item.ppe_website)
+        for item in new_facility_items]
+    assign_new_facility_ids(new_facilities)
+    for item, facility in zip(new_facility_items, new_facilities):
+        match = make_pending_match(item, facility, 1.0)
+        match.results['match_type'] = 'no_gazetteer_match'
+        match.status = FacilityMatch.AUTOMATIC
+        new_matches.append(match)
+        item.facility = facility
+
+    now = timezone.now()
+    bulk_create_with_history(new_facilities, Facility, batch_size=batch_size)
+    bulk_create_with_history(new_matches, FacilityMatch,
+                             batch_size=batch_size)
+    updated_facilities = list(updated_facilities.values())
+    for facility in updated_facilities:
+        facility.updated_at = now
+    bulk_update_with_history(
+        updated_facilities, Facility,
+        ['ppe_product_types', 'ppe_contact_phone', 'ppe_contact_email',
+         'ppe_website', 'updated_at'],
+        batch_size=batch_size)
+
+    items = list(items.values())
+    for item in items:
+        item.updated_at = now
+    FacilityListItem.objects.bulk_update(
+        items, ['status', 'facility', 'processing_results', 'updated_at'],
+        batch_size=batch_size)
+
+    item_facility_ids = {item.id: item.facility_id for item in items
+                         if item.facility_id is not None}
+    extended_fields = list(ExtendedField.objects.filter(
+        facility_list_item_id__in=item_facility_ids.keys()))
+    for extended_field in extended_fields:
+        extended_field.facility_id = \
+            item_facility_ids[extended_field.facility_list_item_id]
+        extended_field.updated_at = now
+    bulk_update_with_history(extended_fields, ExtendedField,
+                             ['facility', 'updated_at'],
+                             batch_size=batch_size)
+
+    facility_ids = (set(m.facility_id for m in new_matches)
+                    | set(f.id for f in updated_facilities)
+                    | set(item_facility_ids.values()))
+    if len(facility_ids) > 0:
+        index_facilities(list(facility_ids))
+
+    return all_matches
+
+
+@batch_index_updates()
 def save_exact_match_details(exact_results):
     """
     Save the results of a call to identify_exact_matches by creating
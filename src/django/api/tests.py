@@ -1,17 +1,26 @@
 import json
+import mercantile
 from unittest import skip
 import numpy as np
 import os
+import tempfile
+import threading
+import time
 
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from unittest.mock import Mock, patch
+from io import BytesIO, StringIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from django.core import mail
+from django.core.management import call_command
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase, override_settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib import auth
 from django.conf import settings
@@ -35,18 +44,41 @@ from api.models import (Facility, FacilityList, FacilityListItem,
                         ApiLimit, ApiBlock, ContributorNotifications,
                         EmbedConfig, EmbedField, NonstandardField,
                         FacilityActivityReport, ExtendedField, FacilityIndex,
-                        index_custom_text)
+                        TrainingSampleItem, index_custom_text,
+                        batch_index_updates, get_extendedfield_index_values,
+                        EXTENDED_FIELD_INDEX_FIELDS, GeocodingCacheEntry,
+                        FacilityGridCell, FacilityIndexWorker)
 
 from api.oar_id import make_oar_id, validate_oar_id
+from api.helpers import clean, clean_values
+from api.management.commands.benchmark_clean import clean_with_regexes
+from api.checks import _check_gazetteercache
 from api.matching import (match_facility_list_items, GazetteerCache,
-                          sort_exact_matches)
+                          sort_exact_matches, exact_match_items,
+                          filter_existing_facility_matches,
+                          match_detail_to_extended_facility_id,
+                          stream_match_facility_list_items,
+                          refresh_training_sample,
+                          get_messy_items_for_training,
+                          TRAINING_SAMPLE_EXCLUDED_STATUSES,
+                          ShardedGazetteer)
 from api.processing import (parse_facility_list_item,
                             geocode_facility_list_item,
                             reduce_matches, is_string_match,
-                            save_match_details)
+                            save_match_details, bulk_save_match_details,
+                            create_facility_list_items)
 from api.geocoding import (create_geocoding_params,
                            format_geocoded_address_data,
-                           geocode_address)
+                           geocode_address, geocode_addresses,
+                           GeocodingClient, TokenBucket)
+from api.facility_point_store import (FacilityPointStore,
+                                      encode_point_mvt_layer,
+                                      get_facility_point_store)
+from api.tiler import (get_facility_grid_vector_tile, get_hex_dimensions,
+                       is_unfiltered_grid, GRID_CELL_ZOOMS)
+from api.tile_cache import (make_tile_cache_key, DiskTileCache,
+                            MemoryTileCache, TileCache, TILE_CACHE_HIT,
+                            TILE_CACHE_MISS, TILE_CACHE_COALESCED)
 from api.test_data import parsed_city_hall_data
 from api.permissions import referring_host_is_allowed, referring_host
 from api.serializers import (ApprovedFacilityClaimSerializer,
@@ -179,6 +211,32 @@ class FacilityListCreateTest(APITestCase):
         self.assertEqual(items[0].raw_data, '"{}"'.format(
             '","'.join([cell.value for cell in ws[2]])))
 
+    def test_xlsx_percent_columns_and_empty_rows(self):
+        wb = Workbook()
+        ws = wb.active
+        ws.append(['country', 'name', 'address', 'share'])
+        ws.append(['US', 'Somewhere', '999 Park St', 0.25])
+        ws['D2'].number_format = '0%'
+        ws.append([None, None, None, None])
+        ws.append(['US', 'Someplace Else', '1234 Main St', 0.5])
+        xlsx = BytesIO()
+        wb.save(xlsx)
+        xlsx_file = SimpleUploadedFile(
+            'percent.xlsx',
+            xlsx.getvalue(),
+            content_type='application/vnd.openxmlformats-'
+                         'officedocument.spreadsheetml.sheet')
+        response = self.client.post(reverse('facility-list-list'),
+                                    {'file': xlsx_file},
+                                    format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        new_list = FacilityList.objects.get(id=response.json()['id'])
+        self.assertEqual('country,name,address,share', new_list.header)
+        items = new_list.source.facilitylistitem_set.order_by('row_index')
+        self.assertEqual(['"US","Somewhere","999 Park St","25%"',
+                          '"US","Someplace Else","1234 Main St","50%"'],
+                         [item.raw_data for item in items])
+
     def test_file_required(self):
         response = self.client.post(reverse('facility-list-list'))
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -457,6 +515,49 @@ class FacilityListItemParseTest(ProcessingTestCase):
         self.assertEqual('ppe@example.com', item.ppe_contact_email)
         self.assertEqual('https://example.com/ppe', item.ppe_website)
 
+    def test_batch_process_parses_in_chunks(self):
+        facility_list = FacilityList.objects.create(
+            header='address,country,name')
+        source = Source.objects.create(
+            source_type=Source.LIST,
+            facility_list=facility_list)
+        for index, raw_data in enumerate(['1234 main st,de,Shirts!',
+                                          '1234 main st,Unknownistan,Hats',
+                                          '1234 main st,ChInA,Shoes']):
+            FacilityListItem.objects.create(raw_data=raw_data,
+                                            row_index=index,
+                                            source=source)
+
+        out = StringIO()
+        call_command('batch_process', '--action', ProcessingAction.PARSE,
+                     '--list-id', str(facility_list.id), '--chunk-size', '2',
+                     stdout=out)
+
+        items = source.facilitylistitem_set.order_by('row_index')
+        self.assertEqual([FacilityListItem.PARSED,
+                          FacilityListItem.ERROR_PARSING,
+                          FacilityListItem.PARSED],
+                         [item.status for item in items])
+        self.assertEqual('DE', items[0].country_code)
+        self.assertEqual('CN', items[2].country_code)
+        output = out.getvalue()
+        self.assertEqual(2, output.count('processed chunk'))
+        self.assertIn('2 successes', output)
+        self.assertIn('1 failures', output)
+
+    def test_create_facility_list_items_in_batches(self):
+        facility_list = FacilityList.objects.create(
+            header='address,country,name')
+        source = Source.objects.create(
+            source_type=Source.LIST,
+            facility_list=facility_list)
+        rows = ('{} main st,de,Shirts!'.format(i) for i in range(5))
+        self.assertEqual(
+            5, create_facility_list_items(source, rows, batch_size=2))
+        items = source.facilitylistitem_set.order_by('row_index')
+        self.assertEqual([0, 1, 2, 3, 4], [item.row_index for item in items])
+        self.assertEqual('4 main st,de,Shirts!', items[4].raw_data)
+
     def test_ppe_product_type_empty_values(self):
         facility_list = FacilityList.objects.create(
             header='address,country,name,ppe_product_types')
@@ -691,7 +792,7 @@ geocoding_data_second_country = {
 
 
 class GeocodingTest(TestCase):
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_geocode_response_contains_expected_keys(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = geocoding_data
@@ -702,7 +803,7 @@ class GeocodingTest(TestCase):
         self.assertIn('lat', geocoded_data['geocoded_point'])
         self.assertIn('lng', geocoded_data['geocoded_point'])
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_ungeocodable_address_returns_zero_resusts(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = {'results': [],
@@ -710,7 +811,7 @@ class GeocodingTest(TestCase):
         results = geocode_address('@#$^@#$^', 'XX')
         self.assertEqual(0, results['result_count'])
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_incorrect_country_code_raises_error(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = geocoding_data
@@ -725,7 +826,7 @@ class GeocodingTest(TestCase):
              "provided country code of IN.",)
         )
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_accepts_inexact_address(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = geocoding_data_no_country
@@ -740,7 +841,7 @@ class GeocodingTest(TestCase):
         self.assertEqual(expected_point, results["geocoded_point"])
         self.assertEqual(expected_address, results['geocoded_address'])
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_accepts_alternate_address(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = geocoding_data_second_country
@@ -754,12 +855,160 @@ class GeocodingTest(TestCase):
         self.assertEqual(expected_point, results["geocoded_point"])
         self.assertEqual(expected_address, results['geocoded_address'])
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_geocode_non_200_response(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=400)
         with self.assertRaisesRegexp(ValueError, '400'):
             geocode_address('Noorbagh, Kaliakoir Gazipur Dhaka 1704', 'BD')
 
+    @patch('api.geocoding.requests.Session.get')
+    def test_geocode_error_status_is_not_cached(self, mock_get):
+        mock_get.return_value = Mock(ok=True, status_code=200)
+        mock_get.return_value.json.return_value = {
+            'results': [], 'status': 'REQUEST_DENIED'}
+        with self.assertRaisesRegexp(ValueError, 'REQUEST_DENIED'):
+            geocode_address('990 Spring Garden St, Philly', 'US')
+        self.assertEqual(0, GeocodingCacheEntry.objects.count())
+
+        mock_get.return_value.json.return_value = geocoding_data
+        result = geocode_address('990 Spring Garden St, Philly', 'US')
+        self.assertEqual(1, result['result_count'])
+        self.assertEqual(2, mock_get.call_count)
+
+    @patch('api.geocoding.requests.Session.get')
+    def test_geocode_address_uses_cache(self, mock_get):
+        mock_get.return_value = Mock(ok=True, status_code=200)
+        mock_get.return_value.json.return_value = geocoding_data
+        result = geocode_address('990 Spring Garden St, Philly', 'US')
+        cached_result = geocode_address('990 spring garden st philly', 'US')
+
+        self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(result, cached_result)
+        entry = GeocodingCacheEntry.objects.get()
+        self.assertEqual('990 spring garden st philly', entry.address)
+        self.assertEqual(1, entry.hit_count)
+
+    @patch('api.geocoding.requests.Session.get')
+    def test_geocode_address_ignores_expired_cache_entries(self, mock_get):
+        mock_get.return_value = Mock(ok=True, status_code=200)
+        mock_get.return_value.json.return_value = geocoding_data
+        geocode_address('990 Spring Garden St, Philly', 'US')
+        GeocodingCacheEntry.objects.update(
+            created_at=timezone.now() - timedelta(
+                days=settings.GEOCODING_CACHE_TTL_IN_DAYS + 1))
+
+        geocode_address('990 Spring Garden St, Philly', 'US')
+
+        self.assertEqual(2, mock_get.call_count)
+        entry = GeocodingCacheEntry.objects.get()
+        self.assertEqual(0, entry.hit_count)
+
+    @override_settings(GEOCODING_CACHE_TTL_IN_DAYS=0)
+    @patch('api.geocoding.requests.Session.get')
+    def test_geocode_address_without_cache(self, mock_get):
+        mock_get.return_value = Mock(ok=True, status_code=200)
+        mock_get.return_value.json.return_value = geocoding_data
+        geocode_address('990 Spring Garden St, Philly', 'US')
+        geocode_address('990 Spring Garden St, Philly', 'US')
+
+        self.assertEqual(2, mock_get.call_count)
+        self.assertEqual(0, GeocodingCacheEntry.objects.count())
+
+    @patch('api.geocoding.requests.Session.get')
+    def test_geocode_addresses_uses_cache(self, mock_get):
+        mock_get.return_value = Mock(ok=True, status_code=200)
+        mock_get.return_value.json.return_value = geocoding_data
+        geocode_address('990 Spring Garden St, Philly', 'US')
+
+        results = geocode_addresses([
+            ('990 Spring Garden St, Philly', 'US'),
+            ('990 Spring Garden Street, Philly', 'US'),
+            ('990 Spring Garden Street, Philly', 'US'),
+            ('Datong Bridge, Tirupur', 'IN')])
+
+        self.assertEqual(3, mock_get.call_count)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1], results[2])
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual(2, GeocodingCacheEntry.objects.count())
+
+
+class GeocodingStubServerTest(TestCase):
+    def start_stub_server(self, responses):
+        """
+        Start a local HTTP server that replies to successive requests with
+        the specified (status code, JSON body) tuples, repeating the last
+        one, and return its URL and the list of requests it receives.
+        """
+        responses = list(responses)
+        received = []
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    received.append(self.path)
+                    status_code, body = (responses.pop(0)
+                                         if len(responses) > 1
+                                         else responses[0])
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('localhost', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://localhost:{}/'.format(server.server_port), received
+
+    def test_retries_server_errors_and_query_limits(self):
+        url, received = self.start_stub_server([
+            (500, {}),
+            (200, {'results': [], 'status': 'OVER_QUERY_LIMIT'}),
+            (200, {'results': [], 'status': 'UNKNOWN_ERROR'}),
+            (200, geocoding_data)])
+        client = GeocodingClient(url=url, backoff=0, max_retries=3)
+
+        result = client.geocode('990 Spring Garden St, Philly', 'US')
+
+        self.assertEqual(4, len(received))
+        self.assertEqual(
+            geocoding_data['results'][0]['formatted_address'],
+            result['geocoded_address'])
+
+    def test_raises_after_max_retries(self):
+        url, received = self.start_stub_server([(503, {})])
+        client = GeocodingClient(url=url, backoff=0, max_retries=2)
+
+        with self.assertRaisesRegexp(ValueError, '503'):
+            client.geocode('990 Spring Garden St, Philly', 'US')
+        self.assertEqual(3, len(received))
+
+    def test_geocode_batch(self):
+        url, received = self.start_stub_server([(200, geocoding_data)])
+        client = GeocodingClient(url=url, backoff=0, concurrency=4)
+
+        results = client.geocode_batch(
+            [('990 Spring Garden St, Philly', 'US')] * 5
+            + [('Datong Bridge, Tirupur', 'IN')])
+
+        self.assertEqual(6, len(received))
+        self.assertEqual(6, len(results))
+        for result in results[:5]:
+            self.assertEqual(1, result['result_count'])
+        self.assertIsInstance(results[5], ValueError)
+
+    def test_token_bucket_limits_rate(self):
+        bucket = TokenBucket(rate=100, capacity=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
 
 class FacilityAndProcessingTypeTest(TestCase):
     def test_exact_processing_type_match(self):
@@ -945,7 +1194,7 @@ class FacilityListItemGeocodingTest(ProcessingTestCase):
             ('Items to be geocoded must be in the PARSED status',),
         )
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_nested_correct_country_code_succeeds(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = listitem_geocode_data
@@ -969,7 +1218,7 @@ class FacilityListItemGeocodingTest(ProcessingTestCase):
         self.assertEqual(item.geocoded_address, expected_address)
         self.assertIsInstance(item.geocoded_point, Point)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_incorrect_country_code_has_error_status(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = listitem_geocode_data
@@ -1030,6 +1279,67 @@ class FacilityListItemGeocodingTest(ProcessingTestCase):
         self.assertIsNone(item.geocoded_point)
 
 
+class RunPipelineTest(TransactionTestCase):
+    fixtures = ['users', 'contributors']
+
+    def setUp(self):
+        facility_list = FacilityList.objects.create(
+            name='test', header='address,country,name')
+        self.source = Source.objects.create(
+            source_type=Source.LIST,
+            facility_list=facility_list,
+            contributor=Contributor.objects.first())
+        for index, raw_data in enumerate(['990 Spring Garden St,us,Shirts',
+                                          '990 Spring Garden,Unknownistan,'
+                                          'Hats']):
+            FacilityListItem.objects.create(raw_data=raw_data,
+                                            row_index=index,
+                                            source=self.source)
+        # An item that was geocoded before the pipeline was interrupted
+        FacilityListItem.objects.create(
+            raw_data='', row_index=2, source=self.source,
+            status=FacilityListItem.GEOCODED_NO_RESULTS, country_code='US',
+            name='Shoes', address='Nowhere')
+
+    def tearDown(self):
+        GazetteerCache._gazetter = None
+        GazetteerCache._facility_version = None
+        GazetteerCache._match_version = None
+
+    @patch('api.geocoding.requests.Session.get')
+    def test_runs_all_stages_and_resumes(self, mock_get):
+        mock_get.return_value = Mock(ok=True, status_code=200)
+        mock_get.return_value.json.return_value = geocoding_data
+
+        out = StringIO()
+        call_command('run_pipeline', '--list-id',
+                     str(self.source.facility_list.id), '--chunk-size', '1',
+                     stdout=out)
+
+        items = self.source.facilitylistitem_set.order_by('row_index')
+        self.assertEqual([FacilityListItem.MATCHED,
+                          FacilityListItem.ERROR_PARSING,
+                          FacilityListItem.ERROR_MATCHING],
+                         [item.status for item in items])
+        self.assertEqual(1, Facility.objects.count())
+        self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(1, len(mail.outbox))
+        output = out.getvalue()
+        self.assertIn('parse: 1 successes', output)
+        self.assertIn('parse: 1 failures', output)
+        self.assertIn('geocode: 1 successes', output)
+        self.assertIn('match: 2 successes', output)
+
+        # Items that completed every stage are not processed again
+        out = StringIO()
+        call_command('run_pipeline', '--list-id',
+                     str(self.source.facility_list.id), stdout=out)
+        self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(1, Facility.objects.count())
+        self.assertEqual(1, len(mail.outbox))
+        self.assertNotIn('successes', out.getvalue())
+
+
 class FacilityNamesAddressesAndContributorsTest(TestCase):
     def setUp(self):
         self.name_one = 'name_one'
@@ -1703,6 +2013,75 @@ class DedupeMatchingTests(TestCase):
         self.assertFalse(result['results']['no_gazetteer_matches'])
         self.assertFalse(result['results']['no_geocoded_items'])
 
+    @override_settings(GAZETTEER_SHARD_BY_COUNTRY=True)
+    def test_matches_with_country_shards(self):
+        facility = Facility.objects.first()
+        facility_list = self.create_list([
+            (facility.country_code, facility.name.upper(),
+             junk_chars(facility.address.upper())),
+            ('XX', facility.name.upper(),
+             junk_chars(facility.address.upper()))])
+        [item, other_country_item] = \
+            facility_list.source.facilitylistitem_set.order_by('row_index')
+        result = match_facility_list_items(facility_list)
+
+        gazetteer = GazetteerCache._gazetter
+        self.assertIsInstance(gazetteer, ShardedGazetteer)
+        self.assertEqual(
+            set(c.lower() for c in Facility.objects.values_list(
+                'country_code', flat=True)),
+            set(gazetteer.shards.keys()))
+
+        matches = result['item_matches']
+        self.assertEqual(str(facility.id), matches[str(item.id)][0][0])
+        self.assertNotIn(str(other_country_item.id), matches)
+
+    def test_matches_with_gazetteer_snapshot(self):
+        facility = Facility.objects.first()
+        facility_list = self.create_list([
+            (facility.country_code, facility.name.upper(),
+             junk_chars(facility.address.upper()))])
+        item_id = str(facility_list.source.facilitylistitem_set.all()[0].id)
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            path = os.path.join(snapshot_dir, 'gazetteer.snapshot')
+            header = GazetteerCache.write_snapshot(path)
+            self.assertTrue(os.path.exists(path))
+
+            GazetteerCache._gazetter = None
+            GazetteerCache._facility_version = None
+            GazetteerCache._match_version = None
+
+            with override_settings(GAZETTEER_SNAPSHOT_PATH=path):
+                with patch('api.matching.train_gazetteer') as mock_train:
+                    result = match_facility_list_items(facility_list)
+                    mock_train.assert_not_called()
+
+            self.assertEqual(header['facility_version'],
+                             GazetteerCache._facility_version)
+            matches = result['item_matches']
+            self.assertIn(item_id, matches)
+            self.assertEqual(str(facility.id), matches[item_id][0][0])
+
+    def test_does_not_load_stale_gazetteer_snapshot(self):
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            path = os.path.join(snapshot_dir, 'gazetteer.snapshot')
+            GazetteerCache.write_snapshot(path)
+            GazetteerCache._gazetter = None
+
+            with override_settings(GAZETTEER_SNAPSHOT_PATH=path):
+                with override_settings(GIT_COMMIT='other'):
+                    self.assertIsNone(GazetteerCache._load_snapshot())
+                with patch('api.matching.training_data_hash',
+                           return_value='other'):
+                    self.assertIsNone(GazetteerCache._load_snapshot())
+                self.assertIsNotNone(GazetteerCache._load_snapshot())
+
+                # A stale snapshot is replaced
+                with override_settings(GIT_COMMIT='other'):
+                    GazetteerCache._write_snapshot_if_stale()
+                    self.assertIsNotNone(GazetteerCache._load_snapshot())
+
     def assert_match_count_after_delete(
             self, delete_facility=True, match_count=0):
         # First create a list and match it. We use a multiple item list so that
@@ -1751,6 +2130,215 @@ class DedupeMatchingTests(TestCase):
         self.assert_match_count_after_delete(
             delete_facility=False, match_count=1)
 
+    @override_settings(GAZETTEER_REFRESH_INTERVAL_IN_SECONDS=3600,
+                       GAZETTEER_MAX_STALENESS_IN_SECONDS=3600)
+    def test_current_does_not_wait_for_refresh(self):
+        with patch.object(GazetteerCache, 'start_refresh_thread'):
+            gazetteer = GazetteerCache.current()
+            facility = Facility.objects.first()
+            facility_id = str(facility.id)
+            facility.name = 'Renamed Facility'
+            facility.save()
+
+            with self.assertNumQueries(0):
+                self.assertIs(gazetteer, GazetteerCache.current())
+
+            refreshed = GazetteerCache.get_latest()
+            self.assertIsNot(gazetteer, refreshed)
+            self.assertIs(refreshed, GazetteerCache.current())
+            self.assertEqual('renamed facility',
+                             refreshed.live_records()[facility_id]['name'])
+            self.assertNotEqual('renamed facility',
+                                gazetteer.live_records()[facility_id]['name'])
+            self.assertLess(GazetteerCache.index_stats()['staleness_seconds'],
+                            3600)
+
+    @patch('api.matching.GazetteerCache.current')
+    def test_health_check_before_gazetteer_is_loaded(self, mock_current):
+        mock_current.return_value = None
+        self.assertEqual({'ok': True}, _check_gazetteercache())
+
+    @override_settings(GAZETTEER_COMPACTION_RATIO=None)
+    def test_applies_latest_history_row_in_place(self):
+        gazetteer = GazetteerCache.get_latest()
+        stale_records = GazetteerCache.index_stats()['stale_records']
+        facility = Facility.objects.first()
+        for name in ['First Name', 'Second Name', 'Renamed Facility']:
+            facility.name = name
+            facility.save()
+
+        self.assertIs(gazetteer, GazetteerCache.get_latest())
+        self.assertEqual(
+            'renamed facility',
+            gazetteer.live_records()[str(facility.id)]['name'])
+        self.assertEqual(stale_records + 1,
+                         GazetteerCache.index_stats()['stale_records'])
+        self.assertEqual(
+            Facility.history.order_by('-history_id')[0].history_id,
+            GazetteerCache._facility_version)
+
+    def test_polls_history_with_one_query(self):
+        GazetteerCache.get_latest()
+        match = FacilityMatch.objects.first()
+        match.status = FacilityMatch.CONFIRMED
+        match.is_active = True
+        match.save()
+
+        with self.assertNumQueries(1):
+            GazetteerCache.get_latest()
+        self.assertEqual(
+            FacilityMatch.history.order_by('-history_id')[0].history_id,
+            GazetteerCache._match_version)
+        self.assertEqual(
+            match_detail_to_extended_facility_id(match.facility_id, match.id),
+            GazetteerCache._match_record_ids[match.id])
+
+        with self.assertNumQueries(1):
+            GazetteerCache.get_latest()
+
+    def test_removes_deleted_facility_from_index(self):
+        gazetteer = GazetteerCache.get_latest()
+        facility = Facility.objects.first()
+        facility_id = str(facility.id)
+        self.assertIn(facility_id, gazetteer.record_ids())
+        indexed_records = GazetteerCache.index_stats()['indexed_records']
+
+        for item in FacilityListItem.objects.filter(facility=facility):
+            item.facility = None
+            item.save()
+        for match in FacilityMatch.objects.filter(facility=facility):
+            match.delete()
+        facility.delete()
+
+        gazetteer = GazetteerCache.get_latest()
+        self.assertEqual(
+            [], [record_id for record_id in gazetteer.record_ids()
+                 if record_id.startswith(facility_id)])
+        stats = GazetteerCache.index_stats()
+        self.assertLess(stats['indexed_records'], indexed_records)
+        self.assertEqual(indexed_records - stats['indexed_records'],
+                         stats['stale_records'])
+
+    def test_stream_matches_in_chunks(self):
+        facilities = Facility.objects.all()[:2]
+        facility_list = self.create_list([
+            (f.country_code, f.name.upper(), junk_chars(f.address.upper()))
+            for f in facilities])
+        item_ids = [
+            str(i.id) for i in
+            facility_list.source.facilitylistitem_set.order_by('id')]
+
+        chunks = stream_match_facility_list_items(facility_list, chunk_size=1)
+        exact_result, result = next(chunks)
+        self.assertEqual([], exact_result['processed_list_item_ids'])
+        self.assertEqual(item_ids[:1], result['processed_list_item_ids'])
+        save_match_details(result)
+
+        # Matching again resumes after the items that have been saved
+        resumed = list(
+            stream_match_facility_list_items(facility_list, chunk_size=1))
+        self.assertEqual(1, len(resumed))
+        exact_result, result = resumed[0]
+        self.assertEqual(item_ids[1:], result['processed_list_item_ids'])
+        self.assertIn(item_ids[1], result['item_matches'])
+
+    def test_batch_process_counts_resumed_chunks(self):
+        facilities = Facility.objects.all()[:2]
+        facility_list = self.create_list([
+            (f.country_code, f.name.upper(), junk_chars(f.address.upper()))
+            for f in facilities])
+        exact_result, result = next(
+            stream_match_facility_list_items(facility_list, chunk_size=1))
+        save_match_details(result)
+
+        # Items matched before matching was interrupted are not counted as
+        # failures when it is resumed
+        out = StringIO()
+        call_command('batch_process', '--action', ProcessingAction.MATCH,
+                     '--list-id', str(facility_list.id), '--chunk-size', '1',
+                     stdout=out)
+        output = out.getvalue()
+        self.assertIn('match: 1 successes', output)
+        self.assertNotIn('failures', output)
+
+    def test_bulk_save_match_details(self):
+        facility = Facility.objects.first()
+        facility_list = self.create_list([
+            (facility.country_code, facility.name.upper(),
+             junk_chars(facility.address.upper())),
+            ('US', 'Bulk Saved Facility', '1 Bulk Saved Road')])
+        [matched_item, new_item] = \
+            facility_list.source.facilitylistitem_set.order_by('row_index')
+        new_item.geocoded_point = Point(0, 0)
+        new_item.save()
+        result = match_facility_list_items(facility_list)
+        self.assertIn(str(matched_item.id), result['item_matches'])
+        self.assertNotIn(str(new_item.id), result['item_matches'])
+
+        matches = bulk_save_match_details(result)
+
+        self.assertEqual(
+            [facility.id], [m.facility_id for m in matches
+                            if m.facility_list_item_id == matched_item.id])
+        self.assertTrue(FacilityMatch.history.filter(
+            id=matches[0].id, history_type='+').exists())
+
+        new_item.refresh_from_db()
+        self.assertEqual(FacilityListItem.MATCHED, new_item.status)
+        self.assertEqual(new_item, new_item.facility.created_from)
+        self.assertEqual(
+            'no_gazetteer_match',
+            new_item.facility.facilitymatch_set.get().results['match_type'])
+        self.assertTrue(Facility.history.filter(
+            id=new_item.facility_id, history_type='+').exists())
+        self.assertTrue(
+            FacilityIndex.objects.filter(id=new_item.facility_id).exists())
+
+    def test_bulk_save_match_details_with_confirmed_match_candidate(self):
+        facility = Facility.objects.first()
+        confirmed_match = FacilityMatch.objects.filter(
+            facility=facility).first()
+        facility_list = self.create_list([
+            (facility.country_code, facility.name.upper(),
+             junk_chars(facility.address.upper()))])
+        item = facility_list.source.facilitylistitem_set.get()
+        result = match_facility_list_items(facility_list)
+        # The only candidate is the record added for a confirmed match
+        result['item_matches'] = {
+            str(item.id): [(match_detail_to_extended_facility_id(
+                facility.id, confirmed_match.id), np.float32(0.99))]
+        }
+
+        matches = bulk_save_match_details(result)
+
+        self.assertEqual([facility.id], [m.facility_id for m in matches])
+        item.refresh_from_db()
+        self.assertEqual(FacilityListItem.MATCHED, item.status)
+        self.assertEqual(facility, item.facility)
+
+    @override_settings(GAZETTEER_TRAINING_SAMPLE_SIZE_PER_COUNTRY=1)
+    def test_training_sample(self):
+        countries = set(
+            FacilityListItem.objects
+            .exclude(status__in=TRAINING_SAMPLE_EXCLUDED_STATUSES)
+            .values_list('country_code', flat=True))
+        self.assertEqual((len(countries), 0), refresh_training_sample())
+        self.assertEqual(
+            set(c.lower() for c in countries),
+            set(TrainingSampleItem.objects.values_list('country',
+                                                       flat=True)))
+
+        # Only items created since the previous refresh are considered
+        self.assertEqual((0, 0), refresh_training_sample())
+        facility = Facility.objects.first()
+        self.create_list([('XX', facility.name, facility.address)])
+        self.assertEqual((1, 0), refresh_training_sample())
+
+        messy = get_messy_items_for_training()
+        self.assertEqual(len(countries) + 1, len(messy))
+        self.assertIn({'country': 'xx', 'name': clean(facility.name),
+                       'address': clean(facility.address)}, messy.values())
+
     def test_does_not_match(self):
         facility_list = self.create_list([
             ('US', 'Azavea', '990 Spring Garden St.')])
@@ -1768,6 +2356,18 @@ class DedupeMatchingTests(TestCase):
         result = match_facility_list_items(facility_list)
         self.assertTrue(result['results']['no_geocoded_items'])
 
+    def test_filter_existing_facility_matches(self):
+        [first, second] = Facility.objects.all()[:2]
+        matches = [
+            ('1', str(first.id), 0.9),
+            ('1', '{}_MATCH-1'.format(first.id), 0.8),
+            ('2', 'US2020052NOTREAL', 0.7),
+            ('2', str(second.id), 0.6),
+        ]
+        with self.assertNumQueries(1):
+            filtered = filter_existing_facility_matches(matches)
+        self.assertEqual([matches[0], matches[1], matches[3]], filtered)
+
     def test_reduce_matches(self):
         matches = [
             ('US2020052GKF19F', 75),
@@ -1821,6 +2421,33 @@ class OarIdTests(TestCase):
         self.assertRaises(ValueError, make_oar_id, '99')
 
 
+class CleanTests(TestCase):
+    values = [
+        'Nhà Máy Dệt-May, Lô 3/4:\nKhu CN',
+        '  "O\'Neill  Apparel"  ',
+        'İstanbul Tekstil A/S',
+        '服装 有限公司',
+        ' - , ',
+        'ABC\tCo.,  Ltd',
+    ]
+
+    def test_clean(self):
+        self.assertEqual(
+            ['nha may detmay lo 3 4 khu cn', 'oneill apparel',
+             'istanbul tekstil a s', 'fu zhuang you xian gong si', None,
+             'abc\tco. ltd'],
+            [clean(value) for value in self.values])
+
+    def test_clean_matches_regular_expressions(self):
+        for value in self.values:
+            self.assertEqual(clean_with_regexes(value), clean(value))
+
+    def test_clean_values(self):
+        self.assertEqual(
+            [clean(value) for value in self.values + self.values],
+            clean_values(self.values + self.values))
+
+
 class ContributorsListAPIEndpointTests(TestCase):
     def setUp(self):
         self.name_one = 'name_one'
@@ -4829,6 +5456,42 @@ class FacilityAPITestCaseBase(APITestCase):
                           password=self.user_password)
 
 
+class BatchIndexUpdatesTest(FacilityAPITestCaseBase):
+    @patch('api.models.index_facilities')
+    def test_reindexes_each_facility_once(self, mock_index_facilities):
+        with batch_index_updates():
+            self.facility.name = 'New Name'
+            self.facility.save()
+            self.match.save()
+            self.list_item.save()
+            mock_index_facilities.assert_not_called()
+
+        mock_index_facilities.assert_called_once_with([self.facility.id])
+
+    def test_updates_index_when_batch_exits(self):
+        with batch_index_updates():
+            self.facility.name = 'New Name'
+            self.facility.save()
+            with batch_index_updates():
+                self.match.save()
+            self.assertEqual(
+                'Name', FacilityIndex.objects.get(id=self.facility.id).name)
+
+        self.assertEqual(
+            'New Name', FacilityIndex.objects.get(id=self.facility.id).name)
+
+    @patch('api.models.index_facilities')
+    def test_flush_waits_for_deferred_updates(self, mock_index_facilities):
+        FacilityIndexWorker.enqueue({mock_index_facilities: {1, 2}})
+        FacilityIndexWorker.enqueue({mock_index_facilities: {3}})
+        FacilityIndexWorker.flush()
+
+        indexed_ids = [facility_id
+                       for call in mock_index_facilities.call_args_list
+                       for facility_id in call[0][0]]
+        self.assertEqual([1, 2, 3], sorted(indexed_ids))
+
+
 class SearchByList(APITestCase):
     def setUp(self):
         self.user_email = 'test@example.com'
@@ -7225,6 +7888,27 @@ class PPEFieldTest(TestCase):
         self.assertEqual('HTTP://TEST.COM',
                          self.facility.ppe_website)
 
+    def test_bulk_match_populates_ppe(self):
+        self.facility.ppe_website = 'HTTP://TEST.COM'
+        self.facility.save()
+
+        results = self.make_match_results(self.list_item_two.id,
+                                          self.facility.id, 100)
+        bulk_save_match_details(results)
+        self.facility.refresh_from_db()
+
+        self.assertEqual(self.list_item_two.ppe_product_types,
+                         self.facility.ppe_product_types)
+        self.assertEqual(self.list_item_two.ppe_contact_phone,
+                         self.facility.ppe_contact_phone)
+        self.assertEqual(self.list_item_two.ppe_contact_email,
+                         self.facility.ppe_contact_email)
+        self.assertEqual('HTTP://TEST.COM',
+                         self.facility.ppe_website)
+        self.assertEqual(
+            self.list_item_two.ppe_contact_phone,
+            self.facility.history.latest('history_date').ppe_contact_phone)
+
     def match_url(self, match, action='detail'):
         return reverse('facility-match-{}'.format(action),
                        kwargs={'pk': match.pk})
@@ -7525,6 +8209,33 @@ class CloseListTest(TestCase):
         activity = FacilityActivityReport.objects.all().count()
         self.assertEquals(2, activity)
 
+    def test_close_list_dry_run(self):
+        counts = close_list(self.list_one.id, self.user.id, dry_run=True)
+
+        self.assertEqual({'facilities': 2, 'already_closed': 0, 'closed': 0},
+                         counts)
+        self.assertFalse(Facility.objects.filter(is_closed=True).exists())
+        self.assertEqual(0, FacilityActivityReport.objects.count())
+
+    def test_close_list_in_chunks_skips_closed_facilities(self):
+        self.facility_one.is_closed = True
+        self.facility_one.save()
+
+        progress = Mock()
+        counts = close_list(self.list_one.id, self.user.id, chunk_size=1,
+                            progress=progress)
+
+        self.assertEqual({'facilities': 2, 'already_closed': 1, 'closed': 1},
+                         counts)
+        progress.assert_called_once_with(1, 1)
+        f_one_b = Facility.objects.get(id=self.facility_one_b.id)
+        self.assertTrue(f_one_b.is_closed)
+        self.assertEqual(
+            [self.facility_one_b.id],
+            list(FacilityActivityReport.objects.values_list('facility_id',
+                                                            flat=True)))
+        self.assertTrue(f_one_b.history.filter(is_closed=True).exists())
+
 
 class NonstandardFieldsApiTest(APITestCase):
     def setUp(self):
@@ -7772,6 +8483,18 @@ class ContributorFieldsApiTest(APITestCase):
         index_two_data = '{}|data two'.format(self.contributor.id)
         self.assertNotIn(index_two_data, index_two.custom_text)
 
+    def test_index_custom_text_for_all_facilities(self):
+        FacilityIndex.objects.update(custom_text=[])
+
+        index_custom_text([])
+
+        index_one = FacilityIndex.objects.get(id=self.facility.id)
+        index_one_data = '{}|data one'.format(self.contributor.id)
+        self.assertIn(index_one_data, index_one.custom_text)
+        index_two = FacilityIndex.objects.get(id=self.facility_two.id)
+        index_two_data = '{}|data two'.format(self.contributor.id)
+        self.assertIn(index_two_data, index_two.custom_text)
+
     def test_custom_text_excludes_inactive(self):
         self.match_one.is_active = False
         self.match_one.save()
@@ -7965,7 +8688,7 @@ class ParentCompanyTestCase(FacilityAPITestCaseBase):
         super(ParentCompanyTestCase, self).setUp()
         self.url = reverse('facility-list')
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_submit_parent_company_no_match(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -7989,7 +8712,7 @@ class ParentCompanyTestCase(FacilityAPITestCaseBase):
         self.assertEquals(0, len(facility_index.parent_company_id))
 
     @skip('Skip fuzzy matching. Will revisit at #1805')
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_submit_parent_company_fuzzy_match(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = geocoding_data
@@ -8013,7 +8736,7 @@ class ParentCompanyTestCase(FacilityAPITestCaseBase):
                       facility_index.parent_company_name)
         self.assertIn(self.contributor.id, facility_index.parent_company_id)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_submit_parent_company_duplicate(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8040,7 +8763,7 @@ class ParentCompanyTestCase(FacilityAPITestCaseBase):
         self.assertIn(self.contributor.id, facility_index.parent_company_id)
         self.assertEqual(1, len(facility_index.parent_company_id))
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_search_by_name(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8062,7 +8785,7 @@ class ParentCompanyTestCase(FacilityAPITestCaseBase):
         self.assertEquals(data['count'], 1)
         self.assertEquals(data['features'][0]['id'], facility_id)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_search_by_id(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8084,7 +8807,7 @@ class ParentCompanyTestCase(FacilityAPITestCaseBase):
         self.assertEquals(data['count'], 1)
         self.assertEquals(data['features'][0]['id'], facility_id)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_search_by_multiple(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8114,7 +8837,7 @@ class ProductTypeTestCase(FacilityAPITestCaseBase):
         super(ProductTypeTestCase, self).setUp()
         self.url = reverse('facility-list')
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_array(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8136,7 +8859,7 @@ class ProductTypeTestCase(FacilityAPITestCaseBase):
         self.assertIn('a', facility_index.product_type)
         self.assertIn('b', facility_index.product_type)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_string(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8158,7 +8881,7 @@ class ProductTypeTestCase(FacilityAPITestCaseBase):
         self.assertIn('a', facility_index.product_type)
         self.assertIn('b', facility_index.product_type)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_list_validation(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8173,7 +8896,7 @@ class ProductTypeTestCase(FacilityAPITestCaseBase):
         self.assertEqual(0, ExtendedField.objects.all().count())
         self.assertEqual(response.status_code, 400)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_max_count(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8203,7 +8926,7 @@ class ProductTypeTestCase(FacilityAPITestCaseBase):
         self.assertEqual(MAX_PRODUCT_TYPE_COUNT,
                          len(facility_index.product_type))
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_search_by_product_type(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8230,7 +8953,7 @@ class FacilityAndProcessingTypeAPITest(FacilityAPITestCaseBase):
         super(FacilityAndProcessingTypeAPITest, self).setUp()
         self.url = reverse('facility-list')
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_single_processing_value(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8272,7 +8995,7 @@ class FacilityAndProcessingTypeAPITest(FacilityAPITestCaseBase):
         self.assertNotIn('Final Product Assembly',
                          facility_index.processing_type)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_multiple_facility_values(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8308,7 +9031,7 @@ class FacilityAndProcessingTypeAPITest(FacilityAPITestCaseBase):
         self.assertIn('Office / HQ', facility_index.facility_type)
         self.assertEqual(0, len(facility_index.processing_type))
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_non_taxonomy_value(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8331,7 +9054,7 @@ class FacilityAndProcessingTypeAPITest(FacilityAPITestCaseBase):
         self.assertEqual(['Final Product Assembly'], index_row.facility_type)
         self.assertEqual(['Sewing'], index_row.processing_type)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_search_by_processing_type(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8351,7 +9074,7 @@ class FacilityAndProcessingTypeAPITest(FacilityAPITestCaseBase):
         self.assertEquals(data['count'], 1)
         self.assertEquals(data['features'][0]['id'], facility_id)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_search_by_facility_type(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8379,7 +9102,7 @@ class NumberOfWorkersAPITest(FacilityAPITestCaseBase):
         super(NumberOfWorkersAPITest, self).setUp()
         self.url = reverse('facility-list')
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_single_value(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8400,7 +9123,7 @@ class NumberOfWorkersAPITest(FacilityAPITestCaseBase):
         self.assertEquals(1, len(facility_index.number_of_workers))
         self.assertIn('1001-5000', facility_index.number_of_workers)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_range_value(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8421,7 +9144,7 @@ class NumberOfWorkersAPITest(FacilityAPITestCaseBase):
         self.assertEquals(1, len(facility_index.number_of_workers))
         self.assertIn('Less than 1000', facility_index.number_of_workers)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_crossrange_value(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8444,7 +9167,7 @@ class NumberOfWorkersAPITest(FacilityAPITestCaseBase):
         self.assertIn('1001-5000', facility_index.number_of_workers)
         self.assertIn('5001-10000', facility_index.number_of_workers)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_maxrange_value(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8465,7 +9188,7 @@ class NumberOfWorkersAPITest(FacilityAPITestCaseBase):
         self.assertEquals(1, len(facility_index.number_of_workers))
         self.assertIn('More than 10000', facility_index.number_of_workers)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_search_by_range(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8488,7 +9211,7 @@ class NumberOfWorkersAPITest(FacilityAPITestCaseBase):
         self.assertEquals(data['count'], 1)
         self.assertEquals(data['features'][0]['id'], facility_id)
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     def test_search_without_matches(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = geocoding_data
@@ -8507,13 +9230,47 @@ class NumberOfWorkersAPITest(FacilityAPITestCaseBase):
         self.assertEquals(data['count'], 0)
 
 
+class ExtendedFieldIndexValuesTest(TestCase):
+    def test_get_extendedfield_index_values(self):
+        values = get_extendedfield_index_values([
+            (ExtendedField.PARENT_COMPANY,
+             {'name': 'Parent', 'contributor_name': 'Contributor',
+              'contributor_id': 1}),
+            (ExtendedField.PARENT_COMPANY, {'name': 'Other Parent'}),
+            (ExtendedField.NUMBER_OF_WORKERS, {'min': 500, 'max': 1500}),
+            (ExtendedField.FACILITY_TYPE,
+             {'matched_values': [['FACILITY_TYPE', 'EXACT', 'Office', None],
+                                 ['PROCESSING_TYPE', 'EXACT', None, 'Dye']]}),
+            (ExtendedField.PROCESSING_TYPE,
+             {'matched_values': [['PROCESSING_TYPE', 'EXACT', 'Office',
+                                  'Dye']]}),
+            (ExtendedField.PRODUCT_TYPE, {'raw_values': ['Shirts, Hats']}),
+            (ExtendedField.NATIVE_LANGUAGE_NAME, 'Fábrica'),
+        ])
+
+        self.assertEqual(['Contributor', 'Other Parent'],
+                         sorted(values['parent_company_name']))
+        self.assertEqual([1], values['parent_company_id'])
+        self.assertEqual(['1001-5000', 'Less than 1000'],
+                         sorted(values['number_of_workers']))
+        self.assertEqual(['Office'], values['facility_type'])
+        self.assertEqual(['Dye'], values['processing_type'])
+        self.assertEqual(['shirts hats'], values['product_type'])
+        self.assertEqual(['Fabrica'], values['native_language_name'])
+
+    def test_get_extendedfield_index_values_without_fields(self):
+        values = get_extendedfield_index_values([])
+        self.assertEqual(set(EXTENDED_FIELD_INDEX_FIELDS), set(values.keys()))
+        self.assertTrue(all(v == [] for v in values.values()))
+
+
 class NativeLanguageNameAPITest(FacilityAPITestCaseBase):
     def setUp(self):
         super(NativeLanguageNameAPITest, self).setUp()
         self.url = reverse('facility-list')
         self.long_name = '杭州湾开发区兴慈二路与滨海二路叉口恒元工业园区A3'
 
-    @patch('api.geocoding.requests.get')
+    @patch('api.geocoding.requests.Session.get')
     @skip('DB is read-only')
     def test_search(self, mock_get):
         mock_get.return_value = Mock(ok=True, status_code=200)
@@ -8604,3 +9361,367 @@ class ExactMatchTest(FacilityAPITestCaseBase):
                                      self.contributor)
         self.assertEquals(results[0]['facility_id'], 1)
         self.assertEquals(results[1]['facility_id'], 2)
+
+    def test_exact_match_items(self):
+        self.list_item.clean_name = 'item'
+        self.list_item.clean_address = 'address'
+        self.list_item.save()
+
+        messy = {
+            '1': {'country': 'us', 'name': 'ITEM', 'address': 'Address'},
+            '2': {'country': 'us', 'name': 'Item', 'address': 'Address'},
+            '3': {'country': 'us', 'name': 'Other', 'address': 'Address'},
+            '4': {'country': 'us', 'name': '', 'address': 'Address'},
+        }
+        with self.assertNumQueries(1):
+            results = exact_match_items(messy, self.contributor)
+
+        self.assertEqual(['1', '2'], results['processed_list_item_ids'])
+        for messy_id in ['1', '2']:
+            matches = results['item_matches'][messy_id]
+            self.assertEqual(1, len(matches))
+            self.assertEqual(self.facility.id, matches[0]['facility_id'])
+            self.assertEqual(self.list_item.id, matches[0]['id'])
+
+
+class TileCacheTest(TestCase):
+    def test_key_ignores_param_order(self):
+        key = make_tile_cache_key(
+            'facilities', '1-0', 2, 1, 3,
+            {'countries': ['US', 'CN'], 'name': 'shirts'})
+        self.assertEqual(key, make_tile_cache_key(
+            'facilities', '1-0', 2, 1, 3,
+            {'name': 'shirts', 'countries': ['US', 'CN']}))
+        self.assertEqual(key, make_tile_cache_key(
+            'facilities', '1-0', 2, 1, 3,
+            QueryDict('name=shirts&countries=US&countries=CN')))
+        self.assertNotEqual(key, make_tile_cache_key(
+            'facilities', '1-0', 2, 1, 3, {'countries': ['US']}))
+        self.assertNotEqual(key, make_tile_cache_key(
+            'facilitygrid', '1-0', 2, 1, 3,
+            {'countries': ['US', 'CN'], 'name': 'shirts'}))
+
+    def test_key_includes_value_order_and_empty_values(self):
+        # The first contributor selects the custom text searched by `q` on
+        # embedded maps
+        self.assertNotEqual(
+            make_tile_cache_key('facilities', '1-0', 2, 1, 3,
+                                QueryDict('contributors=2&contributors=1')),
+            make_tile_cache_key('facilities', '1-0', 2, 1, 3,
+                                QueryDict('contributors=1&contributors=2')))
+        # An empty countries filter matches no facilities
+        self.assertNotEqual(
+            make_tile_cache_key('facilities', '1-0', 2, 1, 3,
+                                QueryDict('countries=')),
+            make_tile_cache_key('facilities', '1-0', 2, 1, 3, QueryDict()))
+
+    def test_memory_cache_evicts_least_recently_used(self):
+        cache = MemoryTileCache(max_size=6)
+        cache.set('a', b'aa')
+        cache.set('b', b'bb')
+        cache.set('c', b'cc')
+        self.assertEqual(b'aa', cache.get('a'))
+        cache.set('d', b'dd')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(b'aa', cache.get('a'))
+        self.assertEqual(6, cache.size)
+
+    def test_disk_cache_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as tile_dir:
+            cache = DiskTileCache(tile_dir, max_size=10)
+            cache.set('a', b'aaaa')
+            cache.set('b', b'bbbb')
+            os.utime(cache.path('a'), (0, 0))
+            os.utime(cache.path('b'), (1, 1))
+            self.assertEqual(b'aaaa', cache.get('a'))
+            cache.set('c', b'cccc')
+            self.assertEqual(b'aaaa', cache.get('a'))
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(b'cccc', cache.get('c'))
+
+    def test_concurrent_misses_render_once(self):
+        cache = TileCache(MemoryTileCache(max_size=1024))
+        rendered = []
+        rendering = threading.Event()
+        results = []
+
+        def render():
+            rendering.set()
+            time.sleep(0.2)
+            rendered.append(1)
+            return b'tile'
+
+        def request_tile():
+            results.append(cache.get_or_render('key', render))
+
+        threads = [threading.Thread(target=request_tile)]
+        threads[0].start()
+        rendering.wait()
+        threads.extend(threading.Thread(target=request_tile)
+                       for _ in range(3))
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(rendered))
+        self.assertEqual([b'tile'] * 4, [tile for tile, _ in results])
+        self.assertEqual(3, [cache_status for _, cache_status in results]
+                         .count(TILE_CACHE_COALESCED))
+        self.assertEqual((b'tile', TILE_CACHE_HIT),
+                         cache.get_or_render('key', render))
+        stats = cache.stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(3, stats['coalesced'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(0.8, stats['hit_rate'])
+
+    def test_backend_errors_render_tile(self):
+        backend = Mock()
+        backend.get.side_effect = ConnectionError()
+        backend.set.side_effect = ConnectionError()
+        cache = TileCache(backend)
+        self.assertEqual((b'tile', TILE_CACHE_MISS),
+                         cache.get_or_render('key', lambda: b'tile'))
+        self.assertEqual(2, cache.stats()['errors'])
+
+    @patch('api.management.commands.seed_tiles.get_tile_cache')
+    @patch('api.management.commands.seed_tiles.get_vector_tile')
+    @patch('api.models.Facility.current_tile_cache_key')
+    def test_seed_tiles(self, mock_cachekey, mock_tile, mock_get_tile_cache):
+        mock_cachekey.return_value = '1-0'
+        mock_tile.return_value = b'tile'
+        cache = TileCache(MemoryTileCache(max_size=1024))
+        mock_get_tile_cache.return_value = cache
+
+        out = StringIO()
+        call_command('seed_tiles', '--max-zoom', '1', '--layer',
+                     'facilitygrid', '--filter', 'countries=US', stdout=out)
+
+        # One tile at z0 and four at z1, without and with the filter
+        self.assertEqual(10, mock_tile.call_count)
+        key = make_tile_cache_key('facilitygrid', '1-0', 1, 0, 1,
+                                  {'countries': 'US'})
+        self.assertEqual(b'tile', cache.get(key))
+        output = out.getvalue()
+        self.assertIn('z0: 2 tiles, 2 rendered', output)
+        self.assertIn('z1: 8 tiles, 8 rendered', output)
+
+        out = StringIO()
+        call_command('seed_tiles', '--max-zoom', '1', '--layer',
+                     'facilitygrid', '--filter', 'countries=US', stdout=out)
+        self.assertEqual(10, mock_tile.call_count)
+        self.assertIn('z1: 8 tiles, 0 rendered', out.getvalue())
+
+    @override_switch('vector_tile', active=True)
+    @override_settings(ALLOWED_HOSTS=['testserver', '.allowed.org'])
+    @patch('api.views.get_tile_cache')
+    @patch('api.tiler.get_facilities_vector_tile')
+    def test_get_tile_uses_cache(self, mock_tile, mock_get_tile_cache):
+        mock_tile.return_value = memoryview(b'tile')
+        mock_get_tile_cache.return_value = TileCache(
+            MemoryTileCache(max_size=1024))
+        url = '/tile/facilities/1-0/2/1/3.pbf?countries=US'
+
+        response = self.client.get(url, HTTP_REFERER='http://allowed.org/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(TILE_CACHE_MISS, response['X-Tile-Cache'])
+        self.assertEqual(b'tile', response.content)
+
+        response = self.client.get(url, HTTP_REFERER='http://allowed.org/')
+        self.assertEqual(TILE_CACHE_HIT, response['X-Tile-Cache'])
+        self.assertEqual(b'tile', response.content)
+        self.assertEqual(1, mock_tile.call_count)
+
+
+class FacilityGridCellTest(TestCase):
+    def setUp(self):
+        self.location = Point(-75.1652, 39.9526)
+        self.index = FacilityIndex.objects.create(
+            id='US2022001ABCDEF', name='Factory', country_code='US',
+            location=self.location)
+
+    def cell_counts(self, zoom):
+        return {
+            (cell.x, cell.y): cell.count
+            for cell in FacilityGridCell.objects.filter(
+                zoom=zoom, count__gt=0)}
+
+    def test_index_changes_update_cell_counts(self):
+        for zoom in GRID_CELL_ZOOMS:
+            self.assertEqual([1], list(self.cell_counts(zoom).values()))
+        cell = list(self.cell_counts(11).keys())[0]
+
+        FacilityIndex.objects.create(
+            id='US2022001GHIJKL', name='Factory', country_code='US',
+            location=self.location)
+        self.assertEqual({cell: 2}, self.cell_counts(11))
+
+        FacilityIndex.objects.filter(id=self.index.id).update(
+            location=Point(100.5018, 13.7563))
+        counts = self.cell_counts(11)
+        self.assertEqual(2, len(counts))
+        self.assertEqual(1, counts[cell])
+
+        FacilityIndex.objects.all().delete()
+        for zoom in GRID_CELL_ZOOMS:
+            self.assertEqual({}, self.cell_counts(zoom))
+
+    def test_cell_is_hexagon_containing_facility(self):
+        for zoom in [3, 11]:
+            xy_bounds = mercantile.xy_bounds(mercantile.tile(
+                self.location.x, self.location.y, zoom))
+            width, a, height = get_hex_dimensions(xy_bounds)
+            (x, y), = self.cell_counts(zoom).keys()
+            center = (x * width + (y & 1) * width / 2,
+                      (y >> 1) * height + (2 + 3 * (y & 1)) * a)
+
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT ST_X(ST_Centroid(geom)), ST_Y(ST_Centroid(geom))
+                    FROM generate_hexgrid(%s, %s, %s, %s, %s)
+                    WHERE ST_Contains(geom, ST_Transform(%s::geometry, 3857))
+                    """,
+                    [width, xy_bounds.left, xy_bounds.bottom,
+                     xy_bounds.right, xy_bounds.top, self.location.ewkt])
+                rows = cursor.fetchall()
+            self.assertEqual(1, len(rows))
+            self.assertAlmostEqual(center[0], rows[0][0], places=3)
+            self.assertAlmostEqual(center[1], rows[0][1], places=3)
+
+    def test_unfiltered_grid_tile_reads_cells(self):
+        self.assertTrue(is_unfiltered_grid(QueryDict('embed=1'), 11))
+        self.assertFalse(is_unfiltered_grid(QueryDict('countries=US'), 11))
+        self.assertFalse(is_unfiltered_grid(QueryDict('q='), 11))
+        self.assertFalse(is_unfiltered_grid(QueryDict(''), 12))
+
+        tile = mercantile.tile(self.location.x, self.location.y, 11)
+        with CaptureQueriesContext(connection) as queries:
+            vector_tile = get_facility_grid_vector_tile(
+                QueryDict(''), 'facilitygrid', tile.z, tile.x, tile.y)
+        self.assertGreater(len(vector_tile), 0)
+        self.assertEqual(1, len(queries))
+        self.assertIn('api_facilitygridcell', queries[0]['sql'])
+        self.assertNotIn('hex_grid', queries[0]['sql'])
+
+
+class FacilityPointStoreTest(TestCase):
+    def setUp(self):
+        self.location = Point(-75.1652, 39.9526)
+        FacilityIndex.objects.create(
+            id='US2022001ABCDEF', name='Factory A', country_code='US',
+            location=self.location, contributors=[1, 2], lists=[10],
+            contrib_types=['Brand / Retailer'])
+        FacilityIndex.objects.create(
+            id='US2022001GHIJKL', name='Factory B', country_code='US',
+            location=self.location, contributors=[2], lists=[11],
+            contrib_types=['Auditor'])
+        FacilityIndex.objects.create(
+            id='CN2022001MNOPQR', name='Factory C', country_code='CN',
+            location=Point(121.4737, 31.2304), contributors=[1], lists=[12],
+            contrib_types=['Auditor'])
+        self.store = FacilityPointStore.load('1-0')
+
+    def count(self, query_string):
+        return int(self.store.filter(QueryDict(query_string)).sum())
+
+    def test_filter(self):
+        self.assertEqual(3, len(self.store))
+        self.assertEqual(3, self.count(''))
+        self.assertEqual(2, self.count('countries=US'))
+        self.assertEqual(3, self.count('countries=US&countries=CN'))
+        self.assertEqual(0, self.count('countries=BD'))
+        self.assertEqual(3, self.count('contributors=1&contributors=2'))
+        self.assertEqual(1, self.count(
+            'contributors=1&contributors=2&combine_contributors=AND'))
+        self.assertEqual(1, self.count('countries=US&contributors=1'))
+        self.assertEqual(2, self.count('lists=11&lists=12'))
+        self.assertEqual(2, self.count('contributor_types=Auditor'))
+        self.assertFalse(self.store.supports(QueryDict('q=factory')))
+        self.assertTrue(self.store.supports(QueryDict('countries=US')))
+
+    def test_filter_ignores_values_that_are_not_integers(self):
+        self.assertEqual(0, self.count('contributors=abc'))
+        self.assertEqual(2, self.count('contributors=abc&contributors=1'))
+        self.assertEqual(0, self.count(
+            'contributors=abc&contributors=1&combine_contributors=AND'))
+        self.assertEqual(1, self.count('lists=abc&lists=10'))
+
+    @override_settings(FACILITY_POINT_STORE_REFRESH_INTERVAL_IN_SECONDS=0)
+    @patch('api.facility_point_store._refresh_facility_point_store')
+    def test_refreshes_store_in_background(self, mock_refresh):
+        with patch.multiple('api.facility_point_store',
+                            _facility_point_store=self.store,
+                            _facility_point_store_checked_at=0,
+                            _facility_point_store_loading=False):
+            self.assertEqual(self.store, get_facility_point_store())
+        for _ in range(10):
+            if mock_refresh.called:
+                break
+            time.sleep(0.1)
+        mock_refresh.assert_called_once_with(self.store)
+
+    def test_encode_point_mvt_layer(self):
+        self.assertEqual(b'', encode_point_mvt_layer('layer', [], []))
+        self.assertEqual(
+            b'\x1a\x24\x78\x02\x0a\x05layer'
+            b'\x12\x0b\x12\x02\x00\x00\x18\x01\x22\x03\x09\x02\x04'
+            b'\x1a\x05count\x22\x02\x28\x03\x28\x80\x20',
+            encode_point_mvt_layer('layer', [(1, 2)], [{'count': 3}]))
+
+    @patch('api.tiler.get_facility_point_store')
+    def test_filtered_grid_tile_uses_store(self, mock_get_store):
+        mock_get_store.return_value = self.store
+        tile = mercantile.tile(self.location.x, self.location.y, 5)
+        with CaptureQueriesContext(connection) as queries:
+            vector_tile = get_facility_grid_vector_tile(
+                QueryDict('countries=US'), 'facilitygrid',
+                tile.z, tile.x, tile.y)
+            empty_tile = get_facility_grid_vector_tile(
+                QueryDict('countries=CN'), 'facilitygrid',
+                tile.z, tile.x, tile.y)
+        self.assertEqual(0, len(queries))
+        self.assertIn(b'facilitygrid', vector_tile.tobytes())
+        self.assertEqual(b'', empty_tile.tobytes())
+
+
+class FacilityIndexFilterTest(TestCase):
+    def setUp(self):
+        for oar_id, country_code in [('US2022001ABCDEF', 'US'),
+                                     ('US2022001GHIJKL', 'US'),
+                                     ('CN2022001MNOPQR', 'CN')]:
+            FacilityIndex.objects.create(
+                id=oar_id, name='Factory', country_code=country_code,
+                location=Point(0, 0), facility_type=['Final Product Assembly'])
+
+    def test_filters_index(self):
+        queryset = FacilityIndex.objects.filter_by_query_params(
+            QueryDict('countries=US'))
+        self.assertEqual(2, queryset.count())
+        self.assertEqual(3, FacilityIndex.objects.filter_by_query_params(
+            QueryDict('countries=US&countries=CN')).count())
+        self.assertEqual(0, FacilityIndex.objects.filter_by_query_params(
+            QueryDict('countries=')).count())
+
+    def test_facility_queryset_only_joins_index_with_filters(self):
+        self.assertNotIn('api_facilityindex', str(
+            Facility.objects.filter_by_query_params(QueryDict('')).query))
+        self.assertIn('api_facilityindex', str(
+            Facility.objects.filter_by_query_params(
+                QueryDict('countries=US')).query))
+
+    @patch('api.models.get_facility_and_processing_type')
+    def test_filter_query_is_reused(self, mock_get_type):
+        mock_get_type.return_value = (
+            'FACILITY_TYPE', 'EXACT_MATCH', 'Final Product Assembly',
+            'Assembly')
+        first = FacilityIndex.objects.filter_by_query_params(
+            QueryDict('facility_type=assembly-reuse&countries=CN'))
+        second = FacilityIndex.objects.filter_by_query_params(
+            QueryDict('countries=CN&facility_type=assembly-reuse'))
+        self.assertEqual(1, mock_get_type.call_count)
+        self.assertEqual(str(first.query), str(second.query))
+        self.assertEqual(1, second.count())
+        self.assertEqual(0, second.filter(country_code='US').count())
+        self.assertEqual(1, first.count())
@@ -0,0 +1,353 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import boto3
+import redis
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TILE_CACHE_HIT = 'HIT'
+TILE_CACHE_MISS = 'MISS'
+TILE_CACHE_COALESCED = 'COALESCED'
+
+# When the disk cache grows beyond its maximum size, the least recently used
+# tiles are removed until it is below this fraction of the maximum size so
+# that the directory is not scanned again by the next write
+DISK_TILE_CACHE_EVICTION_RATIO = 0.9
+
+
+def canonicalize_tile_params(params):
+    """
+    Create a string from tile request query parameters that is the same for
+    any ordering of the parameters. The order of the values of each parameter
+    is kept, because the first value of some parameters, such as
+    `contributors`, changes the tile, and empty values are kept, because a
+    parameter with an empty value filters differently than a missing one.
+
+    Arguments:
+    params -- A QueryDict or a dict of parameter names to a value or a list
+              of values.
+
+    Returns:
+    A URL encoded string of the parameter values sorted by name.
+    """
+    if hasattr(params, 'lists'):
+        items = params.lists()
+    else:
+        items = ((k, v if isinstance(v, (list, tuple)) else [v])
+                 for k, v in params.items())
+    return urlencode(sorted(
+        ((name, str(value))
+         for name, values in items
+         for value in values
+         if value is not None),
+        key=lambda item: item[0]))
+
+
+def make_tile_cache_key(layer, cachekey, z, x, y, params):
+    """
+    Create the key under which a vector tile is stored in the tile cache.
+
+    Arguments:
+    layer -- The name of the tile layer.
+    cachekey -- The tile cache key from the tile URL.
+    z -- Zoom level.
+    x -- X position of the tile.
+    y -- Y position of the tile.
+    params -- The query parameters used to filter the tile.
+
+    Returns:
+    A string key.
+    """
+    params_hash = hashlib.sha1(
+        canonicalize_tile_params(params).encode()).hexdigest()
+    return 'tile/{}/{}/{}/{}/{}/{}.pbf'.format(
+        layer, cachekey, z, x, y, params_hash)
+
+
+class MemoryTileCache(object):
+    """
+    Store tiles in a dictionary in process memory, evicting the least
+    recently used tiles once the total size of the tiles is greater than
+    `max_size` bytes.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            return tile
+
+    def set(self, key, tile):
+        with self._lock:
+            if key in self._tiles:
+                self.size -= len(self._tiles.pop(key))
+            self._tiles[key] = tile
+            self.size += len(tile)
+            while self.size > self.max_size and len(self._tiles) > 0:
+                _, evicted = self._tiles.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class DiskTileCache(object):
+    """
+    Store tiles as files in a directory, evicting the least recently used
+    tiles once the total size of the files is greater than `max_size` bytes.
+
+    Reading a tile updates the modification time of its file, which is used
+    to find the least recently used tiles. Tiles are written to a temporary
+    file that is then renamed, so the directory can be shared by processes.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                tile = f.read()
+            os.utime(path)
+            return tile
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, tile):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(tile)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self.size is None:
+                self.size = sum(size for _, _, size in self.files())
+            else:
+                self.size += len(tile)
+            if self.size > self.max_size:
+                self.evict()
+
+    def files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def evict(self):
+        # Other processes may have added or removed files, so the size is
+        # recalculated from the directory before evicting
+        files = sorted(self.files(), key=lambda f: f[1])
+        self.size = sum(size for _, _, size in files)
+        target_size = self.max_size * DISK_TILE_CACHE_EVICTION_RATIO
+        for path, _, size in files:
+            if self.size <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+class RedisTileCache(object):
+    """
+    Store tiles in Redis or a Redis compatible service. Eviction is handled by
+    the server, which should be configured with a `maxmemory` limit and the
+    `allkeys-lru` policy.
+    """
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, tile):
+        self.client.set(key, tile)
+
+
+class S3TileCache(object):
+    """
+    Store tiles as objects in an S3 bucket. Eviction is handled by a lifecycle
+    rule on the bucket. Setting `endpoint_url` stores the tiles in an S3
+    compatible service, such as a local MinIO server, instead of AWS.
+    """
+    def __init__(self, bucket, endpoint_url=None):
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def set(self, key, tile):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=tile,
+                               ContentType='application/x-protobuf')
+
+
+class _Render(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.tile = None
+        self.error = None
+
+
+class TileCache(object):
+    """
+    Read rendered tiles from a storage backend, rendering and storing the
+    tiles that are missing.
+
+    Concurrent requests in this process for a tile that is missing wait for
+    the tile to be rendered by the first request rather than each rendering
+    it. Errors reading from or writing to the backend are logged and the tile
+    is rendered as if the cache was disabled.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._renders = {}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'errors': 0,
+        }
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def stats(self):
+        """
+        Returns:
+        A dict with the number of `hits`, `misses`, `coalesced` requests that
+        waited for another request to render a tile, backend `errors` and the
+        `hit_rate`, which counts coalesced requests as hits.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        requests = stats['hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_rate'] = (
+            (stats['hits'] + stats['coalesced']) / requests
+            if requests > 0 else 0.0)
+        return stats
+
+    def get(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception:
+            self._count('errors')
+            logger.exception('Failed to read tile {}'.format(key))
+            return None
+
+    def set(self, key, tile):
+        try:
+            self.backend.set(key, tile)
+        except Exception:
+            self._count('errors')
+            logger.exception('Failed to write tile {}'.format(key))
+
+    def get_or_render(self, key, render):
+        """
+        Get a tile from the cache or render and store it.
+
+        Arguments:
+        key -- A key created by `make_tile_cache_key`.
+        render -- A function with no arguments that returns the tile bytes.
+
+        Returns:
+        A tuple of the tile bytes and one of TILE_CACHE_HIT, TILE_CACHE_MISS
+        or TILE_CACHE_COALESCED.
+        """
+        tile = self.get(key)
+        if tile is not None:
+            self._count('hits')
+            return tile, TILE_CACHE_HIT
+
+        with self._lock:
+            pending = self._renders.get(key)
+            is_renderer = pending is None
+            if is_renderer:
+                pending = self._renders[key] = _Render()
+
+        if not is_renderer:
+            self._count('coalesced')
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.tile, TILE_CACHE_COALESCED
+
+        self._count('misses')
+        try:
+            pending.tile = render()
+            self.set(key, pending.tile)
+            return pending.tile, TILE_CACHE_MISS
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._renders[key]
+            pending.done.set()
+
+
+def create_tile_cache_backend(backend):
+    if backend == 'memory':
+        return MemoryTileCache(settings.TILE_CACHE_MAX_SIZE_IN_BYTES)
+    elif backend == 'disk':
+        return DiskTileCache(settings.TILE_CACHE_DIRECTORY,
+                             settings.TILE_CACHE_MAX_SIZE_IN_BYTES)
+    elif backend == 'redis':
+        return RedisTileCache(settings.TILE_CACHE_REDIS_URL)
+    elif backend == 's3':
+        return S3TileCache(settings.TILE_CACHE_S3_BUCKET,
+                           endpoint_url=settings.TILE_CACHE_S3_ENDPOINT_URL)
+    raise ValueError('Unknown tile cache backend: {}'.format(backend))
+
+
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache():
+    """
+    Returns:
+    The TileCache shared by the threads in this process, using the backend
+    specified by the TILE_CACHE_BACKEND setting, or None if the setting is
+    empty.
+    """
+    global _tile_cache
+    if not settings.TILE_CACHE_BACKEND:
+        return None
+    with _tile_cache_lock:
+        if _tile_cache is None:
+            _tile_cache = TileCache(
+                create_tile_cache_backend(settings.TILE_CACHE_BACKEND))
+        return _tile_cache
@@ -1,17 +1,150 @@
+import math
+
 import mercantile
 
 from django.contrib.gis.geos import Polygon
 from django.db import connection
 
-from api.models import Facility
+from api.constants import FacilitiesQueryParams
+from api.facility_point_store import get_facility_point_store
+from api.models import Facility, FacilityIndex
 
 GRID_ZOOM_FACTOR = 3
 
+# The zoom levels at which the facility counts of the grid cells are stored
+# in the FacilityGridCell table. Must match the zoom levels used by the
+# `add_facility_grid_cell_counts` database function.
+GRID_CELL_ZOOMS = range(0, 12)
+
+# The query parameters that filter the facilities counted in the grid
+GRID_FILTER_PARAMS = [
+    FacilitiesQueryParams.Q,
+    FacilitiesQueryParams.NAME,
+    FacilitiesQueryParams.CONTRIBUTORS,
+    FacilitiesQueryParams.LISTS,
+    FacilitiesQueryParams.CONTRIBUTOR_TYPES,
+    FacilitiesQueryParams.COUNTRIES,
+    FacilitiesQueryParams.BOUNDARY,
+    FacilitiesQueryParams.PARENT_COMPANY,
+    FacilitiesQueryParams.FACILITY_TYPE,
+    FacilitiesQueryParams.PROCESSING_TYPE,
+    FacilitiesQueryParams.PRODUCT_TYPE,
+    FacilitiesQueryParams.NUMBER_OF_WORKERS,
+    FacilitiesQueryParams.NATIVE_LANGUAGE_NAME,
+]
+
+TILE_LAYERS = ['facilities', 'facilitygrid']
+
+
+def get_hex_dimensions(xy_bounds):
+    """
+    Arguments:
+    xy_bounds -- The web mercator bounds of a tile.
+
+    Returns:
+    A tuple of the width of the grid hexagons drawn on the tile, half of the
+    length of a side of a hexagon and the height of a pair of rows of
+    hexagons, as used by the `generate_hexgrid` database function.
+    """
+    width = abs(xy_bounds.right - xy_bounds.left) / (2 ** GRID_ZOOM_FACTOR)
+    a = math.tan(math.radians(30)) * width / 2
+    return width, a, 6 * a
+
+
+def is_unfiltered_grid(params, z):
+    return z in GRID_CELL_ZOOMS and not any(
+        param in params for param in GRID_FILTER_PARAMS)
+
+
+def get_precomputed_facility_grid_vector_tile(layer, z, x, y):
+    """
+    Create a facility grid vector tile from the facility counts stored in the
+    FacilityGridCell table, without filtering the facilities.
+
+    Arguments:
+    layer (string) -- The name of the tile layer.
+    z (int) -- Zoom level. Must be one of the GRID_CELL_ZOOMS.
+    x (int) -- X (horizontal) position for requested tile on a grid.
+    y (int) -- Y (vertical) position for requested tile on a grid.
+
+    Returns:
+    A vector tile.
+    """
+    xy_bounds = mercantile.xy_bounds(x, y, z)
+    width, a, height = get_hex_dimensions(xy_bounds)
+
+    # Read the same cells that `generate_hexgrid` creates for the tile. The
+    # hexagons are rebuilt from the center of each cell, which is offset by
+    # half of a cell in odd rows.
+    query = """
+        SELECT ST_AsMVT(q, %(layer)s) FROM (
+          SELECT
+            ST_AsMVTGeom(
+              ST_SetSRID(ST_MakePoint(cx, cy), 3857),
+              ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 3857)
+            ) AS mvt_geom,
+            count,
+            ST_XMin(envelope) AS xmin,
+            ST_YMin(envelope) AS ymin,
+            ST_XMax(envelope) AS xmax,
+            ST_YMax(envelope) AS ymax
+          FROM (
+            SELECT
+              cx, cy, count,
+              ST_Transform(ST_MakeEnvelope(
+                cx - %(b)s, cy - 2 * %(a)s, cx + %(b)s, cy + 2 * %(a)s, 3857
+              ), 4326) AS envelope
+            FROM (
+              SELECT
+                x * %(width)s + (y & 1) * %(b)s AS cx,
+                (y >> 1) * %(height)s + (2 + 3 * (y & 1)) * %(a)s AS cy,
+                count
+              FROM api_facilitygridcell
+              WHERE zoom = %(zoom)s
+                AND x BETWEEN %(index_xmin)s AND %(index_xmax)s
+                AND y BETWEEN %(index_ymin)s AND %(index_ymax)s
+                AND count > 0
+            ) AS cells
+          ) AS hexagons
+          -- Exclude geoms on the edges that wrap around the world
+          WHERE abs(ST_XMax(envelope) - ST_XMin(envelope)) < 180
+        ) AS q
+    """
+    query_params = {
+        'layer': layer,
+        'zoom': z,
+        'width': width,
+        'a': a,
+        'b': width / 2,
+        'height': height,
+        'xmin': xy_bounds.left,
+        'ymin': xy_bounds.bottom,
+        'xmax': xy_bounds.right,
+        'ymax': xy_bounds.top,
+        'index_xmin': math.floor(xy_bounds.left / width),
+        'index_xmax': math.ceil(xy_bounds.right / width),
+        'index_ymin': 2 * math.floor(xy_bounds.bottom / height),
+        'index_ymax': 2 * math.ceil(xy_bounds.top / height) + 1,
+    }
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, query_params)
+        rows = cursor.fetchall()
+        return rows[0][0]
+
 
 def get_facility_grid_vector_tile(params, layer, z, x, y):
+    if is_unfiltered_grid(params, z):
+        return get_precomputed_facility_grid_vector_tile(layer, z, x, y)
+
     xy_bounds = mercantile.xy_bounds(x, y, z)
 
-    hex_width = abs(xy_bounds.right - xy_bounds.left) / (2 ** GRID_ZOOM_FACTOR)
+    store = get_facility_point_store()
+    if store is not None and store.supports(params):
+        return memoryview(store.get_grid_vector_tile(
+            params, layer, xy_bounds, get_hex_dimensions(xy_bounds)))
+
+    hex_width, _, _ = get_hex_dimensions(xy_bounds)
     hex_grid_query = """
         CREATE TEMP TABLE hex_grid (geom, mvt_geom, wgs84_geom) AS (
           SELECT geom, ST_AsMVTGeom(
@@ -29,7 +162,7 @@ def get_facility_grid_vector_tile(params, layer, z, x, y):
     hex_grid_idx_query = \
         'CREATE INDEX hex_grid_idx ON hex_grid USING gist (wgs84_geom)'
 
-    location_query, location_params = Facility \
+    location_query, location_params = FacilityIndex \
         .objects \
         .filter_by_query_params(params) \
         .values('location') \
@@ -57,7 +190,7 @@ def get_facility_grid_vector_tile(params, layer, z, x, y):
         '  ST_YMin(ST_Envelope(hex_grid.wgs84_geom)) as ymin, '
         '  ST_XMax(ST_Envelope(hex_grid.wgs84_geom)) as xmax, '
         '  ST_YMax(ST_Envelope(hex_grid.wgs84_geom)) as ymax '
-        'FROM hex_grid JOIN api_facility '
+        'FROM hex_grid JOIN api_facilityindex '
         '  ON ST_Contains(hex_grid.wgs84_geom, location) '
         ' {where_clause} '
         'GROUP BY hex_grid.mvt_geom, '
@@ -147,3 +280,27 @@ def get_facilities_vector_tile(params, layer, z, x, y):
         cursor.execute(st_asmvt_query, params_for_sql)
         rows = cursor.fetchall()
         return rows[0][0]
+
+
+def get_vector_tile(params, layer, z, x, y):
+    """
+    Create a vector tile for one of the TILE_LAYERS, filtered by params.
+
+    Arguments:
+    params (dict) -- Request query parameters whose potential choices are
+                     enumerated in `api.constants.FacilitiesQueryParams`
+    layer (string) -- The name of the tile layer.
+    z (int) -- Zoom level.
+    x (int) -- X (horizontal) position for requested tile on a grid.
+    y (int) -- Y (vertical) position for requested tile on a grid.
+
+    Returns:
+    The bytes of the vector tile.
+    """
+    if layer == 'facilities':
+        tile = get_facilities_vector_tile(params, layer, z, x, y)
+    elif layer == 'facilitygrid':
+        tile = get_facility_grid_vector_tile(params, layer, z, x, y)
+    else:
+        raise ValueError('invalid layer name: {}'.format(layer))
+    return tile.tobytes()
@@ -85,10 +85,12 @@ from api.models import (FacilityList,
                         FacilityIndex,
                         ExtendedField,
                         index_custom_text,
-                        index_extendedfields)
+                        index_extendedfields,
+                        batch_index_updates)
 from api.processing import (parse_csv_line,
                             parse_csv,
-                            parse_xlsx)
+                            parse_xlsx,
+                            create_facility_list_items)
 from api.serializers import (FacilityListSerializer,
                              FacilityListItemSerializer,
                              FacilityListItemsQueryParamsSerializer,
@@ -120,8 +122,8 @@ from api.mail import (send_claim_facility_confirmation_email,
                       send_claim_update_notice_to_list_contributors,
                       send_report_result)
 from api.exceptions import BadRequestException
-from api.tiler import (get_facilities_vector_tile,
-                       get_facility_grid_vector_tile)
+from api.tiler import get_vector_tile, TILE_LAYERS
+from api.tile_cache import get_tile_cache, make_tile_cache_key
 from api.renderers import MvtRenderer
 from api.facility_history import (create_facility_history_list,
                                   create_associate_match_change_reason,
@@ -910,18 +912,26 @@ class FacilitiesViewSet(mixins.ListModelMixin,
         if not params.is_valid():
             raise ValidationError(params.errors)
 
-        queryset = Facility \
+        # Count, sort and page the facilities with the index table and only
+        # read the facilities on the page for serialization
+        index_queryset = FacilityIndex \
             .objects \
             .filter_by_query_params(request.query_params) \
             .order_by('name')
 
-        page_queryset = self.paginate_queryset(queryset)
+        page_ids = self.paginate_queryset(
+            index_queryset.values_list('id', flat=True))
 
-        extent = queryset.aggregate(Extent('location'))['location__extent']
+        extent = index_queryset.aggregate(
+            Extent('location'))['location__extent']
 
         context = {'request': request}
 
-        if page_queryset is not None:
+        if page_ids is not None:
+            facilities = Facility.objects.in_bulk(page_ids)
+            page_queryset = [facilities[facility_id]
+                             for facility_id in page_ids
+                             if facility_id in facilities]
             should_serialize_details = params.validated_data['detail']
             exclude_fields = [
                 'contributor_fields',
@@ -934,6 +944,10 @@ class FacilitiesViewSet(mixins.ListModelMixin,
             response.data['extent'] = extent
             return response
 
+        queryset = Facility \
+            .objects \
+            .filter_by_query_params(request.query_params) \
+            .order_by('name')
         response_data = FacilitySerializer(queryset, many=True,
                                            context=context).data
         response_data['extent'] = extent
@@ -1220,6 +1234,7 @@ class FacilitiesViewSet(mixins.ListModelMixin,
                         status=status.HTTP_403_FORBIDDEN)
 
     @transaction.atomic
+    @batch_index_updates()
     def destroy(self, request, pk=None):
         if request.user.is_anonymous:
             raise NotAuthenticated()
@@ -1526,6 +1541,7 @@ class FacilitiesViewSet(mixins.ListModelMixin,
     @action(detail=False, methods=['POST'],
             permission_classes=(IsRegisteredAndConfirmed,))
     @transaction.atomic
+    @batch_index_updates()
     def merge(self, request):
         if not request.user.is_superuser:
             raise PermissionDenied()
@@ -1649,6 +1665,7 @@ class FacilitiesViewSet(mixins.ListModelMixin,
     @action(detail=True, methods=['GET', 'POST'],
             permission_classes=(IsRegisteredAndConfirmed,))
     @transaction.atomic
+    @batch_index_updates()
     def split(self, request, pk=None):
         if not request.user.is_superuser:
             raise PermissionDenied()
@@ -1845,6 +1862,7 @@ class FacilitiesViewSet(mixins.ListModelMixin,
     @action(detail=True, methods=['POST'],
             permission_classes=(IsRegisteredAndConfirmed,))
     @transaction.atomic
+    @batch_index_updates()
     def promote(self, request, pk=None):
         if not request.user.is_superuser:
             raise PermissionDenied()
@@ -2416,11 +2434,7 @@ class FacilityListViewSet(viewsets.ModelViewSet):
                     replaced_source.is_active = False
                     replaced_source.save()
 
-        items = [FacilityListItem(row_index=idx,
-                                  raw_data=row,
-                                  source=source)
-                 for idx, row in enumerate(rows)]
-        FacilityListItem.objects.bulk_create(items)
+        create_facility_list_items(source, rows)
 
         if ENVIRONMENT in ('Staging', 'Production'):
             submit_jobs(ENVIRONMENT, new_list)
@@ -2612,6 +2626,7 @@ class FacilityListViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
     @transaction.atomic
+    @batch_index_updates()
     @action(detail=True, methods=['post'],
             url_path='remove')
     def remove_item(self, request, pk=None):
@@ -3086,6 +3101,7 @@ class FacilityMatchViewSet(mixins.RetrieveModelMixin,
         return super(FacilityMatchViewSet, self).retrieve(request, pk=pk)
 
     @transaction.atomic
+    @batch_index_updates()
     @action(detail=True, methods=['POST'])
     def confirm(self, request, pk=None):
         """
@@ -3213,6 +3229,7 @@ class FacilityMatchViewSet(mixins.RetrieveModelMixin,
         return Response(response_data)
 
     @transaction.atomic
+    @batch_index_updates()
     @action(detail=True, methods=['POST'])
     def reject(self, request, pk=None):
         """
@@ -3378,7 +3395,7 @@ def get_tile(request, layer, cachekey, z, x, y, ext):
     if cachekey is None:
         raise BadRequestException('missing cache key')
 
-    if layer not in ['facilities', 'facilitygrid']:
+    if layer not in TILE_LAYERS:
         raise BadRequestException('invalid layer name: {}'.format(layer))
 
     if ext != 'pbf':
@@ -3389,14 +3406,20 @@ def get_tile(request, layer, cachekey, z, x, y, ext):
     if not params.is_valid():
         raise ValidationError(params.errors)
 
+    def render_tile():
+        return get_vector_tile(request.query_params, layer, z, x, y)
+
     try:
-        if layer == 'facilities':
-            tile = get_facilities_vector_tile(
-                request.query_params, layer, z, x, y)
-        elif layer == 'facilitygrid':
-            tile = get_facility_grid_vector_tile(
-                request.query_params, layer, z, x, y)
-        return Response(tile.tobytes())
+        tile_cache = get_tile_cache()
+        if tile_cache is None:
+            return Response(render_tile())
+
+        key = make_tile_cache_key(layer, cachekey, z, x, y,
+                                  request.query_params)
+        tile, cache_status = tile_cache.get_or_render(key, render_tile)
+        response = Response(tile)
+        response['X-Tile-Cache'] = cache_status
+        return response
     except core_exceptions.EmptyResultSet:
         return Response(None, status=status.HTTP_204_NO_CONTENT)
 
@@ -351,11 +351,114 @@ ECSMANAGE_ENVIRONMENTS = {
 MAX_UPLOADED_FILE_SIZE_IN_BYTES = 5242880
 TILE_CACHE_MAX_AGE_IN_SECONDS = 60 * 60 * 24 * 365 # 1 year. Also in deployment/terraform/cdn.tf  # NOQA
 
+# When set, processes load the trained and indexed gazetteer from this file
+# rather than retraining it. The file is written by the snapshot_gazetteer
+# management command or by the first process that has to train a gazetteer.
+GAZETTEER_SNAPSHOT_PATH = os.getenv('GAZETTEER_SNAPSHOT_PATH')
+
+# Partition the gazetteer index into one shard per country. The batch_process
+# command matches the countries in a list using up to
+# GAZETTEER_MATCH_PROCESSES forked processes. Other processes always match in
+# the current process, because they run threads that make forking unsafe.
+GAZETTEER_SHARD_BY_COUNTRY = \
+    os.getenv('GAZETTEER_SHARD_BY_COUNTRY', 'true').lower() == 'true'
+GAZETTEER_MATCH_PROCESSES = int(os.getenv('GAZETTEER_MATCH_PROCESSES', 1))
+
+# Rebuild the gazetteer index in the background once the number of records
+# removed from it reaches this fraction of the number of indexed records
+GAZETTEER_COMPACTION_RATIO = float(
+    os.getenv('GAZETTEER_COMPACTION_RATIO', 0.1))
+
+# When set, the gazetteer used for matching is brought up to date with
+# facility and match changes by a background thread on this interval rather
+# than before each match. Matching waits for the changes to be applied if the
+# gazetteer has not been brought up to date for more than
+# GAZETTEER_MAX_STALENESS_IN_SECONDS
+GAZETTEER_REFRESH_INTERVAL_IN_SECONDS = int(
+    os.getenv('GAZETTEER_REFRESH_INTERVAL_IN_SECONDS', 0))
+GAZETTEER_MAX_STALENESS_IN_SECONDS = int(
+    os.getenv('GAZETTEER_MAX_STALENESS_IN_SECONDS', 300))
+
+# The gazetteer is trained with a random sample of up to this many list items
+# from each country, which is stored in the TrainingSampleItem table
+GAZETTEER_TRAINING_SAMPLE_SIZE_PER_COUNTRY = int(
+    os.getenv('GAZETTEER_TRAINING_SAMPLE_SIZE_PER_COUNTRY', 1000))
+
+# When set, the trained gazetteer model is saved to this file and reused to
+# rebuild the gazetteer until the training data changes
+GAZETTEER_MODEL_SETTINGS_PATH = os.getenv('GAZETTEER_MODEL_SETTINGS_PATH')
+
+# How facility index updates collected by api.models.batch_index_updates are
+# made. 'sync' updates the index before the batch ends, in the same
+# transaction. 'deferred' hands the updates to a background thread after the
+# transaction commits.
+FACILITY_INDEX_MODE = os.getenv('FACILITY_INDEX_MODE', 'sync')
+if FACILITY_INDEX_MODE not in ('sync', 'deferred'):
+    raise ImproperlyConfigured(
+        'Invalid value for FACILITY_INDEX_MODE: {}'.format(
+            FACILITY_INDEX_MODE))
+
 GOOGLE_SERVER_SIDE_API_KEY = os.getenv('GOOGLE_SERVER_SIDE_API_KEY')
 if GOOGLE_SERVER_SIDE_API_KEY is None:
     raise ImproperlyConfigured(
         'Invalid GOOGLE_SERVER_SIDE_API_KEY provided, must be set')
 
+# The maximum average rate of requests sent to the Google geocoding API
+GEOCODING_REQUESTS_PER_SECOND = float(
+    os.getenv('GEOCODING_REQUESTS_PER_SECOND', 50))
+
+# The number of times a geocoding request that fails with a server error or
+# an OVER_QUERY_LIMIT status is retried
+GEOCODING_MAX_RETRIES = int(os.getenv('GEOCODING_MAX_RETRIES', 3))
+
+GEOCODING_TIMEOUT_IN_SECONDS = float(
+    os.getenv('GEOCODING_TIMEOUT_IN_SECONDS', 10))
+
+# The number of geocoding requests sent at the same time when geocoding a
+# batch of addresses
+GEOCODING_CONCURRENCY = int(os.getenv('GEOCODING_CONCURRENCY', 10))
+
+# The number of days for which the result of geocoding an address is reused
+# instead of geocoding the address again. Set to 0 to disable the cache.
+GEOCODING_CACHE_TTL_IN_DAYS = int(
+    os.getenv('GEOCODING_CACHE_TTL_IN_DAYS', 90))
+
+# Where rendered vector tiles are stored so that each tile is only rendered
+# once for a tile cache key and set of filters. One of 'memory', 'disk',
+# 'redis' or 's3'. Leave empty to render every tile that is requested.
+TILE_CACHE_BACKEND = os.getenv('TILE_CACHE_BACKEND', '')
+if TILE_CACHE_BACKEND not in ('', 'memory', 'disk', 'redis', 's3'):
+    raise ImproperlyConfigured(
+        'Invalid value for TILE_CACHE_BACKEND: {}'.format(TILE_CACHE_BACKEND))
+
+# The maximum total size of the tiles kept by the memory and disk tile cache
+# backends, which evict the least recently used tiles first. The redis and s3
+# backends rely on the server eviction policy or a bucket lifecycle rule.
+TILE_CACHE_MAX_SIZE_IN_BYTES = int(
+    os.getenv('TILE_CACHE_MAX_SIZE_IN_BYTES', 512 * 1024 * 1024))
+
+TILE_CACHE_DIRECTORY = os.getenv('TILE_CACHE_DIRECTORY', '/tmp/oar-tiles')
+
+TILE_CACHE_REDIS_URL = os.getenv('TILE_CACHE_REDIS_URL',
+                                 'redis://localhost:6379/0')
+
+# Set TILE_CACHE_S3_ENDPOINT_URL to use an S3 compatible service, such as a
+# local MinIO server, in place of AWS
+TILE_CACHE_S3_BUCKET = os.getenv('TILE_CACHE_S3_BUCKET')
+TILE_CACHE_S3_ENDPOINT_URL = os.getenv('TILE_CACHE_S3_ENDPOINT_URL')
+if TILE_CACHE_BACKEND == 's3' and not TILE_CACHE_S3_BUCKET:
+    raise ImproperlyConfigured(
+        'TILE_CACHE_S3_BUCKET must be set to use the s3 tile cache backend')
+
+# Keep the locations and filterable attributes of the indexed facilities in
+# memory in each process to create filtered facility grid tiles without
+# querying the database. The store is rebuilt when the tile cache key changes,
+# which is checked at most once every refresh interval.
+FACILITY_POINT_STORE = \
+    os.getenv('FACILITY_POINT_STORE', 'true').lower() == 'true'
+FACILITY_POINT_STORE_REFRESH_INTERVAL_IN_SECONDS = int(
+    os.getenv('FACILITY_POINT_STORE_REFRESH_INTERVAL_IN_SECONDS', 60))
+
 if not DEBUG:
     ROLLBAR = {
         'access_token': os.getenv('ROLLBAR_SERVER_SIDE_ACCESS_TOKEN'),